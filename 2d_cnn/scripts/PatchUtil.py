@@ -1,3 +1,4 @@
+import itertools
 import numpy as np
 import warnings 
 
@@ -66,9 +67,45 @@ def from_patches(patches, patch_n, target_shape, pad=0):
     
     return canvas[...,~-1]/canvas[...,-1]
 
+def get_patch_offsets(size, patch_size, n):
+    """
+    Start indices of n evenly spaced-out patches of length patch_size along an axis of length size.
+    """
+    stride = (size - patch_size) / (n - 1) if n > 1 else 0
+    return [int(i*stride) for i in range(n)]
+
+def get_blending_window(patch_shape, mode="gaussian", sigma_scale=1/8, min_weight=1e-3):
+    """
+    Separable 2D weighting window to blend overlapping patches, maximal at the center of the patch and decaying
+    towards its borders (same window as the 3D pipeline, 3d_cnn/src/tensors/actions.py).
+
+    Arguments:
+        patch_shape: shape of the window: (height, width).
+        mode: "gaussian" or "cosine".
+        sigma_scale: standard deviation of the gaussian window, relative to the side length.
+        min_weight: minimum weight relative to the maximum, so that every pixel has a positive weight.
+
+    Returns:
+        A float32 numpy array of shape patch_shape, with maximum 1.
+    """
+    assert mode in ["gaussian", "cosine"], "blending mode should be gaussian or cosine"
+
+    profiles = []
+    for length in patch_shape:
+        position = np.arange(length) + 0.5
+        if mode == "gaussian":
+            sigma = sigma_scale * length
+            profiles.append(np.exp(-(position - length / 2) ** 2 / (2 * sigma ** 2)))
+        else:
+            profiles.append(0.5 * (1 - np.cos(2 * np.pi * position / length)))
+
+    window = np.outer(*profiles).astype(np.float32)
+    window /= window.max()
+    return np.maximum(window, min_weight)
+
 def into_patches_3d(image, patch_shape, patch_n):
     """
-    Process a 3D image stack into evenly spaced-out 2D patches.
+    Process a 3D image stack into evenly spaced-out 2D patches, without copying it.
     
     Arguments:
         image: image stack to process into patches as a 3D numpy array.
@@ -76,66 +113,76 @@ def into_patches_3d(image, patch_shape, patch_n):
         patch_n: number of rows and columns of patches: (rows, columns).
     
     Returns:
-        A stack of patches as a numpy array of shape (patch_n[0]*patch_n[1]*z, y, x).
+        A list of patch_n[0]*patch_n[1] views of the image of shape (z, y, x), one per patch position, in the order
+        expected by from_patches_3d. np.concatenate of the list gives a stack of shape (patch_n[0]*patch_n[1]*z, y, x).
     """
 
     assert len(patch_shape) == len(patch_n), "Rank of patch shape and patch number need to match number of selected axis"
     
-    y_stride = (image.shape[1] - patch_shape[0]) / (patch_n[0] - 1) if patch_n[0] > 1 else 0
-    x_stride = (image.shape[2] - patch_shape[1]) / (patch_n[1] - 1) if patch_n[1] > 1 else 0
+    y_offsets = get_patch_offsets(image.shape[1], patch_shape[0], patch_n[0])
+    x_offsets = get_patch_offsets(image.shape[2], patch_shape[1], patch_n[1])
     
-    out = np.vstack([
-            image[
-                :,
-                int(row*y_stride):int(row*y_stride)+patch_shape[0],
-                int(col*x_stride):int(col*x_stride)+patch_shape[1]
-            ] for col in range(patch_n[1]) for row in range(patch_n[0])
-        ])
-    return out
+    return [image[:, y:y+patch_shape[0], x:x+patch_shape[1]] for x in x_offsets for y in y_offsets]
 
-def from_patches_3d(patches, patch_n, target_shape, pad=0):
+def from_patches_3d(patches, patch_n, target_shape, pad=0, blending=None):
     """
     Assemble a 3D image stack from evenly spaced-out 2D patches.
-    Patches need to be grouped along first array axis by patch position, not by Z-slice; 
+    Patches need to be grouped by patch position, not by Z-slice; 
     this can be ensured by using PatchUtil.into_patches_3d to create patches.
-    Overlapping areas will be averaged.
+    Overlapping areas will be averaged, optionally weighted with a blending window.
+    The patches are summed into a float32 canvas, and their coverage (the sum of their weights) is counted in a single
+    2D map shared by all Z-slices.
 
     Arguments:
-        patches: stack of patches as a numpy array of shape (patch_n[0]*patch_n[1]*z, y, x).
+        patches: stack of patches as a numpy array of shape (patch_n[0]*patch_n[1]*z, y, x), or iterable of
+            patch_n[0]*patch_n[1] arrays of shape (z, y, x), one per patch position (e.g. a generator of the
+            predictions of the views returned by into_patches_3d, so that they are not all held in memory).
         patch_n: number of rows and columns of patches: (rows, columns).
         target_shape: target shape in which the patches shall be assembled into.
         pad: cropping to apply to patches on all sides.
+        blending: None to average overlapping patches, or "gaussian"/"cosine" to weight them with a window decaying
+            towards their borders (see get_blending_window), to avoid seams.
 
     Returns:
-        A 3D assembly of the patches as a numpy array in the target shape.
+        A 3D assembly of the patches as a float32 numpy array in the target shape.
     """
-    # TODO: check whether optimizing this function is viable, counter channel could also just be 2D.
-    
-    y_stride = (target_shape[1] - patches.shape[1]) / (patch_n[0] - 1) if patch_n[0] > 1 else 0
-    x_stride = (target_shape[2] - patches.shape[2]) / (patch_n[1] - 1) if patch_n[1] > 1 else 0
+    if isinstance(patches, np.ndarray):
+        patches = np.split(patches, patch_n[0]*patch_n[1])
+    patches = iter(patches)
+    first_patch = next(patches)
+
+    patch_shape = first_patch.shape[1:]
+    y_offsets = get_patch_offsets(target_shape[1], patch_shape[0], patch_n[0])
+    x_offsets = get_patch_offsets(target_shape[2], patch_shape[1], patch_n[1])
     
-    canvas_shape = list(target_shape)+[2]
+    canvas_shape = list(target_shape)
     if pad:
-        patches = patches[:, pad:-pad, pad:-pad]
+        patch_shape = (patch_shape[0] - 2*pad, patch_shape[1] - 2*pad)
         canvas_shape[1] -= 2*pad
         canvas_shape[2] -= 2*pad
-    
-    unstacked = np.split(patches, patch_n[0]*patch_n[1])
-        
-    coords = [
-        (
-            slice(0, canvas_shape[0]),
-            slice(int(y*y_stride), int(y*y_stride) + patches.shape[1]),
-            slice(int(x*x_stride), int(x*x_stride) + patches.shape[2])
-        ) for x in range(patch_n[1]) for y in range(patch_n[0]) 
-    ]
-    
-    canvas = np.zeros(canvas_shape)
-    
-    for patch, coord in zip(unstacked, coords):
-        canvas[coord] += np.stack([patch, np.ones(patch.shape)], -1)
-    
-    if np.any(canvas[...,-1] == 0):
+
+    canvas = np.zeros(canvas_shape, dtype=np.float32)
+    coverage = np.zeros(canvas_shape[1:], dtype=np.float32)
+    if blending:
+        window = get_blending_window(patch_shape, mode=blending)
+        weighted_patch = np.empty([canvas_shape[0]] + list(patch_shape), dtype=np.float32)
+
+    positions = [(y, x) for x in x_offsets for y in y_offsets]
+    for patch, (y, x) in zip(itertools.chain([first_patch], patches), positions):
+        if pad:
+            patch = patch[:, pad:-pad, pad:-pad]
+        region = (slice(y, y + patch_shape[0]), slice(x, x + patch_shape[1]))
+        if blending:
+            np.multiply(patch, window, out=weighted_patch)
+            canvas[(slice(None),) + region] += weighted_patch
+            coverage[region] += window
+        else:
+            canvas[(slice(None),) + region] += patch
+            coverage[region] += 1
+    
+    if np.any(coverage == 0):
         warnings.warn("zero-coverage regions detected")
 
-    return canvas[...,~-1]/canvas[...,-1]
\ No newline at end of file
+    with np.errstate(divide="ignore", invalid="ignore"):
+        canvas /= coverage
+    return canvas
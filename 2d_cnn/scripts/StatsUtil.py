@@ -0,0 +1,86 @@
+import json
+import os
+import warnings
+
+import mrcfile
+import numpy as np
+
+# Same sidecar files as the statistics of the 3D pipeline (3d_cnn/src/image/statistics.py),
+# so that both reuse each other's results
+STATISTICS_CACHE_SUFFIX = ".stats.json"
+CHUNK_VOXELS = 2 ** 24
+
+def get_file_key(path):
+    """
+    Identifies a version of a file: statistics cached for another path, size or modification time are ignored.
+    """
+    file_stat = os.stat(path)
+    return {"path": os.path.abspath(path), "size": file_stat.st_size, "mtime_ns": file_stat.st_mtime_ns}
+
+def read_cached_regions(cache_path, file_key):
+    try:
+        with open(cache_path, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    if any(cache.get(key) != value for key, value in file_key.items()):
+        return {}
+
+    return cache.get("regions", {})
+
+def write_cached_regions(cache_path, file_key, regions):
+    temporary_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with open(temporary_path, "w") as f:
+            json.dump(dict(file_key, regions=regions), f, indent=1)
+        os.replace(temporary_path, cache_path)
+    except OSError as e:
+        warnings.warn(f"Could not write the statistics cache {cache_path} ({e})")
+
+def compute_moments(data, z_start, z_stop):
+    """
+    Mean and standard deviation of data[z_start:z_stop] in a single pass over float64 chunks of z-slices,
+    combining the mean and sum of squared deviations of each chunk.
+    """
+    count, mean, squared_deviations = 0, 0., 0.
+    minimum, maximum = np.inf, -np.inf
+    slices_per_chunk = max(CHUNK_VOXELS // max(int(np.prod(data.shape[1:])), 1), 1)
+
+    for z in range(z_start, z_stop, slices_per_chunk):
+        chunk = np.array(data[z:min(z + slices_per_chunk, z_stop)], dtype=np.float64).ravel()
+        chunk_mean = chunk.mean()
+        minimum = min(minimum, float(chunk.min()))
+        maximum = max(maximum, float(chunk.max()))
+        chunk -= chunk_mean
+
+        total_count = count + chunk.size
+        delta = chunk_mean - mean
+        mean += delta * chunk.size / total_count
+        squared_deviations += np.dot(chunk, chunk) + delta ** 2 * count * chunk.size / total_count
+        count = total_count
+
+    assert count > 0, "Empty tomogram region"
+    return {"count": count, "mean": float(mean), "std": float(np.sqrt(squared_deviations / count)),
+            "min": minimum, "max": maximum}
+
+def get_mrc_mean_std(path, z_range=None):
+    """
+    Mean and standard deviation of a memory-mapped MRC file, or of its z-slices in [z_range[0], z_range[1]),
+    cached in the sidecar file <path>.stats.json.
+    """
+    file_key = get_file_key(path)
+    cache_path = path + STATISTICS_CACHE_SUFFIX
+    region_name = "all" if z_range is None else "{}:{}".format(*z_range)
+    statistics = read_cached_regions(cache_path, file_key).get(region_name, {})
+
+    if "mean" not in statistics:
+        with mrcfile.mmap(path, mode="r", permissive=True) as f:
+            z_start, z_stop = (0, f.data.shape[0]) if z_range is None else z_range
+            statistics = compute_moments(f.data, z_start, z_stop)
+
+        regions = read_cached_regions(cache_path, file_key)
+        regions[region_name] = statistics
+        write_cached_regions(cache_path, file_key, regions)
+
+    return statistics["mean"], statistics["std"]
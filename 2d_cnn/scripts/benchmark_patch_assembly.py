@@ -0,0 +1,83 @@
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+
+from PatchUtil import from_patches_3d, into_patches_3d
+from ConfigUtil import csv_list
+
+def main():
+    parser = get_cli()
+    args = parser.parse_args()
+
+    if len(args.patch_dim) == 1:
+        args.patch_dim *= 2
+    if len(args.patch_size) == 1:
+        args.patch_size *= 2
+
+    tomo = np.random.default_rng(0).standard_normal(args.shape, dtype=np.float32)
+
+    for blending in [None] + args.blending:
+        # Stand-in for the predictions: a copy of each patch position, made only when it is assembled
+        tracemalloc.start()
+        start = time.time()
+        tomo_patches = into_patches_3d(tomo, args.patch_size, args.patch_dim)
+        tomo_pred = (patches.copy() for patches in tomo_patches)
+        rec = from_patches_3d(tomo_pred, args.patch_dim, tomo.shape, pad=args.crop, blending=blending)
+        elapsed = time.time() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"Blending: {blending}, output {rec.shape} {rec.dtype}, time: {elapsed:.1f} s, "
+              f"peak memory: {peak / 2**20:.0f} MB (tomogram: {tomo.nbytes / 2**20:.0f} MB)")
+        del rec
+
+def get_cli():
+    parser = argparse.ArgumentParser(
+        description="Time and peak memory of slicing a random tomogram into 2D patches and reassembling them."
+    )
+
+    parser.add_argument(
+        "-s",
+        "--shape",
+        type=csv_list,
+        default=[500, 1000, 1000],
+        help="Comma-separated shape (z, y, x) of the random tomogram."
+    )
+
+    parser.add_argument(
+        "-p",
+        "--patch_size",
+        type=csv_list,
+        default=[288, 288],
+        help="Comma-separated height and width for patches."
+    )
+
+    parser.add_argument(
+        "-d",
+        "--patch_dim",
+        type=csv_list,
+        default=[5, 5],
+        help="Comma-separated numbers of row and columns of patches."
+    )
+
+    parser.add_argument(
+        "-x",
+        "--crop",
+        type=int,
+        default=48,
+        help="Crop patches on reassembly."
+    )
+
+    parser.add_argument(
+        "-b",
+        "--blending",
+        nargs="*",
+        default=["gaussian"],
+        help="Blending windows to benchmark besides plain averaging."
+    )
+
+    return parser
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,7 @@ import os
 
 from PatchUtil import *
 from ConfigUtil import assemble_config, csv_list
+from StatsUtil import get_mrc_mean_std
 
 from UNet import dice_coefficient, neg_dice_coefficient
 
@@ -53,18 +54,19 @@ def main():
         tomo_header = f.header
     
     orig_shape = tomo.shape
+    z_range = None
 
     if config["z_cutoff"]:
         config["z_cutoff"] = min(tomo.shape[0], config["z_cutoff"])
         z_center = tomo.shape[0] // 2
         z_idx = slice(z_center-(config["z_cutoff"] // 2), z_center+(config["z_cutoff"] // 2))
+        z_range = (z_idx.start, z_idx.stop)
 
         tomo = tomo[z_idx]
 
-    # Normalization
+    # Normalization, with the statistics cached next to the tomogram
     if config["normalize"]:
-        mean = tomo.mean()
-        std = tomo.std()
+        mean, std = get_mrc_mean_std(tomo_file, z_range)
 
         tomo -= mean
         tomo /= std
@@ -73,10 +75,11 @@ def main():
         padding = [(0, 0)] + [(config["crop"],)*2]*2
         tomo = np.pad(tomo, padding, mode="reflect")
 
-    # Slice & predict
-    tomo_patches = np.expand_dims(into_patches_3d(tomo, config["patch_size"], config["patch_dim"]), -1) # Add channel dim
-    tomo_pred = model.predict(tomo_patches)
-    rec = from_patches_3d(tomo_pred[...,0], config["patch_dim"], tomo.shape, pad=config["crop"])
+    # Slice & predict, one patch position at a time: the patches are views of the tomogram, and each prediction
+    # is added to the reassembly before the next one is made
+    tomo_patches = into_patches_3d(tomo, config["patch_size"], config["patch_dim"])
+    tomo_pred = (model.predict(np.expand_dims(patches, -1))[...,0] for patches in tomo_patches) # Add channel dim
+    rec = from_patches_3d(tomo_pred, config["patch_dim"], tomo.shape, pad=config["crop"], blending=config["blending"])
 
     if config["compensate_crop"]:
         padding = [((i - o)//2,)*2 for i, o in zip(orig_shape, rec.shape)]
@@ -166,6 +169,14 @@ def get_cli():
         help="Comma-separated numbers of row and columns of patches to be evenly-spaced out along tomogram slices."
     )
 
+    parser.add_argument(
+        "-b",
+        "--blending",
+        required=False,
+        choices=["gaussian", "cosine"],
+        help="Blend overlapping patches with a gaussian or cosine window instead of averaging them."
+    )
+
     parser.add_argument(
         "-z",
         "--z_cutoff",
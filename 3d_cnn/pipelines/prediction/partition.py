@@ -1,20 +1,21 @@
 import argparse
 import os
 
-import numpy as np
 import pandas as pd
 import yaml
 
 from constants.dataset_tables import DatasetTableHeader, ModelsTableHeader
-from file_actions.readers.tomograms import load_tomogram
+from file_actions.readers.tomograms import load_tomogram, load_tomograms_in_common_shape
 from tomogram_utils.volume_actions.actions import \
-    partition_raw_intersecting_mask
+    generate_partition_with_workers, partition_raw_intersecting_mask
 from tomogram_utils.volume_actions.actions import partition_tomogram
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-yaml_file", "--yaml_file", help="yaml_file", type=str)
 parser.add_argument("-tomos_set", "--tomos_set",
                     help="tomos set name to be used for training", type=int)
+parser.add_argument("-workers", "--workers", type=int, default=1,
+                    help="processes writing each partition")
 args = parser.parse_args()
 yaml_file = args.yaml_file
 config = yaml.safe_load(open(yaml_file))
@@ -58,27 +59,23 @@ if write_on_table:
             tomo_df = df[df[DTHeader.tomo_name] == tomo_name]
             path_to_raw = tomo_df.iloc[0][DTHeader.processing_tomo]
             path_to_lamella = tomo_df.iloc[0][DTHeader.filtering_mask]
-            raw_dataset = load_tomogram(path_to_dataset=path_to_raw)
-            if isinstance(path_to_lamella, float):
+            if args.workers > 1:
+                generate_partition_with_workers(path_to_raw=path_to_raw,
+                                                output_h5_file_path=partition_path,
+                                                subtomo_shape=subtomogram_shape,
+                                                overlap=overlap,
+                                                workers=args.workers,
+                                                path_to_mask=None if isinstance(path_to_lamella, float)
+                                                else path_to_lamella)
+            elif isinstance(path_to_lamella, float):
                 print("No filtering mask file available.")
+                raw_dataset = load_tomogram(path_to_dataset=path_to_raw)
                 partition_tomogram(dataset=raw_dataset,
                                    output_h5_file_path=partition_path,
                                    subtomo_shape=subtomogram_shape,
                                    overlap=overlap)
             else:
-                path_to_lamella = tomo_df.iloc[0][DTHeader.filtering_mask]
-                lamella_mask = load_tomogram(path_to_dataset=path_to_lamella)
-
-                lamella_shape = lamella_mask.shape
-                dataset_shape = raw_dataset.shape
-
-                minimum_shape = [np.min([data_dim, lamella_dim]) for
-                                 data_dim, lamella_dim
-                                 in zip(dataset_shape, lamella_shape)]
-                minz, miny, minx = minimum_shape
-
-                lamella_mask = lamella_mask[:minz, :miny, :minx]
-                raw_dataset = raw_dataset[:minz, :miny, :minx]
+                raw_dataset, lamella_mask = load_tomograms_in_common_shape([path_to_raw, path_to_lamella])
 
                 partition_raw_intersecting_mask(dataset=raw_dataset,
                                                 mask_dataset=lamella_mask,
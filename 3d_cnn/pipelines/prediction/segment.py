@@ -8,6 +8,7 @@ import yaml
 
 from constants.dataset_tables import ModelsTableHeader, DatasetTableHeader
 from file_actions.writers.h5 import segment_and_write
+from networks.inference import prepare_model_for_inference, set_inference_threads
 from networks.io import get_device
 from networks.unet import UNet3D, UNet
 
@@ -72,7 +73,12 @@ if torch.cuda.device_count() > 1:
 
 checkpoint = torch.load(path_to_model, map_location=device)
 model.load_state_dict(checkpoint['model_state_dict'])
-model = model.eval()
+set_inference_threads(num_threads=config["prediction"].get("num_threads", None))
+model = prepare_model_for_inference(model=model, device=device,
+                                    channels_last=config["prediction"].get("channels_last", False),
+                                    compile_mode=config["prediction"].get("compile", None),
+                                    example_input_shape=[1, 1] + box_shape,
+                                    amp=config["prediction"].get("amp", None))
 
 DTHeader = DatasetTableHeader(partition_name=test_partition)
 df = pd.read_csv(dataset_table, dtype={DTHeader.tomo_name: str})
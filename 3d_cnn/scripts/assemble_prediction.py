@@ -20,7 +20,7 @@ from constants import h5_internal_paths
 from constants.config import Config
 from constants.dataset_tables import DatasetTableHeader
 from file_actions.writers.h5 import assemble_tomo_from_subtomos
-from file_actions.readers.tomograms import load_tomogram
+from file_actions.readers.metadata_index import get_tomogram_metadata
 from paths.pipeline_dirs import get_probability_map_path, testing_partition_path
 from constants.config import get_model_name
 
@@ -62,9 +62,7 @@ if run_job:
     tomo_df = df[df[DTHeader.tomo_name] == tomo_name]
     print("config.processing_tomo", config.processing_tomo)
     tomo_path = tomo_df.iloc[0][config.processing_tomo]
-    tomo = load_tomogram(path_to_dataset=tomo_path)
-    output_shape = tomo.shape
-    del tomo
+    output_shape = get_tomogram_metadata(path_to_dataset=tomo_path, dataset_table=config.dataset_table)["shape"]
 
     subtomos_internal_path = os.path.join(
         h5_internal_paths.PREDICTED_SEGMENTATION_SUBTOMOGRAMS,
@@ -72,8 +70,10 @@ if run_job:
 
     assemble_tomo_from_subtomos(output_path=output_path, partition_file_path=data_partition, output_shape=output_shape,
                                 subtomo_shape=box_shape, subtomos_internal_path=subtomos_internal_path,
-                                class_number=config.pred_class_number, overlap=config.overlap,
-                                reconstruction_type="prediction", final_activation='sigmoid')
+                                class_number=config.pred_class_number, overlap=config.pred_overlap,
+                                reconstruction_type="prediction", final_activation='sigmoid',
+                                blending=config.pred_blending,
+                                min_mask_fraction=config.region_mask_min_fraction)
 
     print("Assembling prediction has finalized.")
 
@@ -0,0 +1,90 @@
+import argparse
+import sys
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-pythonpath", "--pythonpath", type=str)
+parser.add_argument("-shape", "--shape", type=int, nargs=3, default=[160, 192, 192],
+                    help="shape (z, y, x) of the synthetic tomogram")
+parser.add_argument("-box_side", "--box_side", type=int, default=64)
+parser.add_argument("-overlaps", "--overlaps", type=int, nargs="+", default=[12, 6, 4])
+parser.add_argument("-batch_size", "--batch_size", type=int, default=4)
+parser.add_argument("-threads", "--threads", type=int, default=1)
+parser.add_argument("-seed", "--seed", type=int, default=0)
+args = parser.parse_args()
+pythonpath = args.pythonpath
+sys.path.append(pythonpath)
+
+import contextlib
+import io
+import os
+import tempfile
+import time
+
+import h5py
+import numpy as np
+import torch.nn as nn
+from scipy.ndimage import gaussian_filter
+
+from constants import h5_internal_paths
+from file_actions.writers.h5 import assemble_tomo_from_subtomos, segment_and_write
+from networks.inference import set_inference_threads
+from tomogram_utils.volume_actions.actions import partition_tomogram
+
+
+class BorderBiasedNetwork(nn.Module):
+    """
+    Zero-padded smoothing of the raw tile: accurate in the tile center,
+    biased towards the background near the tile border.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.conv = nn.Conv3d(1, 1, 11, padding=5, bias=False)
+        self.conv.weight.data[:] = 1 / 11 ** 3
+
+    def forward(self, x):
+        return 12 * (self.conv(self.conv(x)) - 0.25)
+
+
+def dice(probabilities, truth):
+    prediction = probabilities > 0.5
+    return 2 * np.count_nonzero(prediction & truth) / (np.count_nonzero(prediction) + np.count_nonzero(truth))
+
+
+set_inference_threads(args.threads)
+rng = np.random.default_rng(args.seed)
+truth = gaussian_filter(rng.normal(size=args.shape), 4) > 0.02
+raw = (truth + rng.normal(scale=1.0, size=args.shape)).astype(np.float32)
+model = BorderBiasedNetwork().eval()
+subtomo_shape = (args.box_side,) * 3
+print("Synthetic tomogram of shape", raw.shape, "with {:.1f}% foreground".format(100 * truth.mean()))
+
+with tempfile.TemporaryDirectory() as tmp_dir:
+    for overlap in args.overlaps:
+        partition_path = os.path.join(tmp_dir, "partition_{}.h5".format(overlap))
+        with contextlib.redirect_stdout(io.StringIO()):
+            partition_tomogram(dataset=raw, output_h5_file_path=partition_path,
+                               subtomo_shape=subtomo_shape, overlap=overlap)
+        with h5py.File(partition_path, 'r') as f:
+            tiles = len(f[h5_internal_paths.RAW_SUBTOMOGRAMS])
+        start = time.time()
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            segment_and_write(data_path=partition_path, model=model, label_name="synthetic",
+                              mean_value=0, std_value=1, batch_size=args.batch_size)
+        segmentation_time = time.time() - start
+        for blending in [None, "gaussian", "cosine"]:
+            output_path = os.path.join(tmp_dir, "prediction.hdf")
+            start = time.time()
+            with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                assemble_tomo_from_subtomos(
+                    output_path=output_path, partition_file_path=partition_path,
+                    output_shape=raw.shape, subtomo_shape=subtomo_shape,
+                    subtomos_internal_path=os.path.join(h5_internal_paths.PREDICTED_SEGMENTATION_SUBTOMOGRAMS,
+                                                        "synthetic"),
+                    class_number=0, overlap=overlap, final_activation="sigmoid", blending=blending)
+            assembly_time = time.time() - start
+            with h5py.File(output_path, 'r') as f:
+                probabilities = f[h5_internal_paths.HDF_INTERNAL_PATH][:]
+            print("overlap {:>2}, {:<12}: {:>4} tiles, {:5.1f} s (assembly {:4.1f} s), dice {:.3f}".format(
+                overlap, "hard stitch" if blending is None else blending, tiles,
+                segmentation_time + assembly_time, assembly_time, dice(probabilities, truth)))
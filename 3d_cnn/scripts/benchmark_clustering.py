@@ -0,0 +1,46 @@
+import argparse
+import sys
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-pythonpath", "--pythonpath", type=str)
+parser.add_argument("-shape", "--shape", type=int, nargs=3, default=[400, 1000, 1000],
+                    help="shape (z, y, x) of the synthetic segmentation")
+parser.add_argument("-n_particles", "--n_particles", type=int, default=50000)
+parser.add_argument("-min_cluster_size", "--min_cluster_size", type=int, default=100)
+parser.add_argument("-max_cluster_size", "--max_cluster_size", type=int, default=35000)
+parser.add_argument("-connectivity", "--connectivity", type=int, default=1)
+parser.add_argument("-seed", "--seed", type=int, default=0)
+args = parser.parse_args()
+pythonpath = args.pythonpath
+sys.path.append(pythonpath)
+
+import resource
+import time
+
+import numpy as np
+
+from tomogram_utils.coordinates_toolbox.clustering import get_cluster_centroids
+
+
+def get_peak_memory_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Synthetic segmentation: spheres of random radii, some of them touching
+rng = np.random.default_rng(args.seed)
+dataset = np.zeros(args.shape, dtype=np.int8)
+for center, radius in zip(rng.integers(0, args.shape, size=(args.n_particles, 3)),
+                          rng.integers(2, 9, size=args.n_particles)):
+    slices = tuple(slice(max(c - radius, 0), min(c + radius + 1, dim)) for c, dim in zip(center, args.shape))
+    grid = np.ogrid[slices]
+    dataset[slices][sum((g - c) ** 2 for g, c in zip(grid, center)) <= radius ** 2] = 1
+print("Synthetic segmentation of shape", dataset.shape, "with", np.count_nonzero(dataset), "foreground voxels")
+print("Peak memory after generating the dataset: {:.0f} MB".format(get_peak_memory_mb()))
+
+start = time.time()
+clusters_map, centroids_list, cluster_size_list = \
+    get_cluster_centroids(dataset=dataset, min_cluster_size=args.min_cluster_size,
+                          max_cluster_size=args.max_cluster_size, connectivity=args.connectivity)
+print("{} clusters within size range, output dtype {}".format(len(centroids_list), clusters_map.dtype))
+print("Clustering wall time: {:.1f} s".format(time.time() - start))
+print("Peak memory: {:.0f} MB".format(get_peak_memory_mb()))
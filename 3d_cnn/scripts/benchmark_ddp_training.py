@@ -0,0 +1,69 @@
+import argparse
+import sys
+
+parser = argparse.ArgumentParser(description="Times training epochs of a UNet3D on random boxes. "
+                                             "Launch with torchrun --nproc_per_node=N to train "
+                                             "with N processes.")
+parser.add_argument("-pythonpath", "--pythonpath", type=str)
+parser.add_argument("-n_boxes", "--n_boxes", type=int, default=64,
+                    help="training boxes, shared between the processes")
+parser.add_argument("-box_size", "--box_size", type=int, default=32)
+parser.add_argument("-batch_size", "--batch_size", type=int, default=2,
+                    help="batch size of each process")
+parser.add_argument("-depth", "--depth", type=int, default=2)
+parser.add_argument("-initial_features", "--initial_features", type=int, default=8)
+parser.add_argument("-epochs", "--epochs", type=int, default=3)
+parser.add_argument("-seed", "--seed", type=int, default=0)
+args = parser.parse_args()
+pythonpath = args.pythonpath
+sys.path.append(pythonpath)
+
+import time
+
+import torch
+import torch.nn as nn
+import torch.optim as optim
+import torch.utils.data as du
+
+from networks.datasets import get_data_loader
+from networks.distributed import cleanup_distributed, get_distributed_device, \
+    get_world_size, init_distributed, is_main_process, set_loader_epoch, \
+    wrap_distributed
+from networks.io import get_device
+from networks.loss import DiceCoefficientLoss
+from networks.routines import train
+from networks.unet import UNet3D
+
+distributed = init_distributed()
+device = get_distributed_device() if distributed else get_device()
+torch.manual_seed(args.seed)
+
+generator = torch.Generator().manual_seed(args.seed)
+shape = (args.n_boxes, 1) + (args.box_size,) * 3
+raw_data = torch.randn(shape, generator=generator)
+labels = (torch.rand(shape, generator=generator) > 0.5).long()
+loader = get_data_loader(du.TensorDataset(raw_data, labels), batch_size=args.batch_size,
+                         shuffle=True, seed=args.seed)
+
+net = UNet3D(final_activation=nn.Sigmoid(), depth=args.depth,
+             initial_features=args.initial_features, out_channels=1)
+net = wrap_distributed(net, device) if distributed else net.to(device)
+optimizer = optim.Adam(net.parameters())
+lr_scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer)
+loss = DiceCoefficientLoss()
+
+epoch_times = list()
+for epoch in range(args.epochs):
+    set_loader_epoch(loader, epoch)
+    start = time.time()
+    train(model=net, loader=loader, optimizer=optimizer, loss_function=loss,
+          epoch=epoch, device=device, log_interval=len(loader), lr_scheduler=lr_scheduler)
+    epoch_times += [time.time() - start]
+
+if is_main_process():
+    # the first epoch warms up the allocator and the process group
+    epoch_time = min(epoch_times[1:]) if len(epoch_times) > 1 else epoch_times[0]
+    print("Processes:", get_world_size())
+    print("Epoch wall time: {:.2f} s".format(epoch_time))
+    print("Training boxes per second: {:.2f}".format(args.n_boxes / epoch_time))
+cleanup_distributed()
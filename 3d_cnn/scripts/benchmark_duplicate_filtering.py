@@ -0,0 +1,182 @@
+import argparse
+import sys
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-pythonpath", "--pythonpath", type=str)
+parser.add_argument("-n_points", "--n_points", type=int, default=2000)
+parser.add_argument("-shape", "--shape", type=int, nargs=3, default=[100, 200, 200],
+                    help="shape (z, y, x) of the box holding the random clouds")
+parser.add_argument("-min_peak_distance", "--min_peak_distance", type=int, default=10)
+parser.add_argument("-max_num_points", "--max_num_points", type=int, default=300)
+parser.add_argument("-seed", "--seed", type=int, default=0)
+args = parser.parse_args()
+pythonpath = args.pythonpath
+sys.path.append(pythonpath)
+
+import contextlib
+import io
+import time
+
+import numpy as np
+
+from tomogram_utils.coordinates_toolbox.utils import average_duplicated_centroids, \
+    filtering_duplicate_coords, filtering_duplicate_coords_with_values
+
+
+# The loops used before the KD-tree and the cell grid, as references
+
+def filtering_duplicate_coords_reference(motl_coords, min_peak_distance):
+    unique_motl_coords = [motl_coords[0]]
+    for point in motl_coords[1:]:
+        flag = "unique"
+        n_point = 0
+        while flag == "unique" and n_point < len(unique_motl_coords):
+            x = unique_motl_coords[n_point]
+            n_point += 1
+            if np.linalg.norm(x - point) <= min_peak_distance:
+                flag = "repeated"
+        if flag == "unique":
+            unique_motl_coords += [point]
+    return unique_motl_coords
+
+
+def filtering_duplicate_coords_with_values_reference(motl_coords, motl_values, min_peak_distance,
+                                                     preference_by_score=True, max_num_points=np.inf):
+    motl_coords = np.array(motl_coords)
+    unique_motl_coords = [motl_coords[0]]
+    unique_motl_values = [motl_values[0]]
+    for value, point in zip(motl_values[1:], motl_coords[1:]):
+        flag = "unique"
+        n_point = 0
+        n_unique_points = len(unique_motl_coords)
+        if n_unique_points < max_num_points:
+            while flag == "unique" and n_point < n_unique_points:
+                x = unique_motl_coords[n_point]
+                x_val = unique_motl_values[n_point]
+                n_point += 1
+                if np.linalg.norm(x - point) <= min_peak_distance:
+                    flag = "repeated"
+                    if preference_by_score and (x_val < value):
+                        unique_motl_coords[n_point] = point
+                        unique_motl_values[n_point] = value
+            if flag == "unique":
+                unique_motl_coords += [point]
+                unique_motl_values += [value]
+    return unique_motl_values, unique_motl_coords
+
+
+def average_duplicated_centroids_reference(motl_coords, cluster_size_list, min_peak_distance):
+    # the debug print of each merged mean is left out
+    unique_motl_coords = [motl_coords[0]]
+    unique_cluster_size_list = [cluster_size_list[0]]
+    for point, weight_point in zip(motl_coords[1:], cluster_size_list[1:]):
+        flag = "unique"
+        n_point = 0
+        while flag == "unique" and n_point < len(unique_motl_coords):
+            x = unique_motl_coords[n_point]
+            weight_x = unique_cluster_size_list[n_point]
+            n_point += 1
+            distance = np.linalg.norm(np.array(x) - np.array(point))
+            if distance <= min_peak_distance:
+                flag = "repeated"
+                total_weight = weight_point + weight_x
+                rel_weight_x = weight_x / total_weight
+                rel_weight_point = weight_point / total_weight
+                relative_mean = np.array(x) * rel_weight_x + np.array(point) * rel_weight_point
+                unique_motl_coords[n_point - 1] = [int(coord) for coord in relative_mean]
+                unique_cluster_size_list[n_point - 1] = np.mean([weight_point, weight_x])
+        if flag == "unique":
+            unique_motl_coords += [point]
+            unique_cluster_size_list += [weight_point]
+    return unique_motl_coords, unique_cluster_size_list
+
+
+def assert_same_points(points, reference_points):
+    assert len(points) == len(reference_points), \
+        "{} points instead of {}".format(len(points), len(reference_points))
+    for point, reference_point in zip(points, reference_points):
+        assert np.array_equal(point, reference_point), "{} instead of {}".format(point, reference_point)
+
+
+def compare(name, function, reference_function, check, **kwargs):
+    start = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        reference_output = reference_function(**kwargs)
+    reference_time = time.time() - start
+    start = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        output = function(**kwargs)
+    new_time = time.time() - start
+    check(output, reference_output)
+    print("{:<64} loop {:6.2f} s   new {:.3f} s".format(name, reference_time, new_time))
+
+
+def check_with_values(output, reference_output):
+    assert output[0] == reference_output[0], "values differ"
+    assert_same_points(output[1], reference_output[1])
+
+
+def check_averaged(output, reference_output):
+    assert_same_points(output[0], reference_output[0])
+    assert output[1] == reference_output[1], "cluster sizes differ"
+
+
+rng = np.random.default_rng(args.seed)
+distance = args.min_peak_distance
+clouds = {"integer": rng.integers(0, args.shape, size=(args.n_points, 3)),
+          "float": rng.random((args.n_points, 3)) * args.shape}
+# near-duplicates, many of them exactly at min_peak_distance
+near_duplicates = np.repeat(clouds["integer"][:args.n_points // 4], 4, axis=0)
+clouds["near-duplicate"] = near_duplicates + rng.choice([0, distance, -distance], size=near_duplicates.shape) * \
+    (rng.random(near_duplicates.shape) < 0.3)
+
+for cloud_name, coordinates in clouds.items():
+    motl_coords = list(coordinates)
+    unsorted_values = list(rng.random(len(motl_coords)))
+    sorted_values = sorted(unsorted_values, reverse=True)
+    equal_values = [1.0] * len(motl_coords)
+    compare("{}: filtering_duplicate_coords".format(cloud_name),
+            filtering_duplicate_coords, filtering_duplicate_coords_reference, assert_same_points,
+            motl_coords=motl_coords, min_peak_distance=distance)
+    for values_name, values, preference_by_score in [("sorted values, preference", sorted_values, True),
+                                                     ("equal values, preference", equal_values, True),
+                                                     ("unsorted values", unsorted_values, False)]:
+        for max_num_points in [np.inf, args.max_num_points]:
+            compare("{}: with_values, {}, max {}".format(cloud_name, values_name, max_num_points),
+                    filtering_duplicate_coords_with_values, filtering_duplicate_coords_with_values_reference,
+                    check_with_values, motl_coords=motl_coords, motl_values=values,
+                    min_peak_distance=distance, preference_by_score=preference_by_score,
+                    max_num_points=max_num_points)
+    compare("{}: average_duplicated_centroids".format(cloud_name),
+            average_duplicated_centroids, average_duplicated_centroids_reference, check_averaged,
+            motl_coords=[list(point) for point in motl_coords],
+            cluster_size_list=list(rng.integers(1, 1000, size=len(motl_coords))), min_peak_distance=distance)
+
+# Behaviour change with preference_by_score and unsorted scores: a higher
+# scored point replaces the kept point it is close to. The old loop replaced
+# the next kept point instead, or raised IndexError if there was none.
+motl_coords = [np.array([0, 0, 0]), np.array([20, 0, 0]), np.array([1, 0, 0])]
+motl_values = [1.0, 1.0, 5.0]
+with contextlib.redirect_stdout(io.StringIO()):
+    reference_values, reference_coords = filtering_duplicate_coords_with_values_reference(
+        motl_coords, motl_values, min_peak_distance=2, preference_by_score=True)
+    values, coords = filtering_duplicate_coords_with_values(motl_coords, motl_values, min_peak_distance=2,
+                                                            preference_by_score=True)
+assert_same_points(reference_coords, [[0, 0, 0], [1, 0, 0]])
+assert reference_values == [1.0, 5.0]
+assert_same_points(coords, [[1, 0, 0], [20, 0, 0]])
+assert values == [5.0, 1.0]
+try:
+    with contextlib.redirect_stdout(io.StringIO()):
+        filtering_duplicate_coords_with_values_reference(motl_coords[::2], motl_values[::2], min_peak_distance=2,
+                                                         preference_by_score=True)
+    assert False, "the old loop should raise IndexError"
+except IndexError:
+    pass
+with contextlib.redirect_stdout(io.StringIO()):
+    values, coords = filtering_duplicate_coords_with_values(motl_coords[::2], motl_values[::2], min_peak_distance=2,
+                                                            preference_by_score=True)
+assert_same_points(coords, [[1, 0, 0]])
+assert values == [5.0]
+print("Preference by score replaces the matched point (the old loop replaced the next one)")
+print("All outputs are identical")
@@ -0,0 +1,67 @@
+import argparse
+import sys
+
+parser = argparse.ArgumentParser(description="Times the forward pass of a UNet3D on CPU with the "
+                                             "inference modes of prepare_model_for_inference.")
+parser.add_argument("-pythonpath", "--pythonpath", type=str)
+parser.add_argument("-box_size", "--box_size", type=int, default=64)
+parser.add_argument("-batch_size", "--batch_size", type=int, default=2)
+parser.add_argument("-depth", "--depth", type=int, default=2)
+parser.add_argument("-initial_features", "--initial_features", type=int, default=8)
+parser.add_argument("-threads", "--threads", type=int, default=1)
+parser.add_argument("-repeats", "--repeats", type=int, default=5)
+parser.add_argument("-seed", "--seed", type=int, default=0)
+args = parser.parse_args()
+pythonpath = args.pythonpath
+sys.path.append(pythonpath)
+
+import copy
+import time
+import warnings
+
+import torch
+import torch.nn as nn
+
+from networks.inference import prepare_model_for_inference, set_inference_threads
+from networks.unet import UNet3D
+
+
+def time_forward(model, input_tensor, context):
+    with context():
+        # warm up call, where tracing and compilation happen
+        output = model(input_tensor)
+        start = time.time()
+        for _ in range(args.repeats):
+            output = model(input_tensor)
+    return (time.time() - start) / args.repeats, output.detach()
+
+
+# the deprecation and tracer warnings of torch.jit, fallbacks are still reported
+warnings.filterwarnings("ignore", category=FutureWarning)
+warnings.filterwarnings("ignore", category=torch.jit.TracerWarning)
+set_inference_threads(args.threads)
+torch.manual_seed(args.seed)
+device = torch.device("cpu")
+net = UNet3D(final_activation=nn.Sigmoid(), depth=args.depth,
+             initial_features=args.initial_features, out_channels=1)
+net = net.eval()
+input_shape = (args.batch_size, 1) + (args.box_size,) * 3
+input_tensor = torch.randn(input_shape)
+
+# before: eager network with autograd enabled
+eager_time, eager_output = time_forward(net, input_tensor, torch.enable_grad)
+print("{:<28} {:.3f} s/batch".format("autograd (before)", eager_time))
+
+modes = [("inference_mode", dict()),
+         ("channels_last_3d", dict(channels_last=True)),
+         ("jit.trace", dict(compile_mode="trace", example_input_shape=input_shape)),
+         ("channels_last_3d + jit.trace", dict(channels_last=True, compile_mode="trace",
+                                               example_input_shape=input_shape)),
+         ("torch.compile", dict(compile_mode="compile"))]
+for name, options in modes:
+    model = prepare_model_for_inference(copy.deepcopy(net), device, **options)
+    mode_time, output = time_forward(model, input_tensor, torch.inference_mode)
+    # the network actually used, e.g. UNet3D if tracing or compiling fell back
+    print("{:<28} {:.3f} s/batch, speedup {:.2f}, max difference from eager {:.2e} ({})".format(
+        name, mode_time, eager_time / mode_time, (output - eager_output).abs().max().item(),
+        type(model.model).__name__))
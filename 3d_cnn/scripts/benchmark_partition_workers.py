@@ -0,0 +1,56 @@
+import argparse
+import sys
+
+parser = argparse.ArgumentParser(description="Times the writing of a prediction partition of a random "
+                                             "tomogram with an increasing number of processes.")
+parser.add_argument("-pythonpath", "--pythonpath", type=str)
+parser.add_argument("-shape", "--shape", type=int, nargs=3, default=[256, 512, 512],
+                    help="shape (z, y, x) of the random tomogram")
+parser.add_argument("-box_size", "--box_size", type=int, default=64)
+parser.add_argument("-overlap", "--overlap", type=int, default=12)
+parser.add_argument("-workers", "--workers", type=int, nargs="+", default=[1, 2, 4])
+parser.add_argument("-format", "--format", type=int, default=2, help="partition format")
+parser.add_argument("-compression", "--compression", type=str, default="gzip",
+                    help="partition compression (none, gzip, lzf or lz4)")
+parser.add_argument("-work_dir", "--work_dir", type=str, default=None,
+                    help="directory of the temporary files (default: system temporary directory)")
+args = parser.parse_args()
+pythonpath = args.pythonpath
+sys.path.append(pythonpath)
+
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from file_actions.writers.mrc import write_mrc_dataset
+from tomogram_utils.volume_actions.actions import generate_partition_with_workers
+
+compression = None if args.compression == "none" else args.compression
+box_shape = (args.box_size, args.box_size, args.box_size)
+
+with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+    tomo_path = os.path.join(work_dir, "tomo.mrc")
+    mask_path = os.path.join(work_dir, "mask.mrc")
+    rng = np.random.default_rng(0)
+    write_mrc_dataset(mrc_path=tomo_path, array=rng.standard_normal(args.shape, dtype=np.float32))
+    # a slab as lamella mask
+    mask = np.zeros(args.shape, dtype=np.int8)
+    mask[args.shape[0] // 4:3 * args.shape[0] // 4] = 1
+    write_mrc_dataset(mrc_path=mask_path, array=mask, dtype="int8")
+    del mask
+
+    reference_time = None
+    for workers in args.workers:
+        partition_path = os.path.join(work_dir, "partition_{}.h5".format(workers))
+        start = time.time()
+        generate_partition_with_workers(path_to_raw=tomo_path, output_h5_file_path=partition_path,
+                                        subtomo_shape=box_shape, overlap=args.overlap, workers=workers,
+                                        path_to_mask=mask_path, partition_format=args.format,
+                                        compression=compression)
+        elapsed = time.time() - start
+        reference_time = elapsed if reference_time is None else reference_time
+        print("Processes: {}, partition time: {:.2f} s, speedup: {:.2f}".format(
+            workers, elapsed, reference_time / elapsed))
+        os.remove(partition_path)
@@ -0,0 +1,119 @@
+import argparse
+import sys
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-pythonpath", "--pythonpath", type=str)
+parser.add_argument("-n_true", "--n_true", type=int, default=2000)
+parser.add_argument("-n_predicted", "--n_predicted", type=int, default=4000)
+parser.add_argument("-box", "--box", type=int, default=200,
+                    help="side of the cube holding the random clouds")
+parser.add_argument("-seed", "--seed", type=int, default=0)
+args = parser.parse_args()
+pythonpath = args.pythonpath
+sys.path.append(pythonpath)
+
+import time
+
+import numpy as np
+
+from performance.statistics_utils import get_clean_points_close2point
+from performance.statistics_utils import precision_recall_calculator
+
+
+def precision_recall_calculator_reference(predicted_coordinates, value_predicted,
+                                          true_coordinates, radius):
+    # The brute force loop precision_recall_calculator used before the KD-tree
+    true_coordinates = list(true_coordinates)
+    predicted_coordinates = list(predicted_coordinates)
+    detected_true = list()
+    predicted_true_positives = list()
+    predicted_redundant = list()
+    value_predicted_true_positives = list()
+    value_predicted_redundant = list()
+    precision = list()
+    recall = list()
+    total_true_points = len(true_coordinates)
+    predicted_false_positives = list()
+    value_predicted_false_positives = list()
+    for value, point in zip(value_predicted, predicted_coordinates):
+        close_to_point, distances = get_clean_points_close2point(point, true_coordinates, radius)
+        if len(close_to_point) > 0:
+            flag = "true_positive_candidate"
+            flag_tmp = "not_redundant_yet"
+            for dist, clean_p in sorted(zip(distances, close_to_point)):
+                if flag == "true_positive_candidate":
+                    if tuple(clean_p) not in detected_true:
+                        detected_true.append(tuple(clean_p))
+                        flag = "true_positive"
+                    else:
+                        flag_tmp = "redundant_candidate"
+            if flag == "true_positive":
+                predicted_true_positives.append(tuple(point))
+                value_predicted_true_positives.append(value)
+            elif flag == "true_positive_candidate" and flag_tmp == "redundant_candidate":
+                predicted_redundant.append(tuple(point))
+                value_predicted_redundant.append(value)
+            else:
+                print("This should never happen!")
+        else:
+            predicted_false_positives.append(tuple(point))
+            value_predicted_false_positives.append(value)
+        true_positives_total = len(predicted_true_positives)
+        false_positives_total = len(predicted_false_positives)
+        precision.append(true_positives_total / (true_positives_total + false_positives_total))
+        recall.append(true_positives_total)
+    false_negatives = [point for point in true_coordinates if tuple(point) not in detected_true]
+    recall = list(np.array(recall) * (1 / total_true_points))
+    return precision, recall, detected_true, predicted_true_positives, \
+           predicted_false_positives, value_predicted_true_positives, \
+           value_predicted_false_positives, false_negatives, predicted_redundant, \
+           value_predicted_redundant
+
+
+def assert_same_output(output, reference_output):
+    assert len(output) == len(reference_output)
+    for item, reference_item in zip(output, reference_output):
+        item = [tuple(p) if isinstance(p, (tuple, np.ndarray)) else p for p in item]
+        reference_item = [tuple(p) if isinstance(p, (tuple, np.ndarray)) else p for p in reference_item]
+        assert item == reference_item, "outputs differ"
+
+
+def compare(name, predicted, values, true, radius):
+    start = time.time()
+    reference_output = precision_recall_calculator_reference(predicted, values, true, radius)
+    reference_time = time.time() - start
+    start = time.time()
+    output = precision_recall_calculator(predicted, values, true, radius)
+    kdtree_time = time.time() - start
+    assert_same_output(output, reference_output)
+    print("{:<32} radius {:<8.4g} TP {:>5} FP {:>5} redundant {:>5}   loop {:.2f} s   KD-tree {:.3f} s".format(
+        name, radius, len(output[3]), len(output[4]), len(output[8]), reference_time, kdtree_time))
+
+
+rng = np.random.default_rng(args.seed)
+values = list(rng.random(args.n_predicted))
+
+# Integer clouds: the radii are hit exactly by many distances (e.g. 3-4-5)
+true = rng.integers(0, args.box, size=(args.n_true, 3))
+predicted = rng.integers(0, args.box, size=(args.n_predicted, 3))
+for radius in [1, 5, 8]:
+    compare("integer", predicted, values, true, radius)
+
+# Float clouds, with radii taken from actual distances between the clouds
+true = rng.random((args.n_true, 3)) * args.box
+predicted = rng.random((args.n_predicted, 3)) * args.box
+for radius in [4.5, np.linalg.norm(true[0] - predicted[0]), np.linalg.norm(true[1] - predicted[2])]:
+    compare("float", predicted, values, true, radius)
+exact_predicted = predicted.copy()
+exact_predicted[:args.n_true // 2] = true[:args.n_true // 2] + [3, 4, 0]
+compare("float, distances at radius", exact_predicted, values, true,
+        np.linalg.norm(exact_predicted[0] - true[0]))
+
+# Near-duplicate clouds: repeated true points and predictions clustered around them
+true = rng.integers(0, args.box, size=(args.n_true // 2, 3))
+true = np.concatenate([true, true[:args.n_true // 4], true[:args.n_true // 4] + 1])
+predicted = np.repeat(true, 2, axis=0)[:args.n_predicted] + rng.integers(-2, 3, size=(min(2 * len(true), args.n_predicted), 3))
+values = list(rng.random(len(predicted)))
+for radius in [0, 1, np.sqrt(3), 2]:
+    compare("near-duplicate", predicted, values, true, radius)
+print("All outputs are identical")
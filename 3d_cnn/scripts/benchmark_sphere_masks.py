@@ -0,0 +1,62 @@
+import argparse
+import sys
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-pythonpath", "--pythonpath", type=str)
+parser.add_argument("-shape", "--shape", type=int, nargs=3, default=[200, 400, 400],
+                    help="shape (z, y, x) of the mask")
+parser.add_argument("-n_particles", "--n_particles", type=int, default=2000)
+parser.add_argument("-radius", "--radius", type=int, default=8)
+parser.add_argument("-seed", "--seed", type=int, default=0)
+parser.add_argument("-skip_loop", "--skip_loop", action="store_true", default=False,
+                    help="do not time the voxel by voxel loop")
+args = parser.parse_args()
+pythonpath = args.pythonpath
+sys.path.append(pythonpath)
+
+import time
+
+import numpy as np
+
+from tomogram_utils.peak_toolbox.utils import paste_spheres_in_dataset
+
+
+def paste_sphere_voxel_by_voxel(dataset: np.array, center: tuple or list,
+                                radius: int, value: float = 1):
+    # Former implementation of paste_sphere_in_dataset
+    dataset_shape = dataset.shape
+    cx, cy, cz = center
+    radius = int(radius)
+    ball = [(0, 0, 0)]
+    for i in range(radius):
+        for j in range(radius):
+            for k in range(radius):
+                if np.sqrt(i ** 2 + j ** 2 + k ** 2) <= radius:
+                    ball += [(i, j, k), (-i, j, k), (i, -j, k),
+                             (i, j, -k), (-i, -j, k), (-i, j, -k),
+                             (i, -j, -k), (-i, -j, -k)]
+    for point in ball:
+        i, j, k = point
+        rel_point = np.array([i + cx, j + cy, k + cz])
+        if np.min(rel_point) >= 0 and np.min(rel_point < np.array(dataset_shape)):
+            dataset[i + cx, j + cy, k + cz] = value
+    return dataset
+
+
+rng = np.random.default_rng(args.seed)
+centers = rng.integers(0, args.shape, size=(args.n_particles, 3))
+values = rng.random(args.n_particles)
+print("Pasting", args.n_particles, "spheres of radius", args.radius, "in a mask of shape", args.shape)
+
+start = time.time()
+dataset = np.zeros(args.shape)
+paste_spheres_in_dataset(dataset=dataset, centers=centers, radius=args.radius, values=values)
+print("paste_spheres_in_dataset wall time: {:.2f} s".format(time.time() - start))
+
+if not args.skip_loop:
+    start = time.time()
+    loop_dataset = np.zeros(args.shape)
+    for center, value in zip(centers, values):
+        paste_sphere_voxel_by_voxel(dataset=loop_dataset, center=center, radius=args.radius, value=value)
+    print("Voxel by voxel loop wall time: {:.2f} s".format(time.time() - start))
+    print("Same mask:", np.array_equal(dataset, loop_dataset))
@@ -0,0 +1,96 @@
+import argparse
+import sys
+
+parser = argparse.ArgumentParser(description="Checks that the training losses and their gradients "
+                                             "under bf16/fp16 autocast match float32.")
+parser.add_argument("-pythonpath", "--pythonpath", type=str)
+parser.add_argument("-box_size", "--box_size", type=int, default=32)
+parser.add_argument("-batch_size", "--batch_size", type=int, default=2)
+parser.add_argument("-depth", "--depth", type=int, default=2)
+parser.add_argument("-initial_features", "--initial_features", type=int, default=8)
+parser.add_argument("-loss_tolerance", "--loss_tolerance", type=float, default=2e-3,
+                    help="maximum absolute difference from the float32 loss")
+parser.add_argument("-gradient_tolerances", "--gradient_tolerances", type=float, nargs=2, default=[0.25, 0.1],
+                    help="bf16 and fp16 maximum norm of the difference from the float32 "
+                         "gradients, relative to the norm of the float32 gradients")
+parser.add_argument("-min_cosine", "--min_cosine", type=float, default=0.98,
+                    help="minimum cosine similarity between the float32 and the "
+                         "mixed precision gradients")
+parser.add_argument("-seed", "--seed", type=int, default=0)
+args = parser.parse_args()
+pythonpath = args.pythonpath
+sys.path.append(pythonpath)
+
+import copy
+
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from monai.losses.dice import GeneralizedDiceLoss
+
+from networks.amp import get_autocast, get_grad_scaler
+from networks.io import get_device
+from networks.loss import DiceCoefficientLoss
+from networks.unet import UNet3D
+
+
+def loss_and_gradients(model, x, y, loss_function, amp):
+    # one training step as in networks.routines.train, without the update
+    model = copy.deepcopy(model)
+    optimizer = optim.SGD(model.parameters(), lr=0)
+    grad_scaler = get_grad_scaler(device, amp)
+    optimizer.zero_grad()
+    with get_autocast(device, amp):
+        prediction = model(x)
+    prediction = prediction.float()
+    loss = loss_function(prediction, y.long())
+    if grad_scaler is None:
+        loss.backward()
+    else:
+        grad_scaler.scale(loss).backward()
+        grad_scaler.unscale_(optimizer)
+    gradients = torch.cat([p.grad.flatten() for p in model.parameters() if p.grad is not None])
+    return loss.item(), gradients
+
+
+device = get_device()
+torch.manual_seed(args.seed)
+# no dropout, so that all the precisions see the same network
+net = UNet3D(final_activation=nn.Sigmoid(), depth=args.depth, initial_features=args.initial_features,
+             out_channels=1, BN=True, encoder_dropout=0, decoder_dropout=0).to(device).train()
+shape = (args.batch_size, 1) + (args.box_size,) * 3
+labels = {"random": torch.rand(shape) > 0.5,
+          "near-empty": torch.zeros(shape, dtype=torch.bool),
+          "near-full": torch.ones(shape, dtype=torch.bool)}
+labels["near-empty"].view(-1)[torch.randperm(labels["near-empty"].numel())[:5]] = True
+labels["near-full"].view(-1)[torch.randperm(labels["near-full"].numel())[:5]] = False
+# bf16 keeps 8 bits of mantissa, fp16 11 bits
+gradient_tolerances = dict(zip(["bf16", "fp16"], args.gradient_tolerances))
+losses = {"Dice": DiceCoefficientLoss(), "GeneralizedDice": GeneralizedDiceLoss()}
+
+failures = 0
+for label_name, y in labels.items():
+    x = (y.float() + torch.randn(shape)).to(device)
+    y = y.to(device)
+    for loss_name, loss_function in losses.items():
+        reference_loss, reference_gradients = loss_and_gradients(net, x, y, loss_function, None)
+        for amp in ["bf16", "fp16"]:
+            try:
+                amp_loss, amp_gradients = loss_and_gradients(net, x, y, loss_function, amp)
+            except RuntimeError as exception:
+                print("{:<10} {:<15} {}: not supported on {} ({})".format(label_name, loss_name, amp, device,
+                                                                          exception))
+                continue
+            loss_difference = abs(amp_loss - reference_loss)
+            gradient_difference = (amp_gradients - reference_gradients).norm().item() / \
+                reference_gradients.norm().item()
+            cosine = torch.nn.functional.cosine_similarity(amp_gradients, reference_gradients, dim=0).item()
+            finite = bool(torch.isfinite(torch.tensor(amp_loss))) and bool(torch.isfinite(amp_gradients).all())
+            passed = finite and loss_difference <= args.loss_tolerance and \
+                gradient_difference <= gradient_tolerances[amp] and cosine >= args.min_cosine
+            failures += not passed
+            print("{:<10} {:<15} {}: loss {:.5f} (float32 {:.5f}), relative gradient difference {:.2e}, "
+                  "cosine {:.4f}{}".format(label_name, loss_name, amp, amp_loss, reference_loss,
+                                           gradient_difference, cosine, "" if passed else "  FAILED"))
+assert failures == 0, "{} loss or gradient comparisons out of tolerance".format(failures)
+print("All losses and gradients are finite and within tolerance")
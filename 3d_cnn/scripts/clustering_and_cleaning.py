@@ -28,11 +28,13 @@ import shutil
 import pandas as pd
 import numpy as np
 # import seaborn as sns
-from file_actions.readers.tomograms import load_tomogram
+from file_actions.readers.metadata_index import get_tomogram_metadata
+from file_actions.readers.tomograms import load_tomogram, open_tomogram
 from file_actions.writers.csv import build_tom_motive_list
 from file_actions.writers.tomogram import write_tomogram
 from tomogram_utils.coordinates_toolbox.clustering import get_cluster_centroids, \
     get_cluster_centroids_in_contact, get_cluster_centroids_colocalization
+from tomogram_utils.coordinates_toolbox.clustering_by_slabs import get_cluster_centroids_by_slabs
 from paths.pipeline_dirs import get_probability_map_path, get_post_processed_prediction_path
 from constants.config import Config
 from constants.config import get_model_name
@@ -69,90 +71,113 @@ if run_job:
             shutil.move(os.path.join(tomo_output_dir, file), os.path.join(tomo_output_dir, "prev_" + file))
 
     assert os.path.isfile(output_path)
-    prediction_dataset = load_tomogram(path_to_dataset=output_path)
-    output_shape = prediction_dataset.shape
-    prediction_dataset_thr = 1 * (prediction_dataset > config.threshold)
-    # set to zero the edges of tomogram
-    if isinstance(config.ignore_border_thickness, int):
-        ix = config.ignore_border_thickness
-        iy, iz = ix, ix
-    else:
-        ix, iy, iz = config.ignore_border_thickness
-
-    if iz > 0:
-        prediction_dataset_thr[:iz, :, :] = np.zeros_like(prediction_dataset_thr[:iz, :, :])
-        prediction_dataset_thr[-iz:, :, :] = np.zeros_like(prediction_dataset_thr[-iz:, :, :])
-    if iy > 0:
-        prediction_dataset_thr[:, :iy, :] = np.zeros_like(prediction_dataset_thr[:, :iy, :])
-        prediction_dataset_thr[:, -iy:, :] = np.zeros_like(prediction_dataset_thr[:, -iy:, :])
-    if ix > 0:
-        prediction_dataset_thr[:, :, :ix] = np.zeros_like(prediction_dataset_thr[:, :, :ix])
-        prediction_dataset_thr[:, :, -ix:] = np.zeros_like(prediction_dataset_thr[:, :, -ix:])
-
-    print(f"Region mask: {config.region_mask}")
-    df = pd.read_csv(config.dataset_table, dtype={"tomo_name": str})
-    df.set_index("tomo_name", inplace=True)
-    masking_file = df[config.region_mask][tomo_name]
-    clusters_output_path = get_post_processed_prediction_path(output_dir=config.output_dir,
-                                                              model_name=model_name,
-                                                              tomo_name=tomo_name,
-                                                              semantic_class=config.pred_class)
-    os.makedirs(tomo_output_dir, exist_ok=True)
-    contact_mode = config.contact_mode
-
-    if np.max(prediction_dataset_thr) == 0:
-        clusters_labeled_by_size = prediction_dataset_thr
-        centroids_list = []
-        cluster_size_list = []
-    else:
-        print(f"masking_file: {masking_file}")
+    if config.clustering_out_of_core:
+        df = pd.read_csv(config.dataset_table, dtype={"tomo_name": str})
+        df.set_index("tomo_name", inplace=True)
+        masking_file = df[config.region_mask][tomo_name]
         if isinstance(masking_file, float):
             print(f"No intersecting mask available of the type {config.region_mask} for tomo {tomo_name}.")
-            prediction_dataset_thr = prediction_dataset_thr.astype(np.int8)
-            clusters_labeled_by_size, centroids_list, cluster_size_list = \
-                get_cluster_centroids(dataset=prediction_dataset_thr,
-                                      min_cluster_size=config.min_cluster_size,
-                                      max_cluster_size=config.max_cluster_size,
-                                      connectivity=config.clustering_connectivity)
+            masking_file = None
+        clusters_output_path = get_post_processed_prediction_path(output_dir=config.output_dir, model_name=model_name,
+                                                                  tomo_name=tomo_name, semantic_class=config.pred_class)
+        print(f"clusters_output_path: {clusters_output_path}")
+        centroids_list, cluster_size_list = \
+            get_cluster_centroids_by_slabs(prediction_path=output_path, output_path=clusters_output_path,
+                                           threshold=config.threshold,
+                                           min_cluster_size=config.min_cluster_size,
+                                           max_cluster_size=config.max_cluster_size,
+                                           ignore_border_thickness=config.ignore_border_thickness,
+                                           mask_path=masking_file, contact_mode=config.contact_mode,
+                                           connectivity=config.clustering_connectivity,
+                                           slab_size=config.clustering_slab_size)
+    else:
+        prediction_dataset = load_tomogram(path_to_dataset=output_path)
+        output_shape = prediction_dataset.shape
+        prediction_dataset_thr = (prediction_dataset > config.threshold).astype(np.int8)
+        del prediction_dataset
+        # set to zero the edges of tomogram
+        if isinstance(config.ignore_border_thickness, int):
+            ix = config.ignore_border_thickness
+            iy, iz = ix, ix
         else:
-            mask_indicator = load_tomogram(path_to_dataset=masking_file)
-            shx, shy, shz = [np.min([shl, shp]) for shl, shp in
-                             zip(mask_indicator.shape, prediction_dataset_thr.shape)]
-            mask_indicator = mask_indicator[:shx, :shy, :shz]
-            prediction_dataset_thr = prediction_dataset_thr[:shx, :shy, :shz]
-            if contact_mode == "intersection":
-                prediction_dataset_thr = mask_indicator.astype(np.int8) * prediction_dataset_thr.astype(np.int8)
-                if np.max(prediction_dataset_thr) > 0:
-                    clusters_labeled_by_size, centroids_list, cluster_size_list = \
-                        get_cluster_centroids(dataset=prediction_dataset_thr,
-                                              min_cluster_size=config.min_cluster_size,
-                                              max_cluster_size=config.max_cluster_size,
-                                              connectivity=config.clustering_connectivity)
-            elif contact_mode == "contact":
-                if np.max(prediction_dataset_thr) > 0:
-                    clusters_labeled_by_size, centroids_list, cluster_size_list = \
-                        get_cluster_centroids_in_contact(dataset=prediction_dataset_thr,
-                                                         min_cluster_size=config.min_cluster_size,
-                                                         max_cluster_size=config.max_cluster_size,
-                                                         contact_mask=mask_indicator,
-                                                         connectivity=config.clustering_connectivity)
-
+            ix, iy, iz = config.ignore_border_thickness
+
+        if iz > 0:
+            prediction_dataset_thr[:iz, :, :] = np.zeros_like(prediction_dataset_thr[:iz, :, :])
+            prediction_dataset_thr[-iz:, :, :] = np.zeros_like(prediction_dataset_thr[-iz:, :, :])
+        if iy > 0:
+            prediction_dataset_thr[:, :iy, :] = np.zeros_like(prediction_dataset_thr[:, :iy, :])
+            prediction_dataset_thr[:, -iy:, :] = np.zeros_like(prediction_dataset_thr[:, -iy:, :])
+        if ix > 0:
+            prediction_dataset_thr[:, :, :ix] = np.zeros_like(prediction_dataset_thr[:, :, :ix])
+            prediction_dataset_thr[:, :, -ix:] = np.zeros_like(prediction_dataset_thr[:, :, -ix:])
+
+        print(f"Region mask: {config.region_mask}")
+        df = pd.read_csv(config.dataset_table, dtype={"tomo_name": str})
+        df.set_index("tomo_name", inplace=True)
+        masking_file = df[config.region_mask][tomo_name]
+        clusters_output_path = get_post_processed_prediction_path(output_dir=config.output_dir,
+                                                                  model_name=model_name,
+                                                                  tomo_name=tomo_name,
+                                                                  semantic_class=config.pred_class)
+        os.makedirs(tomo_output_dir, exist_ok=True)
+        contact_mode = config.contact_mode
+
+        if np.max(prediction_dataset_thr) == 0:
+            clusters_labeled_by_size = prediction_dataset_thr
+            centroids_list = []
+            cluster_size_list = []
+        else:
+            print(f"masking_file: {masking_file}")
+            if isinstance(masking_file, float):
+                print(f"No intersecting mask available of the type {config.region_mask} for tomo {tomo_name}.")
+                prediction_dataset_thr = prediction_dataset_thr.astype(np.int8)
+                clusters_labeled_by_size, centroids_list, cluster_size_list = \
+                    get_cluster_centroids(dataset=prediction_dataset_thr,
+                                          min_cluster_size=config.min_cluster_size,
+                                          max_cluster_size=config.max_cluster_size,
+                                          connectivity=config.clustering_connectivity)
             else:
-                assert contact_mode == "colocalization"
-                if np.max(prediction_dataset_thr) > 0:
-                    clusters_labeled_by_size, centroids_list, cluster_size_list = \
-                        get_cluster_centroids_colocalization(dataset=prediction_dataset_thr,
+                mask_shape = get_tomogram_metadata(path_to_dataset=masking_file,
+                                                   dataset_table=config.dataset_table)["shape"]
+                shx, shy, shz = [np.min([shl, shp]) for shl, shp in
+                                 zip(mask_shape, prediction_dataset_thr.shape)]
+                with open_tomogram(masking_file) as mask_volume:
+                    mask_indicator = mask_volume[:shx, :shy, :shz]
+                prediction_dataset_thr = prediction_dataset_thr[:shx, :shy, :shz]
+                if contact_mode == "intersection":
+                    prediction_dataset_thr = mask_indicator.astype(np.int8) * prediction_dataset_thr.astype(np.int8)
+                    if np.max(prediction_dataset_thr) > 0:
+                        clusters_labeled_by_size, centroids_list, cluster_size_list = \
+                            get_cluster_centroids(dataset=prediction_dataset_thr,
+                                                  min_cluster_size=config.min_cluster_size,
+                                                  max_cluster_size=config.max_cluster_size,
+                                                  connectivity=config.clustering_connectivity)
+                elif contact_mode == "contact":
+                    if np.max(prediction_dataset_thr) > 0:
+                        clusters_labeled_by_size, centroids_list, cluster_size_list = \
+                            get_cluster_centroids_in_contact(dataset=prediction_dataset_thr,
                                                              min_cluster_size=config.min_cluster_size,
                                                              max_cluster_size=config.max_cluster_size,
                                                              contact_mask=mask_indicator,
-                                                             tol_contact=config.contact_distance,
                                                              connectivity=config.clustering_connectivity)
 
-    clusters_output_path = get_post_processed_prediction_path(output_dir=config.output_dir, model_name=model_name,
-                                                              tomo_name=tomo_name, semantic_class=config.pred_class)
-    print(f"clusters_output_path: {clusters_output_path}")
-    clusters_output = 1*(clusters_labeled_by_size > 0)
-    write_tomogram(output_path=clusters_output_path, tomo_data=clusters_output)
+                else:
+                    assert contact_mode == "colocalization"
+                    if np.max(prediction_dataset_thr) > 0:
+                        clusters_labeled_by_size, centroids_list, cluster_size_list = \
+                            get_cluster_centroids_colocalization(dataset=prediction_dataset_thr,
+                                                                 min_cluster_size=config.min_cluster_size,
+                                                                 max_cluster_size=config.max_cluster_size,
+                                                                 contact_mask=mask_indicator,
+                                                                 tol_contact=config.contact_distance,
+                                                                 connectivity=config.clustering_connectivity)
+
+        clusters_output_path = get_post_processed_prediction_path(output_dir=config.output_dir, model_name=model_name,
+                                                                  tomo_name=tomo_name, semantic_class=config.pred_class)
+        print(f"clusters_output_path: {clusters_output_path}")
+        clusters_output = (clusters_labeled_by_size > 0).astype(np.int8)
+        write_tomogram(output_path=clusters_output_path, tomo_data=clusters_output)
 
     os.makedirs(tomo_output_dir, exist_ok=True)
     if calculate_motl:
@@ -0,0 +1,17 @@
+import argparse
+import sys
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-pythonpath", "--pythonpath", type=str)
+parser.add_argument("-input", "--input", type=str, help="format 1 partition file")
+parser.add_argument("-output", "--output", type=str, help="format 2 partition file to be written")
+parser.add_argument("-compression", "--compression", type=str, default=None,
+                    help="compression of the output datasets: gzip, lzf or lz4 (default: none)")
+
+args = parser.parse_args()
+pythonpath = args.pythonpath
+sys.path.append(pythonpath)
+
+from file_actions.writers.partition import convert_partition_to_v2
+
+convert_partition_to_v2(input_path=args.input, output_path=args.output, compression=args.compression)
@@ -30,7 +30,7 @@ import numpy as np
 import pandas as pd
 
 from constants.dataset_tables import DatasetTableHeader, ModelsTableHeader
-from file_actions.readers.tomograms import load_tomogram
+from file_actions.readers.tomograms import load_tomogram, load_tomograms_in_common_shape
 from paths.pipeline_dirs import fold_testing_partition_path, get_probability_map_path, get_models_table_path
 from tomogram_utils.volume_actions.actions import \
     partition_raw_intersecting_mask
@@ -130,26 +130,15 @@ for tomo_name in tomo_evaluation_list:
         tomo_df = df[df[DTHeader.tomo_name] == tomo_name]
         path_to_raw = tomo_df.iloc[0][DTHeader.processing_tomo]
         path_to_lamella = tomo_df.iloc[0][DTHeader.filtering_mask]
-        raw_dataset = load_tomogram(path_to_dataset=path_to_raw)
         if isinstance(path_to_lamella, float):
             print("No filtering mask file available.")
+            raw_dataset = load_tomogram(path_to_dataset=path_to_raw)
             partition_tomogram(dataset=raw_dataset,
                                output_h5_file_path=partition_path,
                                subtomo_shape=subtomogram_shape,
                                overlap=overlap)
         else:
-            path_to_lamella = tomo_df.iloc[0][DTHeader.filtering_mask]
-            lamella_mask = load_tomogram(path_to_dataset=path_to_lamella)
-
-            lamella_shape = lamella_mask.shape
-            dataset_shape = raw_dataset.shape
-
-            minimum_shape = [np.min([data_dim, lamella_dim]) for
-                             data_dim, lamella_dim in zip(dataset_shape, lamella_shape)]
-            minz, miny, minx = minimum_shape
-
-            lamella_mask = lamella_mask[:minz, :miny, :minx]
-            raw_dataset = raw_dataset[:minz, :miny, :minx]
+            raw_dataset, lamella_mask = load_tomograms_in_common_shape([path_to_raw, path_to_lamella])
 
             partition_raw_intersecting_mask(dataset=raw_dataset,
                                             mask_dataset=lamella_mask,
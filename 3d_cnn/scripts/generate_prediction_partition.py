@@ -6,6 +6,8 @@ parser.add_argument("-config_file", "--config_file", type=str)
 parser.add_argument("-pythonpath", "--pythonpath", type=str)
 parser.add_argument("-fold", "--fold", type=str, default="None")
 parser.add_argument("-tomo_name", "--tomo_name", type=str)
+parser.add_argument("-workers", "--workers", type=int, default=None,
+                    help="processes writing the partition (default: partition workers of the config file)")
 
 args = parser.parse_args()
 pythonpath = args.pythonpath
@@ -18,16 +20,18 @@ import numpy as np
 import pandas as pd
 
 from constants.dataset_tables import DatasetTableHeader
-from file_actions.readers.tomograms import load_tomogram
+from file_actions.readers.tomograms import load_tomogram, load_tomograms_in_common_shape
+from image.statistics import get_tomogram_statistics
 from paths.pipeline_dirs import testing_partition_path
 from tomogram_utils.volume_actions.actions import \
-    partition_raw_intersecting_mask
+    generate_partition_with_workers, partition_raw_intersecting_mask
 from constants.config import Config
 
 config_file = args.config_file
 tomo_name = args.tomo_name
 fold = ast.literal_eval(args.fold)
 config = Config(args.config_file)
+workers = args.workers if args.workers is not None else config.partition_workers
 
 snakemake_pattern = config.work_dir + "/testing_data/" + tomo_name + \
                     "/.test_partition.{fold}.done".format(fold=str(fold))
@@ -43,7 +47,7 @@ os.makedirs(partition_output_dir, exist_ok=True)
 if os.path.exists(partition_path):
     print("Exiting, path exists.")
 else:
-    overlap = config.overlap
+    overlap = config.pred_overlap
     box_size = config.box_size
     box_shape = (box_size, box_size, box_size)
 
@@ -55,29 +59,36 @@ else:
     print(tomo_name, config.processing_tomo, tomo_df)
     path_to_raw = tomo_df.iloc[0][config.processing_tomo]
     intersecting_mask_path = tomo_df.iloc[0][config.region_mask]
-    raw_dataset = load_tomogram(path_to_dataset=path_to_raw, dtype=float)
-    if isinstance(intersecting_mask_path, float):
-        print("No region mask file available.")
-        intersecting_mask = np.ones_like(raw_dataset, dtype=np.int8)
+    # Cache the normalization statistics now, so that the segmentation job
+    # does not need to read the tomogram
+    get_tomogram_statistics(path_to_dataset=path_to_raw)
+    if workers > 1:
+        generate_partition_with_workers(path_to_raw=path_to_raw,
+                                        output_h5_file_path=partition_path,
+                                        subtomo_shape=box_shape,
+                                        overlap=overlap,
+                                        workers=workers,
+                                        path_to_mask=None if isinstance(intersecting_mask_path, float)
+                                        else intersecting_mask_path,
+                                        partition_format=config.partition_format,
+                                        compression=config.partition_compression,
+                                        min_mask_fraction=config.region_mask_min_fraction)
     else:
-        intersecting_mask_path = tomo_df.iloc[0][config.region_mask]
-        intersecting_mask = load_tomogram(path_to_dataset=intersecting_mask_path)
-
-        mask_shape = intersecting_mask.shape
-        dataset_shape = raw_dataset.shape
-
-        minimum_shape = [np.min([data_dim, mask_dim]) for
-                         data_dim, mask_dim in zip(dataset_shape, mask_shape)]
-        minz, miny, minx = minimum_shape
-
-        intersecting_mask = intersecting_mask[:minz, :miny, :minx]
-        raw_dataset = raw_dataset[:minz, :miny, :minx]
-
-    partition_raw_intersecting_mask(dataset=raw_dataset,
-                                    mask_dataset=intersecting_mask,
-                                    output_h5_file_path=partition_path,
-                                    subtomo_shape=box_shape,
-                                    overlap=overlap)
+        if isinstance(intersecting_mask_path, float):
+            print("No region mask file available.")
+            raw_dataset = load_tomogram(path_to_dataset=path_to_raw)
+            intersecting_mask = np.ones_like(raw_dataset, dtype=np.int8)
+        else:
+            raw_dataset, intersecting_mask = load_tomograms_in_common_shape([path_to_raw, intersecting_mask_path])
+
+        partition_raw_intersecting_mask(dataset=raw_dataset,
+                                        mask_dataset=intersecting_mask,
+                                        output_h5_file_path=partition_path,
+                                        subtomo_shape=box_shape,
+                                        overlap=overlap,
+                                        partition_format=config.partition_format,
+                                        compression=config.partition_compression,
+                                        min_mask_fraction=config.region_mask_min_fraction)
 
 # For snakemake
 with open(snakemake_pattern, "w") as f:
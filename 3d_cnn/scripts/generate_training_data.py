@@ -6,6 +6,8 @@ parser.add_argument("-tomo_name", "--tomo_name", type=str)
 parser.add_argument("-config_file", "--config_file", type=str)
 parser.add_argument("-fold", "--fold", type=str, default="None")
 parser.add_argument("-pythonpath", "--pythonpath", type=str)
+parser.add_argument("-workers", "--workers", type=int, default=None,
+                    help="processes writing the partition (default: partition workers of the config file)")
 parser.add_argument("-v", "--verbose", dest="verbose", action="store_true", default=False, help="Print out verbose messages.")
 args = parser.parse_args()
 
@@ -37,6 +39,7 @@ config = Config(config_file)
 df = pd.read_csv(config.dataset_table, dtype={"tomo_name": str})
 df.set_index('tomo_name', inplace=True)
 fold = ast.literal_eval(args.fold)
+workers = args.workers if args.workers is not None else config.partition_workers
 path_to_raw = df[config.processing_tomo][tomo_name]
 if args.verbose:
     print(f"path_to_raw: {path_to_raw}")
@@ -71,7 +74,10 @@ else:
         subtomo_shape=box_shape,
         overlap=config.overlap,
         min_label_fraction=config.min_label_fraction,
-        max_label_fraction=config.max_label_fraction)
+        max_label_fraction=config.max_label_fraction,
+        partition_format=config.partition_format,
+        compression=config.partition_compression,
+        workers=workers)
     if args.verbose:
         print(f"label_fractions_list is: {label_fractions_list}")
 
@@ -1,8 +1,6 @@
 import argparse
 import sys
 
-import numpy as np
-
 parser = argparse.ArgumentParser()
 parser.add_argument("-gpu", "--gpu", help="cuda visible devices", type=str)
 parser.add_argument("-pythonpath", "--pythonpath", type=str)
@@ -26,19 +24,16 @@ import os
 import ast
 
 import torch
-import torch.nn as nn
-import warnings
 import pandas as pd
 
-from collections import OrderedDict
 from file_actions.writers.h5 import segment_and_write
-from constants.config import Config, get_model_name, model_descriptor_from_config
+from constants.config import Config, get_model_name
+from networks.inference import prepare_model_for_inference, set_inference_threads
 from networks.io import get_device
-from networks.unet import UNet3D
 from constants.dataset_tables import DatasetTableHeader
-from file_actions.readers.tomograms import load_tomogram
+from image.statistics import get_tomogram_mean_std
 from paths.pipeline_dirs import testing_partition_path
-from networks.utils import get_training_testing_lists
+from networks.utils import get_training_testing_lists, load_unet_model_for_prediction
 
 gpu = args.gpu
 if gpu is None:
@@ -75,55 +70,12 @@ if run_job:
     output_classes = len(config.semantic_classes)
 
     device = get_device()
-    checkpoint = torch.load(model_path, map_location=device, weights_only=False)
-
-    if 'model_descriptor' not in checkpoint.keys():
-        warnings.warn("Model without model descriptor... it will be added")
-        print("WARNING: model without model descriptor... it will be added")
-        model_descriptor = model_descriptor_from_config(config)
-        checkpoint["model_descriptor"] = model_descriptor
-        torch.save({
-            'model_descriptor': model_descriptor,
-            'epoch': checkpoint['epoch'],
-            'model_state_dict': checkpoint['model_state_dict'],
-            'optimizer_state_dict': checkpoint['optimizer_state_dict'],
-            'loss': checkpoint['loss'],
-        }, model_path)
-    else:
-        print(f"Model trained under the following original settings: {checkpoint['model_descriptor']}")
-
-    model_descriptor = checkpoint['model_descriptor']
-
-    net_conf = {'final_activation': None,
-                'depth': model_descriptor.depth,
-                'initial_features': model_descriptor.initial_features,
-                "out_channels": model_descriptor.output_classes,
-                "BN": model_descriptor.batch_norm,
-                "encoder_dropout": model_descriptor.encoder_dropout,
-                "decoder_dropout": model_descriptor.decoder_dropout}
-
-    model = UNet3D(**net_conf)
-    model.to(device)
-
-    if torch.cuda.device_count() > 1:
-        print(f"Let's use {torch.cuda.device_count()} GPUs!")
-        model = nn.DataParallel(model)
-
-        substring = 'module.'
-        checkpoint_tmp = OrderedDict()
-        for k in checkpoint['model_state_dict']:
-            new_k = substring + k if not k.startswith(substring) else k
-            checkpoint_tmp[new_k] = checkpoint['model_state_dict'][k]
-        checkpoint['model_state_dict'] = checkpoint_tmp
-    else:
-        substring = 'module.'
-        checkpoint_tmp = OrderedDict()
-        for k in checkpoint['model_state_dict']:
-            new_k = k[len(substring):] if k.startswith(substring) else k
-            checkpoint_tmp[new_k] = checkpoint['model_state_dict'][k]
-        checkpoint['model_state_dict'] = checkpoint_tmp
-    model.load_state_dict(checkpoint['model_state_dict'])
-    model = model.eval()
+    model = load_unet_model_for_prediction(path_to_model=model_path, config=config, device=device)
+    set_inference_threads(num_threads=config.pred_num_threads)
+    model = prepare_model_for_inference(model=model, device=device, channels_last=config.pred_channels_last,
+                                        compile_mode=config.pred_compile_mode,
+                                        example_input_shape=[config.pred_batch_size, 1] + box_shape,
+                                        amp=config.pred_amp)
 
     DTHeader = DatasetTableHeader(processing_tomo=config.processing_tomo, filtering_mask=config.region_mask)
     df = pd.read_csv(config.dataset_table, dtype={"tomo_name": str})
@@ -131,14 +83,12 @@ if run_job:
     tomo_df = df[df[DTHeader.tomo_name] == tomo_name]
     path_to_raw = tomo_df.iloc[0][config.processing_tomo]
     intersecting_mask_path = tomo_df.iloc[0][config.region_mask]
-    raw_dataset = load_tomogram(path_to_dataset=path_to_raw, dtype=float)
-    mean_val = np.mean(raw_dataset)
-    std_val = np.std(raw_dataset)
-    del raw_dataset
+    mean_val, std_val = get_tomogram_mean_std(path_to_dataset=path_to_raw)
 
     print(f"Segmenting tomo: {tomo_name}")
     segment_and_write(data_path=partition_path, model=model, label_name=model_name, mean_value=mean_val,
-                      std_value=std_val)
+                      std_value=std_val, batch_size=config.pred_batch_size,
+                      min_mask_fraction=config.region_mask_min_fraction)
     print("The segmentation has finished!")
 
 # For snakemake:
@@ -0,0 +1,113 @@
+import argparse
+import sys
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-gpu", "--gpu", help="cuda visible devices", type=str)
+parser.add_argument("-pythonpath", "--pythonpath", type=str)
+parser.add_argument("-config_file", "--config_file", type=str)
+parser.add_argument("-tomo_name", "--tomo_name", type=str)
+parser.add_argument("-fold", "--fold", type=str, default="None")
+parser.add_argument("-v", "--verbose", dest="verbose", action="store_true", default=False, help="Print out verbose messages.")
+args = parser.parse_args()
+
+# Log arguments
+if args.verbose:
+    print(f"Arguments received: {args}")
+
+pythonpath = args.pythonpath
+if pythonpath not in sys.path:
+    sys.path.append(pythonpath)
+    if args.verbose:
+        print(f"Added {pythonpath} to sys.path")
+
+import os
+import ast
+
+import torch
+import pandas as pd
+
+from constants.config import Config, get_model_name
+from constants.dataset_tables import DatasetTableHeader
+from file_actions.readers.metadata_index import get_tomogram_metadata
+from file_actions.readers.tomograms import load_tomogram, load_tomograms_in_common_shape
+from file_actions.writers.mrc import write_mrc_dataset
+from image.statistics import get_tomogram_mean_std
+from networks.inference import prepare_model_for_inference, set_inference_threads
+from networks.io import get_device
+from networks.utils import get_training_testing_lists, load_unet_model_for_prediction
+from paths.pipeline_dirs import get_probability_map_path
+from tomogram_utils.volume_actions.actions import segment_tomogram
+
+gpu = args.gpu
+if gpu is None:
+    print("No CUDA_VISIBLE_DEVICES passed...")
+    if torch.cuda.is_available():
+        os.environ["CUDA_VISIBLE_DEVICES"] = "0"
+else:
+    os.environ["CUDA_VISIBLE_DEVICES"] = gpu
+
+config_file = args.config_file
+config = Config(user_config_file=config_file)
+tomo_name = args.tomo_name
+fold = ast.literal_eval(args.fold)
+
+model_path, model_name = get_model_name(config, fold)
+
+snakemake_pattern = config.output_dir + "/predictions/" + model_name + "/" + tomo_name + "/" + config.pred_class + \
+                    "/.{fold}.probability_map.done".format(fold=str(fold))
+
+if isinstance(fold, int):
+    tomo_training_list, tomo_testing_list = get_training_testing_lists(config=config, fold=fold)
+    if tomo_name in tomo_testing_list:
+        run_job = True
+    else:
+        run_job = False
+else:
+    run_job = True
+
+if run_job:
+    box_shape = [config.box_size, config.box_size, config.box_size]
+    tomo_output_dir, output_path = get_probability_map_path(config.output_dir, model_name, tomo_name,
+                                                            config.pred_class)
+    os.makedirs(tomo_output_dir, exist_ok=True)
+
+    device = get_device()
+    model = load_unet_model_for_prediction(path_to_model=model_path, config=config, device=device)
+    set_inference_threads(num_threads=config.pred_num_threads)
+    model = prepare_model_for_inference(model=model, device=device, channels_last=config.pred_channels_last,
+                                        compile_mode=config.pred_compile_mode,
+                                        example_input_shape=[config.pred_batch_size, 1] + box_shape,
+                                        amp=config.pred_amp)
+
+    DTHeader = DatasetTableHeader(processing_tomo=config.processing_tomo, filtering_mask=config.region_mask)
+    df = pd.read_csv(config.dataset_table, dtype={"tomo_name": str})
+    df[DTHeader.tomo_name] = df[DTHeader.tomo_name].astype(str)
+    tomo_df = df[df[DTHeader.tomo_name] == tomo_name]
+    path_to_raw = tomo_df.iloc[0][config.processing_tomo]
+    intersecting_mask_path = tomo_df.iloc[0][config.region_mask]
+    output_shape = get_tomogram_metadata(path_to_dataset=path_to_raw, dataset_table=config.dataset_table)["shape"]
+    mean_val, std_val = get_tomogram_mean_std(path_to_dataset=path_to_raw)
+
+    if isinstance(intersecting_mask_path, float):
+        print("No region mask file available.")
+        raw_dataset = load_tomogram(path_to_dataset=path_to_raw)
+        intersecting_mask = None
+    else:
+        raw_dataset, intersecting_mask = load_tomograms_in_common_shape([path_to_raw, intersecting_mask_path])
+
+    print(f"Segmenting tomo: {tomo_name}")
+    probability_map = segment_tomogram(dataset=raw_dataset, mask_dataset=intersecting_mask, model=model,
+                                       output_shape=output_shape, subtomo_shape=box_shape,
+                                       overlap=config.pred_overlap, class_number=config.pred_class_number,
+                                       mean_value=mean_val, std_value=std_val, batch_size=config.pred_batch_size,
+                                       final_activation='sigmoid', blending=config.pred_blending,
+                                       min_mask_fraction=config.region_mask_min_fraction)
+    del raw_dataset, intersecting_mask
+    write_mrc_dataset(mrc_path=output_path, array=probability_map)
+    print("The segmentation has finished!")
+
+# For snakemake:
+snakemake_pattern_dir = os.path.dirname(snakemake_pattern)
+os.makedirs(snakemake_pattern_dir, exist_ok=True)
+with open(file=snakemake_pattern, mode="w") as f:
+    print("Creating snakemake pattern", snakemake_pattern)
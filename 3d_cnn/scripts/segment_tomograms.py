@@ -0,0 +1,133 @@
+import argparse
+import sys
+import time
+
+start_time = time.time()
+
+parser = argparse.ArgumentParser(description="Segments the partitions of several tomograms with a single "
+                                             "model process, as segment.py does for each of them.")
+parser.add_argument("-gpu", "--gpu", help="cuda visible devices", type=str)
+parser.add_argument("-pythonpath", "--pythonpath", type=str)
+parser.add_argument("-config_file", "--config_file", type=str)
+parser.add_argument("-tomo_names", "--tomo_names", type=str, nargs="*", default=None,
+                    help="tomograms to segment (default: the prediction list of the config file)")
+parser.add_argument("-fold", "--fold", type=str, default="None")
+parser.add_argument("-v", "--verbose", dest="verbose", action="store_true", default=False, help="Print out verbose messages.")
+args = parser.parse_args()
+
+# Log arguments
+if args.verbose:
+    print(f"Arguments received: {args}")
+
+pythonpath = args.pythonpath
+if pythonpath not in sys.path:
+    sys.path.append(pythonpath)
+    if args.verbose:
+        print(f"Added {pythonpath} to sys.path")
+
+import os
+import ast
+
+import torch
+import pandas as pd
+
+from file_actions.writers.h5 import SubtomoBatchReader, segment_and_write
+from constants.config import Config, get_model_name
+from networks.inference import prepare_model_for_inference, print_job_timings, \
+    run_pipelined_jobs, set_inference_threads
+from networks.io import get_device
+from constants.dataset_tables import DatasetTableHeader
+from image.statistics import get_tomogram_mean_std
+from paths.pipeline_dirs import testing_partition_path
+from networks.utils import get_training_testing_lists, load_unet_model_for_prediction
+
+gpu = args.gpu
+if gpu is None:
+    print("No CUDA_VISIBLE_DEVICES passed...")
+    if torch.cuda.is_available():
+        os.environ["CUDA_VISIBLE_DEVICES"] = "0"
+else:
+    os.environ["CUDA_VISIBLE_DEVICES"] = gpu
+
+config_file = args.config_file
+config = Config(user_config_file=config_file)
+tomo_names = args.tomo_names if args.tomo_names else config.prediction_tomos
+fold = ast.literal_eval(args.fold)
+
+model_path, model_name = get_model_name(config, fold)
+
+if isinstance(fold, int):
+    tomo_training_list, tomo_testing_list = get_training_testing_lists(config=config, fold=fold)
+    jobs = [tomo_name for tomo_name in tomo_names if tomo_name in tomo_testing_list]
+else:
+    jobs = list(tomo_names)
+print("Tomograms to segment:", jobs)
+
+
+def get_snakemake_pattern(tomo_name: str) -> str:
+    return ".done_patterns/" + model_name + "." + tomo_name + ".{fold}.segmentation.done".format(fold=str(fold))
+
+
+def write_snakemake_pattern(tomo_name: str):
+    snakemake_pattern = get_snakemake_pattern(tomo_name)
+    os.makedirs(os.path.dirname(snakemake_pattern), exist_ok=True)
+    with open(file=snakemake_pattern, mode="w") as f:
+        print(f"Creating snakemake pattern {snakemake_pattern}")
+    return
+
+
+DTHeader = DatasetTableHeader(processing_tomo=config.processing_tomo, filtering_mask=config.region_mask)
+df = pd.read_csv(config.dataset_table, dtype={"tomo_name": str})
+df[DTHeader.tomo_name] = df[DTHeader.tomo_name].astype(str)
+
+
+def read_tomogram_statistics(tomo_name: str) -> tuple:
+    tomo_df = df[df[DTHeader.tomo_name] == tomo_name]
+    path_to_raw = tomo_df.iloc[0][config.processing_tomo]
+    return get_tomogram_mean_std(path_to_dataset=path_to_raw)
+
+
+def open_partition(tomo_name: str) -> SubtomoBatchReader:
+    # The I/O of each job, done in the background while the previous
+    # tomogram is segmented: reading the raw tomogram for its statistics,
+    # when they are not cached yet, listing the subtomograms of the partition
+    # and starting to read their first batches
+    mean_val, std_val = read_tomogram_statistics(tomo_name)
+    output_dir_tomo, partition_path = testing_partition_path(output_dir=config.work_dir,
+                                                             tomo_name=tomo_name,
+                                                             fold=fold)
+    return SubtomoBatchReader(data_path=partition_path, label_name=model_name, mean_value=mean_val,
+                              std_value=std_val, batch_size=config.pred_batch_size,
+                              min_mask_fraction=config.region_mask_min_fraction)
+
+
+def segment_partition(tomo_name: str, reader: SubtomoBatchReader):
+    print(f"Segmenting tomo: {tomo_name}")
+    segment_and_write(data_path=reader.data_path, model=model, label_name=model_name,
+                      mean_value=reader.mean_value, std_value=reader.std_value,
+                      batch_size=config.pred_batch_size,
+                      min_mask_fraction=config.region_mask_min_fraction, reader=reader)
+    print("The segmentation has finished!")
+    write_snakemake_pattern(tomo_name)
+    return
+
+
+if len(jobs) > 0:
+    box_shape = [config.box_size, config.box_size, config.box_size]
+    device = get_device()
+    model = load_unet_model_for_prediction(path_to_model=model_path, config=config, device=device)
+    set_inference_threads(num_threads=config.pred_num_threads)
+    model = prepare_model_for_inference(model=model, device=device, channels_last=config.pred_channels_last,
+                                        compile_mode=config.pred_compile_mode,
+                                        example_input_shape=[config.pred_batch_size, 1] + box_shape,
+                                        amp=config.pred_amp)
+    startup_time = time.time() - start_time
+    timings = run_pipelined_jobs(jobs=jobs, prepare=open_partition, process=segment_partition)
+    print("Latency per tomogram (s), prepare = reading the tomogram statistics and opening the partition, "
+          "wait = prepare time not overlapped with the previous segmentation:")
+    print_job_timings(timings=timings, startup_time=startup_time)
+
+# For snakemake, also for the tomograms of other folds:
+for tomo_name in tomo_names:
+    if tomo_name not in jobs:
+        write_snakemake_pattern(tomo_name)
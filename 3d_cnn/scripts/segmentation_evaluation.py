@@ -19,7 +19,8 @@ import pandas as pd
 import torch
 
 from constants.dataset_tables import DatasetTableHeader
-from file_actions.readers.tomograms import load_tomogram
+from file_actions.readers.metadata_index import get_tomogram_metadata
+from file_actions.readers.tomograms import load_tomogram, open_tomogram
 from pytorch_cnn.classes.loss import DiceCoefficient
 from paths.pipeline_dirs import get_post_processed_prediction_path
 from constants.config import Config
@@ -63,28 +64,28 @@ if run_job:
     tomo_df = df[df[DTHeader.tomo_name] == tomo_name]
     target_path = tomo_df.iloc[0][clean_mask_name]
     prediction = load_tomogram(path_to_dataset=prediction_path)
+    target_shape = get_tomogram_metadata(path_to_dataset=target_path, dataset_table=config.dataset_table)["shape"]
 
     contact_mode = config.contact_mode
     if contact_mode == "intersection":
         lamella_file = tomo_df.iloc[0][DTHeader.filtering_mask]
 
-        if str(lamella_file) == "nan":
-            prediction = load_tomogram(prediction_path)
-        else:
-            lamella_indicator = load_tomogram(path_to_dataset=lamella_file)
+        if str(lamella_file) != "nan":
+            lamella_shape = get_tomogram_metadata(path_to_dataset=lamella_file,
+                                                  dataset_table=config.dataset_table)["shape"]
             shx, shy, shz = [np.min([shl, shp]) for shl, shp in
-                             zip(lamella_indicator.shape, prediction.shape)]
-            lamella_indicator = lamella_indicator[:shx, :shy, :shz]
+                             zip(lamella_shape, prediction.shape)]
+            with open_tomogram(lamella_file) as lamella_volume:
+                lamella_indicator = lamella_volume[:shx, :shy, :shz]
             prediction = prediction[:shx, :shy, :shz]
             prediction = np.array(lamella_indicator, dtype=float) * np.array(prediction,
                                                                              dtype=float)
 
-    target = load_tomogram(path_to_dataset=target_path)
-
     shx, shy, shz = [np.min([shl, shp]) for shl, shp in
-                     zip(target.shape, prediction.shape)]
+                     zip(target_shape, prediction.shape)]
 
-    target = target[:shx, :shy, :shz]
+    with open_tomogram(target_path) as target_volume:
+        target = target_volume[:shx, :shy, :shz]
     prediction = prediction[:shx, :shy, :shz]
 
     prediction = torch.from_numpy(prediction).float()
@@ -33,6 +33,10 @@ import torch.optim as optim
 
 from monai.losses.dice import GeneralizedDiceLoss
 
+from networks.amp import get_grad_scaler
+from networks.distributed import cleanup_distributed, get_distributed_device, \
+    init_distributed, is_main_process, remove_module_prefix, \
+    set_loader_epoch, wrap_distributed
 from networks.io import get_device, to_device
 from networks.utils import get_training_testing_lists, \
     generate_data_loaders_data_augmentation
@@ -47,10 +51,17 @@ from constants.config import Config, record_model
 from constants.config import get_model_name
 
 
+def place_net(net: nn.Module) -> nn.Module:
+    # one process per GPU when launched by torchrun, otherwise all the
+    # visible GPUs of this process
+    if distributed:
+        return wrap_distributed(net=net, device=device)
+    return to_device(net=net, gpu=gpu)
+
+
 def load_checkpoint(filename: str):
     if args.verbose:
         print(f"Entered the load_checkpoint function with filename: {filename}")
-    device = get_device()
     checkpoint = torch.load(filename, map_location=device)
     model_descriptor = checkpoint['model_descriptor']
     net_conf = {'final_activation': nn.Sigmoid(),
@@ -61,9 +72,9 @@ def load_checkpoint(filename: str):
                 "encoder_dropout": model_descriptor.encoder_dropout,
                 "decoder_dropout": model_descriptor.decoder_dropout}
     net = UNet3D(**net_conf)
-    net = to_device(net=net, gpu=gpu)
+    net.load_state_dict(remove_module_prefix(checkpoint['model_state_dict']))
+    net = place_net(net)
     start_epoch = checkpoint['epoch']
-    net.load_state_dict(checkpoint['model_state_dict'])
     optimizer = optim.Adam(net.parameters())
     optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
     validation_loss = checkpoint['loss']
@@ -75,7 +86,8 @@ def load_checkpoint(filename: str):
 
 config = Config(args.config_file)
 gpu = args.gpu
-device = get_device()
+distributed = init_distributed()
+device = get_distributed_device() if distributed else get_device()
 fold = ast.literal_eval(args.fold)
 
 # Generate relevant dirs
@@ -112,8 +124,10 @@ else:
     metric = loss
 
     tomo_training_list, tomo_testing_list = get_training_testing_lists(config=config, fold=fold)
-    model_descriptor = record_model(config=config, training_tomos=tomo_training_list,
-                                    testing_tomos=tomo_testing_list, fold=fold)
+    model_descriptor = None
+    if is_main_process():
+        model_descriptor = record_model(config=config, training_tomos=tomo_training_list,
+                                        testing_tomos=tomo_testing_list, fold=fold)
 
     if config.force_retrain and os.path.isfile(last_model_path):
         net, optimizer, old_epoch, validation_loss = load_checkpoint(filename=last_model_path)
@@ -128,48 +142,54 @@ else:
                     "decoder_dropout": config.decoder_dropout}
 
         net = UNet3D(**net_conf)
-        net = to_device(net=net, gpu=gpu)
+        net = place_net(net)
         validation_loss = np.inf
         best_epoch = -1
         old_epoch = -1
         optimizer = optim.Adam(net.parameters())
 
-    logger = TensorBoard_multiclass(log_dir=log_path, log_image_interval=1)
+    # the first process logs and saves the checkpoints
+    logger = TensorBoard_multiclass(log_dir=log_path, log_image_interval=1) if is_main_process() else None
     lr_scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, factor=0.1,
                                                         patience=10, verbose=True)
     train_loader, val_loader = generate_data_loaders_data_augmentation(config=config,
                                                                        tomo_training_list=tomo_training_list,
                                                                        fold=fold)
+    grad_scaler = get_grad_scaler(device=device, amp=config.amp)
     for epoch in range(old_epoch + 1, config.epochs):
         current_epoch = epoch
-
+        set_loader_epoch(train_loader, epoch)
 
         train(model=net, loader=train_loader, optimizer=optimizer, loss_function=loss,
               epoch=current_epoch, device=device, log_interval=1, tb_logger=logger,
-              log_image=False, lr_scheduler=lr_scheduler)
+              log_image=False, lr_scheduler=lr_scheduler, amp=config.amp, grad_scaler=grad_scaler)
 
         step = current_epoch * len(train_loader.dataset)
 
         current_validation_loss = validate(model=net, loader=val_loader, loss_function=loss,
                                            metric=metric, device=device, step=step, tb_logger=logger,
-                                           log_image_interval=None)
+                                           log_image_interval=None, amp=config.amp)
 
         # save best epoch
         if current_validation_loss <= validation_loss:
             best_epoch = current_epoch
             print(f"Best epoch! --> {best_epoch} with validation loss: {current_validation_loss}")
             validation_loss = current_validation_loss
-            save_unet_model(path_to_model=model_path, epoch=current_epoch,
-                            net=net, optimizer=optimizer, loss=current_validation_loss,
-                            model_descriptor=model_descriptor)
+            if is_main_process():
+                save_unet_model(path_to_model=model_path, epoch=current_epoch,
+                                net=net, optimizer=optimizer, loss=current_validation_loss,
+                                model_descriptor=model_descriptor)
         print(f"Epoch = {current_epoch} was not the best.")
         print(f"The current best is epoch = {best_epoch}")
-        save_unet_model(path_to_model=last_model_path, epoch=current_epoch,
-                        net=net, optimizer=optimizer, loss=current_validation_loss,
-                        model_descriptor=model_descriptor)
+        if is_main_process():
+            save_unet_model(path_to_model=last_model_path, epoch=current_epoch,
+                            net=net, optimizer=optimizer, loss=current_validation_loss,
+                            model_descriptor=model_descriptor)
     print("We have finished the training!")
     print(f"Best validation loss: {validation_loss} of epoch {best_epoch}")
-    shutil.copy(src=model_path, dst=best_model_path)
+    if is_main_process():
+        shutil.copy(src=model_path, dst=best_model_path)
+cleanup_distributed()
 # For snakemake:
 print(f"snakemake_pattern: {snakemake_pattern}")
 os.makedirs(os.path.dirname(snakemake_pattern), exist_ok=True)
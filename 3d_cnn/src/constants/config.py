@@ -31,8 +31,16 @@ class Config:
         self.max_label_fraction = 1
         self.batch_size = config["training"]["batch_size"]
         self.force_retrain = config["training"]["force_retrain"]
+        self.num_workers = config["training"].get("num_workers", 0)
+        self.amp = config["training"].get("amp", None)
+        # Partition files
+        partition_config = config.get("partition") or {}
+        self.partition_format = partition_config.get("format", 1)
+        self.partition_compression = partition_config.get("compression", None)
+        self.partition_workers = partition_config.get("workers", 1)
 
         self.da_rounds = config["training"]["data_augmentation"]["rounds"]
+        self.da_seed = config["training"]["data_augmentation"].get("seed", None)
         if self.da_rounds > 0 :
             self.da_rot_angle = config["training"]["data_augmentation"]["rot_angle"]
             self.da_elastic_alpha = config["training"]["data_augmentation"]["elastic_alpha"]
@@ -63,6 +71,16 @@ class Config:
         self.loss = config["training"]["unet_hyperparameters"]["loss"]
 
         self.pred_class = config["prediction"]["semantic_class"]
+        self.pred_batch_size = config["prediction"].get("batch_size", 1)
+        self.pred_num_threads = config["prediction"].get("num_threads", None)
+        self.pred_channels_last = config["prediction"].get("channels_last", False)
+        self.pred_compile_mode = config["prediction"].get("compile", None)
+        self.pred_single_pass = config["prediction"].get("single_pass", False)
+        self.pred_blending = config["prediction"].get("blending", None)
+        self.pred_overlap = config["prediction"].get("overlap", None)
+        self.pred_amp = config["prediction"].get("amp", None)
+        if self.pred_overlap is None:
+            self.pred_overlap = self.overlap
         self.pred_class_number = -1
         for class_number, semantic_class in enumerate(self.semantic_classes):
             if semantic_class == self.pred_class:
@@ -79,8 +97,11 @@ class Config:
         self.calculate_motl = config["postprocessing_clustering"]["calculate_motl"]
         self.ignore_border_thickness = config["postprocessing_clustering"]["ignore_border_thickness"]
         self.region_mask = config["postprocessing_clustering"]["region_mask"]
+        self.region_mask_min_fraction = config["postprocessing_clustering"].get("region_mask_min_fraction", 0)
         self.contact_mode = config["postprocessing_clustering"]["contact_mode"]
         self.contact_distance = config["postprocessing_clustering"]["contact_distance"]
+        self.clustering_out_of_core = config["postprocessing_clustering"].get("out_of_core", False)
+        self.clustering_slab_size = config["postprocessing_clustering"].get("slab_size", 64)
 
         # evaluation:
         # a. For precision recall in particle picking
@@ -142,5 +163,6 @@ def model_descriptor_from_config(config: Config, training_date=None, fold=None,
                                        total_folds=config.total_folds, fold=fold, da_rounds=config.da_rounds,
                                        da_rot_angle=config.da_rot_angle, da_elastic_alpha=config.da_elastic_alpha,
                                        da_sigma_gauss=config.da_sigma_gauss, da_salt_pepper_p=config.da_salt_pepper_p,
-                                       da_salt_pepper_ampl=config.da_salt_pepper_ampl, loss=config.loss)
+                                       da_salt_pepper_ampl=config.da_salt_pepper_ampl, loss=config.loss,
+                                       amp=config.amp)
     return model_descriptor
@@ -3,3 +3,13 @@ LABELED_SUBTOMOGRAMS = "volumes/labels/"
 PREDICTED_SEGMENTATION_SUBTOMOGRAMS = "volumes/predictions/"
 CLUSTERING_LABELS = "volumes/cluster_labels/"
 HDF_INTERNAL_PATH = "MDF/images/0/image"
+# Partition format 2: one stacked (N, ...) dataset per volume type, with the
+# box centers of the N subtomograms in SUBTOMOGRAM_COORDINATES
+SUBTOMOGRAM_COORDINATES = "volumes/coordinates"
+PARTITION_FORMAT_ATTRIBUTE = "partition_format"
+PARTITION_COMPRESSION_ATTRIBUTE = "partition_compression"
+# Tile occupancy index of prediction partitions: box centers of all the tiles
+# of the padded tomogram, and the fraction of each tile inside the region mask
+TILE_OCCUPANCY_CENTERS = "tile_occupancy/centers"
+TILE_OCCUPANCY_MASK_FRACTIONS = "tile_occupancy/mask_fractions"
+TILE_OCCUPANCY_MIN_FRACTION_ATTRIBUTE = "min_mask_fraction"
@@ -38,6 +38,7 @@ class ModelDescriptor:
     da_salt_pepper_p: float
     da_salt_pepper_ampl: float
     loss: str
+    amp: str or None = None
 
     @staticmethod
     def from_data_frame(df: pd.DataFrame) -> "ModelDescriptor":
@@ -1,6 +1,49 @@
 import numpy as np
 
 
+EM_HEADER_SIZE = 512
+
+
+def _read_em_header(f) -> tuple:
+    header = dict()
+    header['Machine_Coding'] = np.fromfile(f, dtype=np.byte, count=1)
+    header['version'] = np.fromfile(f, dtype=np.byte, count=1)
+    header['old_param'] = np.fromfile(f, dtype=np.byte, count=1)
+    header['data_type_code'] = np.fromfile(f, dtype=np.byte, count=1)
+    header['image_dimensions'] = np.fromfile(f, dtype=np.int32, count=3)
+    header['the_rest'] = np.fromfile(f, dtype=np.byte, count=496)
+    if header['data_type_code'] == 1:
+        dtype = np.byte
+    elif header['data_type_code'] == 2:
+        dtype = np.int16
+    elif header['data_type_code'] == 4:
+        dtype = np.int32
+    elif header['data_type_code'] == 5:
+        dtype = np.float32
+    elif header['data_type_code'] == 8:
+        dtype = np.complex64
+    elif header['data_type_code'] == 9:
+        dtype = np.double
+    else:
+        dtype = np.double
+        print("dtype was undefined, by default it wil be set to np.double")
+    new_image_dim = header['image_dimensions'][::-1]
+    header['image_dimensions'] = np.array(new_image_dim)
+    return header, dtype
+
+
+def read_em_header(path_to_emfile: str) -> tuple:
+    """
+    Reads the header of a .em file (in the tom format), without its data.
+    :param path_to_emfile: str, pointing to the .em file
+    :return: tuple header, dtype
+    where header is the dictionary described in read_em, and dtype the type
+    of the values.
+    """
+    with open(path_to_emfile, 'rb') as f:
+        return _read_em_header(f)
+
+
 def read_em(path_to_emfile: str) -> tuple:
     """
     Function that reads a .em dataset (in the tom format).
@@ -19,30 +62,7 @@ def read_em(path_to_emfile: str) -> tuple:
     """
     # Function that reads a em file
     with open(path_to_emfile, 'r') as f:
-        header = dict()
-        header['Machine_Coding'] = np.fromfile(f, dtype=np.byte, count=1)
-        header['version'] = np.fromfile(f, dtype=np.byte, count=1)
-        header['old_param'] = np.fromfile(f, dtype=np.byte, count=1)
-        header['data_type_code'] = np.fromfile(f, dtype=np.byte, count=1)
-        header['image_dimensions'] = np.fromfile(f, dtype=np.int32, count=3)
-        header['the_rest'] = np.fromfile(f, dtype=np.byte, count=496)
-        if header['data_type_code'] == 1:
-            dtype = np.byte
-        elif header['data_type_code'] == 2:
-            dtype = np.int16
-        elif header['data_type_code'] == 4:
-            dtype = np.int32
-        elif header['data_type_code'] == 5:
-            dtype = np.float32
-        elif header['data_type_code'] == 8:
-            dtype = np.complex64
-        elif header['data_type_code'] == 9:
-            dtype = np.double
-        else:
-            dtype = np.double
-            print("dtype was undefined, by default it wil be set to np.double")
-        new_image_dim = header['image_dimensions'][::-1]
-        header['image_dimensions'] = np.array(new_image_dim)
+        header, dtype = _read_em_header(f)
         value = np.fromfile(f, dtype=dtype)
         value = np.reshape(value, header['image_dimensions'])
         if value.shape[0] == 1 and len(value.shape) == 3:
@@ -5,18 +5,19 @@ import h5py
 import numpy as np
 
 from constants import h5_internal_paths
+from file_actions.readers.partition import get_subtomo_name, list_subtomos, \
+    read_subtomo, read_subtomos
 
 
 def get_subtomos_and_labels(path_to_output_h5, label):
     with h5py.File(path_to_output_h5, 'r') as f:
         internal_path = h5_internal_paths.LABELED_SUBTOMOGRAMS
         internal_path = join(internal_path, label)
-        subtomos_names = list(f[internal_path])
-        subtomos_number = len(subtomos_names)
+        subtomos_keys = list_subtomos(f, internal_path)
+        subtomos_number = len(subtomos_keys)
         subtomos_list = []
-        for subtomo_name in subtomos_names:
-            subtomo_path = join(internal_path, subtomo_name)
-            subtomo = f[subtomo_path][:]
+        for subtomo_key in subtomos_keys:
+            subtomo = read_subtomo(f, internal_path, subtomo_key)
             subtomos_list.append(subtomo)
         labels = np.ones(subtomos_number)
     return subtomos_list, labels
@@ -69,34 +70,26 @@ def read_training_data(training_data_path: str,
     if split < 0:
         print("split = ", split)
         with h5py.File(training_data_path, 'r') as f:
-            raw_subtomo_names = list(f[h5_internal_paths.RAW_SUBTOMOGRAMS])
-            for subtomo_name in raw_subtomo_names:
-                raw_subtomo_h5_internal_path = join(
-                    h5_internal_paths.RAW_SUBTOMOGRAMS, subtomo_name)
-                data += [f[raw_subtomo_h5_internal_path][:]]
-                labels_subtomo_h5_internal_path = join(
-                    h5_internal_paths.LABELED_SUBTOMOGRAMS, label_name)
-                labels_subtomo_h5_internal_path = join(
-                    labels_subtomo_h5_internal_path,
-                    subtomo_name)
-                labels += [f[labels_subtomo_h5_internal_path][:]]
+            raw_subtomo_keys = list_subtomos(f, h5_internal_paths.RAW_SUBTOMOGRAMS)
+            labels_h5_internal_path = join(
+                h5_internal_paths.LABELED_SUBTOMOGRAMS, label_name)
+            data = list(read_subtomos(f, h5_internal_paths.RAW_SUBTOMOGRAMS,
+                                      raw_subtomo_keys))
+            labels = list(read_subtomos(f, labels_h5_internal_path,
+                                        raw_subtomo_keys))
     else:
         with h5py.File(training_data_path, 'r') as f:
-            raw_subtomo_names = list(f[h5_internal_paths.RAW_SUBTOMOGRAMS])
+            raw_subtomo_keys = list_subtomos(f, h5_internal_paths.RAW_SUBTOMOGRAMS)
             if 1 > split > 0:
-                split = int(split * len(raw_subtomo_names))
+                split = int(split * len(raw_subtomo_keys))
             else:
                 split = int(split)
-            for subtomo_name in raw_subtomo_names[:split]:
-                raw_subtomo_h5_internal_path = join(
-                    h5_internal_paths.RAW_SUBTOMOGRAMS, subtomo_name)
-                data += [f[raw_subtomo_h5_internal_path][:]]
-                labels_subtomo_h5_internal_path = join(
-                    h5_internal_paths.LABELED_SUBTOMOGRAMS, label_name)
-                labels_subtomo_h5_internal_path = join(
-                    labels_subtomo_h5_internal_path,
-                    subtomo_name)
-                labels += [f[labels_subtomo_h5_internal_path][:]]
+            labels_h5_internal_path = join(
+                h5_internal_paths.LABELED_SUBTOMOGRAMS, label_name)
+            data = list(read_subtomos(f, h5_internal_paths.RAW_SUBTOMOGRAMS,
+                                      raw_subtomo_keys[:split]))
+            labels = list(read_subtomos(f, labels_h5_internal_path,
+                                        raw_subtomo_keys[:split]))
 
     data = np.array(data)
     labels = np.array(labels)
@@ -128,31 +121,27 @@ def read_training_data_dice_multi_class(training_data_path: str,
     labels = []
     with h5py.File(training_data_path, 'r') as f:
         if len(list(f)) > 0:
-            raw_subtomo_names = list(f[h5_internal_paths.RAW_SUBTOMOGRAMS])
+            raw_subtomo_keys = list_subtomos(f, h5_internal_paths.RAW_SUBTOMOGRAMS)
             if split == -1:
-                subtomo_list = raw_subtomo_names
+                subtomo_list = raw_subtomo_keys
             else:
-                subtomo_list = raw_subtomo_names[:split]
-            for subtomo_name in subtomo_list:
-                raw_subtomo_h5_internal_path = join(
-                    h5_internal_paths.RAW_SUBTOMOGRAMS, subtomo_name)
+                subtomo_list = raw_subtomo_keys[:split]
+            for subtomo_key in subtomo_list:
                 labels_current_subtomo = []
                 for label_name in segmentation_names:
-                    labels_subtomo_h5_internal_path = join(
+                    labels_h5_internal_path = join(
                         h5_internal_paths.LABELED_SUBTOMOGRAMS, label_name)
-                    labels_subtomo_h5_internal_path = join(
-                        labels_subtomo_h5_internal_path,
-                        subtomo_name)
                     labels_current_subtomo += [
-                        f[labels_subtomo_h5_internal_path][:]]
+                        read_subtomo(f, labels_h5_internal_path, subtomo_key)]
                 segm_max = [np.max(label_data) for label_data in
                             labels_current_subtomo]
                 if np.max(segm_max) > 0.5:
-                    data += [[f[raw_subtomo_h5_internal_path][:]]]
+                    data += [[read_subtomo(f, h5_internal_paths.RAW_SUBTOMOGRAMS,
+                                           subtomo_key)]]
                     labels += [np.array(labels_current_subtomo)]
                 else:
                     print("Due to lack of annotations, discarding",
-                          subtomo_name)
+                          get_subtomo_name(f, subtomo_key))
         else:
             print("Empty training set")
 
@@ -168,12 +157,11 @@ def read_partition_data(data_path, internal_path=h5_internal_paths.RAW_SUBTOMOGR
     with h5py.File(data_path, 'r') as f:
         if len(list(f)) > 0:
             if split == -1:
-                subtomo_names = list(f[internal_path])
+                subtomo_keys = list_subtomos(f, internal_path)
             else:
-                subtomo_names = list(f[internal_path])[:split]
-            for subtomo_name in subtomo_names:
-                subtomo_internal_path = join(internal_path, subtomo_name)
-                data += [[f[subtomo_internal_path][:]]]
+                subtomo_keys = list_subtomos(f, internal_path)[:split]
+            for subtomo_key in subtomo_keys:
+                data += [[read_subtomo(f, internal_path, subtomo_key)]]
     pass
 
 
@@ -185,22 +173,18 @@ def dummy_read_training_data_dice_multi_class(training_data_path: str,
     data = []
     labels = []
     with h5py.File(training_data_path, 'r') as f:
-        raw_subtomo_names = list(f[h5_internal_paths.RAW_SUBTOMOGRAMS])[:N]
-        raw_subtomo_names += list(f[h5_internal_paths.RAW_SUBTOMOGRAMS])[
-                             int(2 * N):int(3 * N)]
-        for subtomo_name in raw_subtomo_names[:split]:
-            raw_subtomo_h5_internal_path = join(
-                h5_internal_paths.RAW_SUBTOMOGRAMS, subtomo_name)
-            data += [f[raw_subtomo_h5_internal_path][:]]
+        raw_subtomo_keys = list_subtomos(f, h5_internal_paths.RAW_SUBTOMOGRAMS)[:N]
+        raw_subtomo_keys += list_subtomos(f, h5_internal_paths.RAW_SUBTOMOGRAMS)[
+                            int(2 * N):int(3 * N)]
+        for subtomo_key in raw_subtomo_keys[:split]:
+            data += [read_subtomo(f, h5_internal_paths.RAW_SUBTOMOGRAMS,
+                                  subtomo_key)]
             labels_current_subtomo = []
             for label_name in segmentation_names:
-                labels_subtomo_h5_internal_path = join(
+                labels_h5_internal_path = join(
                     h5_internal_paths.LABELED_SUBTOMOGRAMS, label_name)
-                labels_subtomo_h5_internal_path = join(
-                    labels_subtomo_h5_internal_path,
-                    subtomo_name)
                 labels_current_subtomo += [
-                    f[labels_subtomo_h5_internal_path][:]]
+                    read_subtomo(f, labels_h5_internal_path, subtomo_key)]
             labels += [np.array(labels_current_subtomo)]
 
     data = np.array(data)
@@ -211,10 +195,7 @@ def dummy_read_training_data_dice_multi_class(training_data_path: str,
 
 
 def read_raw_data_from_h5(data_path: str) -> np.array:
-    data = []
     with h5py.File(data_path, 'r') as f:
-        for subtomo_name in list(f[h5_internal_paths.RAW_SUBTOMOGRAMS]):
-            subtomo_h5_internal_path = join(h5_internal_paths.RAW_SUBTOMOGRAMS,
-                                            subtomo_name)
-            data += [f[subtomo_h5_internal_path][:]]
+        subtomo_keys = list_subtomos(f, h5_internal_paths.RAW_SUBTOMOGRAMS)
+        data = read_subtomos(f, h5_internal_paths.RAW_SUBTOMOGRAMS, subtomo_keys)
     return np.array(data)
@@ -0,0 +1,151 @@
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from file_actions.readers.tomograms import TOMOGRAM_FORMATS, open_tomogram
+
+METADATA_INDEX_SUFFIX = "_metadata_index.csv"
+METADATA_INDEX_COLUMNS = ["path", "size", "mtime_ns", "shape", "dtype", "voxel_size",
+                          "data_offset", "header_checksum"]
+CHECKSUM_BYTES = 4096
+MAX_CHECKSUM_BYTES = 2 ** 20
+
+
+def get_metadata_index_path(dataset_table: str) -> str:
+    return os.path.splitext(dataset_table)[0] + METADATA_INDEX_SUFFIX
+
+
+def _get_header_checksum(path_to_dataset: str, data_offset: int or None) -> str:
+    # crc32 of the bytes before the voxels (the first CHECKSUM_BYTES when
+    # their position is unknown), to tell apart files without reading them
+    header_bytes = CHECKSUM_BYTES if data_offset is None else min(data_offset, MAX_CHECKSUM_BYTES)
+    with open(path_to_dataset, 'rb') as f:
+        return "{:08x}".format(zlib.crc32(f.read(header_bytes)))
+
+
+def probe_tomogram_metadata(path_to_dataset: str) -> dict:
+    """
+    Metadata of a tomogram, read from its header only.
+    :return: dictionary with path, size and mtime_ns of the file, shape,
+    dtype, voxel_size (z, y, x or None), data_offset (position of the voxels
+    in the file, or None) and header_checksum
+    """
+    file_stat = os.stat(path_to_dataset)
+    with open_tomogram(path_to_dataset) as volume:
+        metadata = {"path": path_to_dataset, "size": file_stat.st_size, "mtime_ns": file_stat.st_mtime_ns,
+                    "shape": volume.shape, "dtype": volume.dtype, "voxel_size": volume.voxel_size,
+                    "data_offset": volume.data_offset}
+    metadata["header_checksum"] = _get_header_checksum(path_to_dataset, metadata["data_offset"])
+    return metadata
+
+
+def _is_up_to_date(metadata: dict) -> bool:
+    try:
+        file_stat = os.stat(metadata["path"])
+    except OSError:
+        return False
+    return metadata["size"] == file_stat.st_size and metadata["mtime_ns"] == file_stat.st_mtime_ns
+
+
+def _format_tuple(values: tuple or None) -> str:
+    return "" if values is None else " ".join(str(value) for value in values)
+
+
+def _parse_tuple(text, value_type) -> tuple or None:
+    if not isinstance(text, str) or len(text) == 0:
+        return None
+    return tuple(value_type(value) for value in text.split(" "))
+
+
+def _to_row(metadata: dict) -> dict:
+    return dict(metadata, shape=_format_tuple(metadata["shape"]), dtype=metadata["dtype"].str,
+                voxel_size=_format_tuple(metadata["voxel_size"]),
+                data_offset=-1 if metadata["data_offset"] is None else metadata["data_offset"])
+
+
+def _from_row(row: dict) -> dict:
+    return dict(row, size=int(row["size"]), mtime_ns=int(row["mtime_ns"]),
+                shape=_parse_tuple(row["shape"], int), dtype=np.dtype(row["dtype"]),
+                voxel_size=_parse_tuple(row["voxel_size"], float),
+                data_offset=None if int(row["data_offset"]) < 0 else int(row["data_offset"]))
+
+
+def read_metadata_index(dataset_table: str) -> dict:
+    """
+    :return: dictionary {path: metadata} of the metadata index of a dataset
+    table, empty if it has not been built
+    """
+    index_path = get_metadata_index_path(dataset_table)
+    if not os.path.isfile(index_path):
+        return {}
+    index_df = pd.read_csv(index_path, dtype={"shape": str, "dtype": str, "voxel_size": str,
+                                              "header_checksum": str}, keep_default_na=False)
+    return {row["path"]: _from_row(row) for row in index_df.to_dict("records")}
+
+
+def _write_metadata_index(dataset_table: str, index: dict):
+    index_path = get_metadata_index_path(dataset_table)
+    temporary_path = index_path + ".{}.tmp".format(os.getpid())
+    index_df = pd.DataFrame([_to_row(metadata) for metadata in index.values()], columns=METADATA_INDEX_COLUMNS)
+    index_df.to_csv(temporary_path, index=False)
+    os.replace(temporary_path, index_path)
+    return
+
+
+def list_dataset_table_files(dataset_table: str) -> list:
+    """
+    Tomograms, masks and lamella files referenced in any column of a
+    dataset table.
+    """
+    df = pd.read_csv(dataset_table, dtype=str)
+    paths = list()
+    for value in df.values.ravel():
+        if isinstance(value, str) and os.path.splitext(value)[1] in TOMOGRAM_FORMATS \
+                and os.path.isfile(value) and value not in paths:
+            paths.append(value)
+    return paths
+
+
+def build_metadata_index(dataset_table: str, workers: int or None = None) -> dict:
+    """
+    Builds or updates the metadata index of a dataset table
+    (<dataset_table>_metadata_index.csv), probing the headers of its files
+    that are not indexed yet, or changed since, with a pool of threads.
+    :param dataset_table: path to the dataset table (metadata.csv)
+    :param workers: number of threads, by default up to 8
+    :return: dictionary {path: metadata} (see probe_tomogram_metadata)
+    """
+    index = {path: metadata for path, metadata in read_metadata_index(dataset_table).items()
+             if _is_up_to_date(metadata)}
+    paths = [path for path in list_dataset_table_files(dataset_table) if path not in index]
+    if len(paths) > 0:
+        workers = min(8, len(paths)) if workers is None else workers
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            for metadata in executor.map(probe_tomogram_metadata, paths):
+                index[metadata["path"]] = metadata
+        print("Indexed the headers of", len(paths), "files of", dataset_table)
+    _write_metadata_index(dataset_table, index)
+    return index
+
+
+def get_tomogram_metadata(path_to_dataset: str, dataset_table: str or None = None) -> dict:
+    """
+    Metadata of a tomogram (see probe_tomogram_metadata), from the metadata
+    index of the dataset table if it is given. The index is built when
+    missing, and a file missing from it or changed since is probed again.
+    """
+    if dataset_table is None:
+        return probe_tomogram_metadata(path_to_dataset)
+    index = read_metadata_index(dataset_table)
+    if len(index) == 0:
+        index = build_metadata_index(dataset_table)
+    metadata = index.get(path_to_dataset)
+    if metadata is None or not _is_up_to_date(metadata):
+        metadata = probe_tomogram_metadata(path_to_dataset)
+        index[path_to_dataset] = metadata
+        _write_metadata_index(dataset_table, index)
+    return metadata
+
@@ -0,0 +1,146 @@
+from os.path import join
+
+import h5py
+import numpy as np
+
+from constants import h5_internal_paths
+from tomogram_utils.coordinates_toolbox.subtomos import get_coord_from_name
+
+
+def get_partition_format(data_file: h5py.File) -> int:
+    return int(data_file.attrs.get(h5_internal_paths.PARTITION_FORMAT_ATTRIBUTE, 1))
+
+
+def get_partition_compression(data_file: h5py.File) -> str or None:
+    compression = data_file.attrs.get(h5_internal_paths.PARTITION_COMPRESSION_ATTRIBUTE, "")
+    return compression if len(compression) > 0 else None
+
+
+def list_subtomos(data_file: h5py.File,
+                  internal_path: str = h5_internal_paths.RAW_SUBTOMOGRAMS) -> list:
+    """
+    Keys of the subtomograms stored in internal_path (empty if it does not
+    exist): the dataset names subtomo_[z, y, x] in partition format 1, and
+    the row indices of the stacked dataset in partition format 2.
+    """
+    if internal_path not in data_file:
+        return []
+    if get_partition_format(data_file) == 1:
+        return list(data_file[internal_path])
+    else:
+        return list(range(data_file[internal_path].shape[0]))
+
+
+def get_subtomo_center(data_file: h5py.File, key: str or int) -> list:
+    """
+    Box center of a subtomogram, in the coordinates of the padded tomogram
+    it was cropped from.
+    """
+    if get_partition_format(data_file) == 1:
+        return get_coord_from_name(key)
+    else:
+        return [int(coord) for coord in data_file[h5_internal_paths.SUBTOMOGRAM_COORDINATES][key]]
+
+
+def get_subtomo_name(data_file: h5py.File, key: str or int) -> str:
+    """Format 1 name of a subtomogram, for logging and conversion."""
+    if get_partition_format(data_file) == 1:
+        return key
+    else:
+        return "subtomo_{0}".format(str(get_subtomo_center(data_file, key)))
+
+
+def get_subtomo_shape(data_file: h5py.File, internal_path: str,
+                      key: str or int) -> tuple:
+    if get_partition_format(data_file) == 1:
+        return data_file[join(internal_path, key)].shape
+    else:
+        return data_file[internal_path].shape[1:]
+
+
+def read_subtomo(data_file: h5py.File, internal_path: str, key: str or int,
+                 slices: tuple = ()) -> np.array:
+    """
+    Reads a subtomogram (or the region given by slices) from internal_path.
+    """
+    if get_partition_format(data_file) == 1:
+        return data_file[join(internal_path, key)][tuple(slices) + (Ellipsis,)]
+    else:
+        return data_file[internal_path][(key,) + tuple(slices) + (Ellipsis,)]
+
+
+def read_subtomos(data_file: h5py.File, internal_path: str,
+                  keys: list) -> np.array:
+    """
+    Reads several subtomograms from internal_path, stacked along the first
+    axis. For format 2, consecutive keys are read with a single slice.
+    """
+    if get_partition_format(data_file) == 1:
+        return np.array([data_file[join(internal_path, key)][:] for key in keys])
+    dataset = data_file[internal_path]
+    if len(keys) == 0:
+        return np.zeros((0,) + dataset.shape[1:], dtype=dataset.dtype)
+    keys = np.array(keys)
+    if np.all(np.diff(keys) == 1):
+        return dataset[keys[0]:keys[-1] + 1]
+    # h5py needs increasing indices
+    sorted_keys, inverse = np.unique(keys, return_inverse=True)
+    return dataset[sorted_keys][inverse]
+
+
+def list_subtomos_to_segment(data_file: h5py.File, label_name: str) -> tuple:
+    """
+    Keys of the raw subtomograms that have no prediction under
+    volumes/predictions/<label_name> yet.
+    :return: (keys to segment, total number of raw subtomograms)
+    """
+    prediction_path = join(h5_internal_paths.PREDICTED_SEGMENTATION_SUBTOMOGRAMS, label_name)
+    raw_keys = list_subtomos(data_file, h5_internal_paths.RAW_SUBTOMOGRAMS)
+    predicted_keys = list_subtomos(data_file, prediction_path)
+    if len(predicted_keys) == 0:
+        print("The segmentation", label_name, " does not exist yet.")
+    else:
+        print("The segmentation", label_name, " exists already.")
+    if get_partition_format(data_file) == 1:
+        predicted_keys = set(predicted_keys)
+        keys = [key for key in raw_keys if key not in predicted_keys]
+    else:
+        keys = raw_keys[len(predicted_keys):]
+    return keys, len(raw_keys)
+
+
+def get_subtomo_mask_fractions(data_file: h5py.File, keys: list) -> np.array or None:
+    """
+    Region mask fractions of the subtomograms with the given keys, read from
+    the tile occupancy index of the partition (see write_tile_occupancy).
+    :return: np.array of fractions, one per key (1 for subtomograms missing
+    from the index), or None if the partition has no index
+    """
+    if h5_internal_paths.TILE_OCCUPANCY_MASK_FRACTIONS not in data_file:
+        return None
+    index = {tuple(center): fraction for center, fraction in
+             zip(data_file[h5_internal_paths.TILE_OCCUPANCY_CENTERS][:].tolist(),
+                 data_file[h5_internal_paths.TILE_OCCUPANCY_MASK_FRACTIONS][:])}
+    if get_partition_format(data_file) == 1:
+        centers = [get_coord_from_name(key) for key in keys]
+    else:
+        coordinates = data_file[h5_internal_paths.SUBTOMOGRAM_COORDINATES][:]
+        centers = [coordinates[key] for key in keys]
+    return np.array([index.get(tuple(int(coord) for coord in center), 1) for center in centers],
+                    dtype=np.float64)
+
+
+def select_occupied_subtomos(data_file: h5py.File, keys: list,
+                             min_mask_fraction: float = 0) -> tuple:
+    """
+    Splits keys into the subtomograms whose region mask fraction is above
+    min_mask_fraction, and the (almost) empty ones, that can be skipped.
+    Nothing is skipped if the partition has no tile occupancy index.
+    :return: (occupied keys, skipped keys)
+    """
+    mask_fractions = get_subtomo_mask_fractions(data_file, keys)
+    if mask_fractions is None:
+        return list(keys), []
+    occupied_keys = [key for key, fraction in zip(keys, mask_fractions) if fraction > min_mask_fraction]
+    skipped_keys = [key for key, fraction in zip(keys, mask_fractions) if fraction <= min_mask_fraction]
+    return occupied_keys, skipped_keys
@@ -1,10 +1,101 @@
+import contextlib
 import os
 
+import h5py
+import mrcfile
 import numpy as np
 
-from file_actions.readers.em import read_em
-from file_actions.readers.hdf import _load_hdf_dataset
-from file_actions.readers.mrc import read_mrc
+from constants import h5_internal_paths
+from file_actions.readers.em import EM_HEADER_SIZE, read_em_header
+
+TOMOGRAM_FORMATS = [".em", ".hdf", ".mrc", ".rec"]
+
+
+class TomogramVolume:
+    """
+    Tomogram opened without reading its voxels. The shape, dtype and voxel
+    size come from the header, and indexing reads only the requested region,
+    converted to dtype. .mrc/.rec files are read through mrcfile.mmap, .em
+    files through np.memmap and .hdf files through h5py.
+    Attributes:
+      shape: shape (z, y, x) of the tomogram
+      dtype: type of the arrays returned when indexing
+      voxel_size: (z, y, x) voxel size in angstroms, None if the format has
+      none
+      data_offset: position of the voxels in the file, None for chunked
+      .hdf datasets
+    """
+
+    def __init__(self, path_to_dataset: str, dtype=None):
+        _, data_file_extension = os.path.splitext(path_to_dataset)
+        assert data_file_extension in TOMOGRAM_FORMATS, "file in non valid format."
+        self.path = path_to_dataset
+        self.voxel_size = None
+        self._file = None
+        if data_file_extension == ".em":
+            em_header, em_dtype = read_em_header(path_to_emfile=path_to_dataset)
+            shape = tuple(em_header['image_dimensions'])
+            if shape[0] == 1:
+                shape = shape[1:]
+            self._data = np.memmap(path_to_dataset, dtype=em_dtype, mode='r', offset=EM_HEADER_SIZE,
+                                   shape=shape)
+            self.data_offset = EM_HEADER_SIZE
+        elif data_file_extension == ".hdf":
+            self._file = h5py.File(path_to_dataset, 'r')
+            self._data = self._file[h5_internal_paths.HDF_INTERNAL_PATH]
+            self.data_offset = self._data.id.get_offset()
+        else:
+            self._file = mrcfile.mmap(path_to_dataset, mode='r', permissive=True)
+            self._data = self._file.data
+            self.voxel_size = tuple(float(self._file.voxel_size[axis]) for axis in "zyx")
+            self.data_offset = self._file.header.nbytes + int(self._file.header.nsymbt)
+        self.dtype = np.dtype(dtype) if dtype is not None else self._data.dtype
+
+    @property
+    def shape(self) -> tuple:
+        return tuple(self._data.shape)
+
+    @property
+    def ndim(self) -> int:
+        return len(self._data.shape)
+
+    def __getitem__(self, key) -> np.array:
+        return np.array(self._data[key], dtype=self.dtype)
+
+    def read(self) -> np.array:
+        return self[...]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._data = None
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+        return False
+
+
+@contextlib.contextmanager
+def open_tomogram(path_to_dataset: str, dtype=None):
+    """
+    Opens a tomogram without loading it: yields a TomogramVolume, that can
+    be read region by region.
+    """
+    with TomogramVolume(path_to_dataset, dtype=dtype) as volume:
+        yield volume
+
+
+def get_tomogram_shape(path_to_dataset: str) -> tuple:
+    """
+    Shape (z, y, x) of a tomogram, read from its header.
+    """
+    with open_tomogram(path_to_dataset) as volume:
+        return volume.shape
 
 
 def load_tomogram(path_to_dataset: str, dtype=None) -> np.array:
@@ -13,12 +104,20 @@ def load_tomogram(path_to_dataset: str, dtype=None) -> np.array:
     """
     _, data_file_extension = os.path.splitext(path_to_dataset)
     print("file in {} format".format(data_file_extension))
-    assert data_file_extension in [".em", ".hdf", ".mrc", ".rec"], \
-        "file in non valid format."
-    if data_file_extension == ".em":
-        em_header, dataset = read_em(path_to_emfile=path_to_dataset)
-    elif data_file_extension == ".hdf":
-        dataset = _load_hdf_dataset(hdf_file_path=path_to_dataset)
-    elif data_file_extension in [".mrc", ".rec"]:
-        dataset = read_mrc(path_to_mrc=path_to_dataset, dtype=dtype)
-    return dataset
+    with open_tomogram(path_to_dataset, dtype=dtype) as volume:
+        return volume.read()
+
+
+def load_tomograms_in_common_shape(paths_to_datasets: list, dtype=None) -> list:
+    """
+    Loads tomograms cropped to their common shape (the minimum size along
+    each axis), reading only the cropped regions.
+    :param paths_to_datasets: tomogram paths
+    :param dtype: type of the arrays, by default the type of each file
+    :return: list of arrays of the same shape
+    """
+    with contextlib.ExitStack() as stack:
+        volumes = [stack.enter_context(open_tomogram(path, dtype=dtype)) for path in paths_to_datasets]
+        common_shape = np.min([volume.shape for volume in volumes], axis=0)
+        crop = tuple(slice(0, dimension) for dimension in common_shape)
+        return [volume[crop] for volume in volumes]
@@ -1,6 +1,12 @@
+import contextlib
 import os
 import os.path
+import queue
 import random
+import resource
+import tempfile
+import threading
+import time
 from os import makedirs
 from os.path import join
 
@@ -8,23 +14,33 @@ import h5py
 import numpy as np
 import pandas as pd
 import torch
-import torch.nn as nn
 from tqdm import tqdm
 
 from constants import h5_internal_paths
 from file_actions.readers.em import read_em
 from file_actions.readers.motl import read_motl_from_csv
+from file_actions.readers.partition import get_partition_compression, \
+    get_partition_format, get_subtomo_center, get_subtomo_shape, \
+    list_subtomos, list_subtomos_to_segment, read_subtomo, read_subtomos, \
+    select_occupied_subtomos
 from file_actions.readers.tomograms import load_tomogram
-from file_actions.writers.mrc import write_mrc_dataset
+from file_actions.writers.mrc import new_mrc_mmap, update_mrc_header_stats_and_close, \
+    write_mrc_dataset
+from file_actions.writers.partition import SubtomoWriter, \
+    copy_partition_subtomos, fill_subtomo_predictions, write_subtomo_predictions
 from networks.unet import UNet3D
 from pytorch_cnn.classes.io import get_device
-from tensors.actions import crop_window_around_point
+from tensors.actions import crop_window_around_point, get_blending_window
 from tomogram_utils.coordinates_toolbox import subtomos
 from tomogram_utils.coordinates_toolbox.utils import \
     extract_coordinates_from_em_motl
-from tomogram_utils.peak_toolbox.utils import paste_sphere_in_dataset
+from tomogram_utils.peak_toolbox.utils import paste_spheres_in_dataset
 from tomogram_utils.peak_toolbox.utils import read_motl_coordinates_and_values
 
+# Prediction of the voxels left out of the segmentation, such that
+# sigmoid(-10) ~ 0
+BACKGROUND_LOGIT = -10
+
 
 def write_dataset_hdf(output_path: str, tomo_data: np.array):
     with h5py.File(output_path, 'w') as f:
@@ -37,76 +53,198 @@ def write_dataset_from_subtomograms(output_path, subtomo_path, output_shape,
                                     subtomos_internal_path):
     tomo_data = np.zeros(output_shape)
     with h5py.File(subtomo_path, 'r') as f:
-        for subtomo_name in list(f[subtomos_internal_path]):
-            subtomo_center = subtomos.get_coord_from_name(subtomo_name)
+        for subtomo_key in list_subtomos(f, subtomos_internal_path):
+            subtomo_center = get_subtomo_center(f, subtomo_key)
             init_points, end_points, lengths = subtomos.get_subtomo_corners(
                 output_shape,
                 subtomo_shape,
                 subtomo_center)
             print(init_points, end_points, lengths)
-            subtomo_h5_internal_path = join(subtomos_internal_path,
-                                            subtomo_name)
             data_slices = [slice(i, e) for i, e in zip(init_points, end_points)]
             data_slices = tuple(data_slices)
             subtomo_slices = tuple([slice(0, l) for l in lengths])
-            tomo_data[data_slices] = f[subtomo_h5_internal_path][subtomo_slices]
+            tomo_data[data_slices] = read_subtomo(f, subtomos_internal_path,
+                                                  subtomo_key, subtomo_slices)
     write_dataset_hdf(output_path, tomo_data)
     del tomo_data
 
 
+def _get_peak_memory_mb() -> float:
+    """Peak resident memory of the current process, in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+@contextlib.contextmanager
+def open_output_tomo(output_path: str, output_shape: tuple, fill: float):
+    """
+    Opens a float32 output tomogram on disk (.mrc memory map or .hdf
+    dataset), initialized to fill, that can be written region by region.
+    """
+    ext = os.path.splitext(output_path)[-1].lower()
+    assert ext in [".mrc", ".hdf"], "Output format should be .mrc or .hdf"
+    if ext == ".mrc":
+        mrc = new_mrc_mmap(mrc_path=output_path, shape=output_shape, fill=fill)
+        try:
+            yield mrc.data
+        finally:
+            update_mrc_header_stats_and_close(mrc)
+    else:
+        with h5py.File(output_path, 'w') as f:
+            yield f.create_dataset(h5_internal_paths.HDF_INTERNAL_PATH,
+                                   shape=tuple(output_shape),
+                                   dtype=np.float32, fillvalue=fill)
+    print("Dataset saved in", output_path)
+
+
+def _read_subtomo_data(data_file: h5py.File, subtomos_internal_path: str,
+                       subtomo_key: str or int, volume_slices: tuple,
+                       class_number: int, reconstruction_type: str) -> np.array:
+    if reconstruction_type == "prediction":
+        subtomo_data = read_subtomo(data_file, subtomos_internal_path, subtomo_key)
+        channels, *rest = subtomo_data.shape
+        assert class_number < channels
+        # noinspection PyTypeChecker
+        channel_slices = (class_number,) + volume_slices
+        return subtomo_data[channel_slices]
+    else:
+        return read_subtomo(data_file, subtomos_internal_path, subtomo_key,
+                            volume_slices)
+
+
+def _activate(subtomo_data: np.array, final_activation: None or 'sigmoid') -> np.array:
+    subtomo_data = np.ascontiguousarray(subtomo_data, dtype=np.float32)
+    if final_activation is not None:
+        subtomo_data = torch.sigmoid(torch.from_numpy(subtomo_data)).numpy()
+    return subtomo_data
+
+
+def _paste_inner_subtomos(data_file: h5py.File, tomo_data, output_shape: tuple,
+                          subtomo_shape: tuple or list,
+                          subtomos_internal_path: str, subtomo_keys: list,
+                          class_number: int, overlap: int,
+                          final_activation: None or 'sigmoid',
+                          reconstruction_type: str):
+    """
+    Pastes the inner region (without overlap) of each subtomogram into
+    tomo_data, applying the final activation tile by tile.
+    """
+    total_subtomos = len(subtomo_keys)
+    for index, subtomo_key in zip(tqdm(range(total_subtomos)),
+                                  subtomo_keys):
+        subtomo_center = get_subtomo_center(data_file, subtomo_key)
+        inner_slices = subtomos.get_inner_subtomo_slices(
+            output_shape=output_shape, subtomo_shape=subtomo_shape,
+            subtomo_center=subtomo_center, overlap=overlap)
+        if inner_slices is not None:
+            tomo_slices, volume_slices = inner_slices
+            internal_subtomo_data = _read_subtomo_data(
+                data_file=data_file, subtomos_internal_path=subtomos_internal_path,
+                subtomo_key=subtomo_key, volume_slices=volume_slices, class_number=class_number,
+                reconstruction_type=reconstruction_type)
+            tomo_data[tomo_slices] = _activate(internal_subtomo_data, final_activation)
+    return
+
+
+def _blend_subtomos(data_file: h5py.File, tomo_data, output_shape: tuple,
+                    subtomo_shape: tuple or list, subtomos_internal_path: str,
+                    subtomo_keys: list, class_number: int, overlap: int,
+                    final_activation: None or 'sigmoid',
+                    reconstruction_type: str, blending: str,
+                    background: float, accumulators_dir: str,
+                    slab_size: int = 32):
+    """
+    Assembles the whole subtomograms (overlap included) as a weighted average,
+    where each subtomogram is weighted by a blending window. If a final
+    activation is given, it is applied to each subtomogram before averaging.
+    The weighted sum and the weights are accumulated in float32 memory maps
+    in accumulators_dir, and normalized into tomo_data slab by slab. Voxels
+    not covered by any subtomogram are set to background.
+    """
+    window = get_blending_window(window_shape=subtomo_shape, mode=blending)
+    weighted_sum = np.memmap(join(accumulators_dir, "weighted_sum.dat"),
+                             dtype=np.float32, mode="w+", shape=tuple(output_shape))
+    weights = np.memmap(join(accumulators_dir, "weights.dat"),
+                        dtype=np.float32, mode="w+", shape=tuple(output_shape))
+    total_subtomos = len(subtomo_keys)
+    for index, subtomo_key in zip(tqdm(range(total_subtomos)),
+                                  subtomo_keys):
+        subtomo_center = get_subtomo_center(data_file, subtomo_key)
+        slices = subtomos.get_subtomo_slices(
+            output_shape=output_shape, subtomo_shape=subtomo_shape,
+            subtomo_center=subtomo_center, overlap=overlap)
+        if slices is not None:
+            tomo_slices, volume_slices = slices
+            subtomo_data = _read_subtomo_data(
+                data_file=data_file, subtomos_internal_path=subtomos_internal_path,
+                subtomo_key=subtomo_key, volume_slices=volume_slices, class_number=class_number,
+                reconstruction_type=reconstruction_type)
+            subtomo_data = _activate(subtomo_data, final_activation)
+            weighted_sum[tomo_slices] += window[volume_slices] * subtomo_data
+            weights[tomo_slices] += window[volume_slices]
+    for z in range(0, output_shape[0], slab_size):
+        slab_sum = np.array(weighted_sum[z:z + slab_size])
+        slab_weights = weights[z:z + slab_size]
+        covered = slab_weights > 0
+        slab_sum[covered] /= slab_weights[covered]
+        slab_sum[~covered] = background
+        tomo_data[z:z + slab_size] = slab_sum
+    del weighted_sum, weights
+    return
+
+
 def assemble_tomo_from_subtomos(output_path: str, partition_file_path: str,
                                 output_shape: tuple, subtomo_shape: tuple or list,
                                 subtomos_internal_path: str,
                                 class_number: int, overlap: int,
                                 final_activation: None or 'sigmoid' = None,
-                                reconstruction_type: str = "prediction"):
+                                reconstruction_type: str = "prediction",
+                                blending: None or str = None,
+                                min_mask_fraction: float = 0):
+    """
+    Assembles the subtomograms of a partition file into a float32 tomogram,
+    written in .mrc or .hdf format. The output is written in place on disk
+    (the final activation is applied tile by tile), so that the memory needed
+    does not grow with the tomogram size.
+    :param blending: if None, only the inner region of each subtomogram
+    (without overlap) is pasted. If "gaussian" or "cosine", the whole
+    subtomograms are averaged, weighted with the corresponding window, which
+    avoids seams with a smaller overlap.
+    :param min_mask_fraction: subtomograms whose fraction inside the region
+    mask is up to it (see select_occupied_subtomos) are skipped, and their
+    region is left to the background (the activated BACKGROUND_LOGIT)
+    """
     print("Assembling data from", partition_file_path, ":")
-    tomo_data = -10 * np.ones(output_shape)  # such that sigmoid(-10) ~ 0
-    inner_subtomo_shape = tuple([subtomo_dim - 2 * overlap for
-                                 subtomo_dim in subtomo_shape])
-    with h5py.File(partition_file_path, 'r') as f:
-        subtomo_names = list(f[subtomos_internal_path])
-        total_subtomos = len(subtomo_names)
-        output_shape_overlap = tuple([sh + overlap for sh in output_shape])
-        for index, subtomo_name in zip(tqdm(range(total_subtomos)),
-                                       subtomo_names):
-            subtomo_center = subtomos.get_coord_from_name(subtomo_name)
-            start_corner, end_corner, lengths = \
-                subtomos.get_subtomo_corners(output_shape=output_shape_overlap,
-                                             subtomo_shape=inner_subtomo_shape,
-                                             subtomo_center=subtomo_center)
-
-            volume_slices = [slice(overlap, overlap + l) for l in lengths]
-            if np.min(lengths) > 0:
-                overlap_shift = overlap * np.array([1, 1, 1])
-                start_corner -= overlap_shift
-                end_corner -= overlap_shift
-                subtomo_h5_internal_path = join(subtomos_internal_path,
-                                                subtomo_name)
-                if reconstruction_type == "prediction":
-                    channels, *rest = f[subtomo_h5_internal_path][:].shape
-                    assert class_number < channels
-                    # noinspection PyTypeChecker
-                    channel_slices = [class_number] + volume_slices
-                    channel_slices = tuple(channel_slices)
-                    subtomo_data = f[subtomo_h5_internal_path][:]
-                    internal_subtomo_data = subtomo_data[channel_slices]
-                else:
-                    volume_slices = tuple(volume_slices)
-                    internal_subtomo_data = f[subtomo_h5_internal_path][
-                        volume_slices]
-                tomo_slices = tuple(
-                    [slice(s, e) for s, e in zip(start_corner, end_corner)])
-                tomo_data[tomo_slices] = internal_subtomo_data
-    if final_activation is not None:
-        sigmoid = nn.Sigmoid()
-        tomo_data = sigmoid(torch.from_numpy(tomo_data).float())
-        tomo_data = tomo_data.float().numpy()
-    ext = os.path.splitext(output_path)[-1].lower()
-    if ext == ".mrc":
-        write_mrc_dataset(mrc_path=output_path, array=tomo_data)
-    elif ext == ".hdf":
-        write_dataset_hdf(output_path, tomo_data)
+    background = _activate(np.float32(BACKGROUND_LOGIT), final_activation).item()
+    with open_output_tomo(output_path, output_shape, fill=background) as tomo_data, \
+            h5py.File(partition_file_path, 'r') as f:
+        subtomo_keys, skipped_keys = select_occupied_subtomos(
+            data_file=f, keys=list_subtomos(f, subtomos_internal_path),
+            min_mask_fraction=min_mask_fraction)
+        if len(skipped_keys) > 0:
+            print(len(skipped_keys), "subtomograms with a region mask fraction up to", min_mask_fraction,
+                  "skipped")
+        if blending is None:
+            _paste_inner_subtomos(
+                data_file=f, tomo_data=tomo_data, output_shape=output_shape,
+                subtomo_shape=subtomo_shape,
+                subtomos_internal_path=subtomos_internal_path,
+                subtomo_keys=subtomo_keys,
+                class_number=class_number, overlap=overlap,
+                final_activation=final_activation,
+                reconstruction_type=reconstruction_type)
+        else:
+            print("Blending overlapping subtomograms with a", blending, "window")
+            with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_path))) as accumulators_dir:
+                _blend_subtomos(
+                    data_file=f, tomo_data=tomo_data, output_shape=output_shape,
+                    subtomo_shape=subtomo_shape,
+                    subtomos_internal_path=subtomos_internal_path,
+                    subtomo_keys=subtomo_keys,
+                    class_number=class_number, overlap=overlap,
+                    final_activation=final_activation,
+                    reconstruction_type=reconstruction_type, blending=blending,
+                    background=background, accumulators_dir=accumulators_dir)
+    print("Peak memory usage during assembly: {:.0f} MB".format(_get_peak_memory_mb()))
     return
 
 
@@ -128,10 +266,10 @@ def write_clustering_labels_subtomos(output_path: str, subtomo_path: str,
 
     print("To reconstruct: ", label_subtomos_internal_path)
     with h5py.File(subtomo_path, 'r') as f:
-        subtomos_set = f[label_subtomos_internal_path]
-        print(list(subtomos_set))
-        for subtomo_name in list(subtomos_set):
-            subtomo_center = subtomos.get_coord_from_name(subtomo_name)
+        subtomo_keys = list_subtomos(f, label_subtomos_internal_path)
+        print(subtomo_keys)
+        for subtomo_key in subtomo_keys:
+            subtomo_center = get_subtomo_center(f, subtomo_key)
             start_corner, end_corner, lengths = subtomos.get_subtomo_corners(
                 output_shape,
                 internal_subtomo_shape,
@@ -139,27 +277,28 @@ def write_clustering_labels_subtomos(output_path: str, subtomo_path: str,
             overlap_shift = overlap * np.array([1, 1, 1])
             start_corner -= overlap_shift
             end_corner -= overlap_shift
-            if len(subtomos_set[subtomo_name].shape) > 3:
-                channels = subtomos_set[subtomo_name].shape[0]
+            subtomo_shape = get_subtomo_shape(f, label_subtomos_internal_path,
+                                              subtomo_key)
+            inner_slices = (slice(overlap, lengths[0] + overlap),
+                            slice(overlap, lengths[1] + overlap),
+                            slice(overlap, lengths[2] + overlap))
+            if len(subtomo_shape) > 3:
+                channels = subtomo_shape[0]
                 internal_subtomo_data = np.zeros(lengths)
                 if channels > 1:
                     assert class_number < channels
                     # leave out the background class
-                    channel_data = subtomos_set[subtomo_name][
-                                   class_number, overlap:lengths[0] + overlap,
-                                   overlap:lengths[1] + overlap,
-                                   overlap:lengths[2] + overlap]
+                    channel_data = read_subtomo(
+                        f, label_subtomos_internal_path, subtomo_key,
+                        (class_number,) + inner_slices)
                     print("channel ", 0, ", min, max = ", np.min(channel_data),
                           np.max(channel_data))
                     internal_subtomo_data += channel_data
             else:
-                print("subtomos_set[subtomo_name].shape = ",
-                      subtomos_set[subtomo_name].shape)
+                print("subtomo shape = ", subtomo_shape)
 
-                internal_subtomo_data = subtomos_set[subtomo_name][
-                                        overlap:lengths[0] + overlap,
-                                        overlap:lengths[1] + overlap,
-                                        overlap:lengths[2] + overlap]
+                internal_subtomo_data = read_subtomo(
+                    f, label_subtomos_internal_path, subtomo_key, inner_slices)
             slices = [slice(i, e) for i, e in zip(start_corner, end_corner)]
             tomo_data[slices] = internal_subtomo_data
             print("internal_subtomo_data = ", internal_subtomo_data.shape)
@@ -196,37 +335,33 @@ def write_dataset_from_subtomos_with_overlap_dice_multiclass(
     internal_subtomo_shape = tuple([subtomo_dim - 2 * overlap for
                                     subtomo_dim in subtomo_shape])
     with h5py.File(subtomo_path, 'r') as f:
-        for subtomo_name in list(f[subtomos_internal_path]):
-            subtomo_center = subtomos.get_coord_from_name(subtomo_name)
+        for subtomo_key in list_subtomos(f, subtomos_internal_path):
+            subtomo_center = get_subtomo_center(f, subtomo_key)
             start_corner, end_corner, lengths = subtomos.get_subtomo_corners(
                 output_shape,
                 internal_subtomo_shape,
                 subtomo_center)
-            volume_slices = [slice(overlap, l + overlap) for l in lengths]
+            volume_slices = tuple([slice(overlap, l + overlap) for l in lengths])
             overlap_shift = overlap * np.array([1, 1, 1])
             start_corner -= overlap_shift
             end_corner -= overlap_shift
-            subtomo_h5_internal_path = join(subtomos_internal_path,
-                                            subtomo_name)
-            channels = f[subtomo_h5_internal_path][:].shape[0]
+            channels = get_subtomo_shape(f, subtomos_internal_path,
+                                         subtomo_key)[0]
             internal_subtomo_data = np.zeros(lengths)
             if channels > 1:
                 if isinstance(class_number, list):
                     for channel in class_number:
-                        channel_data = f[subtomo_h5_internal_path][
-                            channel,
-                            volume_slices[0],
-                            volume_slices[1],
-                            volume_slices[2]]
+                        channel_data = read_subtomo(
+                            f, subtomos_internal_path, subtomo_key,
+                            (channel,) + volume_slices)
                         print("channel ", channel, ", min, max = ",
                               np.min(channel_data),
                               np.max(channel_data))
                         internal_subtomo_data += channel_data
                 elif isinstance(class_number, int):
-                    channel_data = f[subtomo_h5_internal_path][class_number,
-                                                               volume_slices[0],
-                                                               volume_slices[1],
-                                                               volume_slices[2]]
+                    channel_data = read_subtomo(
+                        f, subtomos_internal_path, subtomo_key,
+                        (class_number,) + volume_slices)
                     print("channel ", class_number, ", min, max = ",
                           np.min(channel_data),
                           np.max(channel_data))
@@ -235,8 +370,9 @@ def write_dataset_from_subtomos_with_overlap_dice_multiclass(
                     print("class_number = ", class_number)
                     print("class_number should be an int or a list of ints")
             else:
-                internal_subtomo_data = f[subtomo_h5_internal_path][
-                    0, volume_slices[0], volume_slices[1], volume_slices[2]]
+                internal_subtomo_data = read_subtomo(
+                    f, subtomos_internal_path, subtomo_key,
+                    (0,) + volume_slices)
             slices = [slice(i, e) for i, e in zip(start_corner, end_corner)]
             tomo_data[slices] = internal_subtomo_data
             print("internal_subtomo_data = ", internal_subtomo_data.shape)
@@ -261,25 +397,22 @@ def write_dataset_from_subtomos_with_overlap_multiclass_exponentiating(
     internal_subtomo_shape = tuple([subtomo_dim - 2 * overlap for
                                     subtomo_dim in subtomo_shape])
     with h5py.File(subtomo_path, 'r') as f:
-        for subtomo_name in list(f[subtomos_internal_path]):
-            subtomo_center = subtomos.get_coord_from_name(subtomo_name)
+        for subtomo_key in list_subtomos(f, subtomos_internal_path):
+            subtomo_center = get_subtomo_center(f, subtomo_key)
             start_corner, end_corner, lengths = subtomos.get_subtomo_corners(
                 output_shape,
                 internal_subtomo_shape,
                 subtomo_center)
-            volume_slices = [slice(overlap, overlap + l) for l in lengths]
+            volume_slices = tuple([slice(overlap, overlap + l) for l in lengths])
             overlap_shift = overlap * np.array([1, 1, 1])
             start_corner -= overlap_shift
             end_corner -= overlap_shift
-            subtomo_h5_internal_path = join(subtomos_internal_path,
-                                            subtomo_name)
-            channels = f[subtomo_h5_internal_path][:].shape[0]
+            channels = get_subtomo_shape(f, subtomos_internal_path,
+                                         subtomo_key)[0]
             internal_subtomo_data = np.zeros(lengths)
             for n in range(channels - 1):  # leave out the background class
-                channel_data = f[subtomo_h5_internal_path][n + 1,
-                                                           volume_slices[0],
-                                                           volume_slices[1],
-                                                           volume_slices[2]]
+                channel_data = read_subtomo(f, subtomos_internal_path,
+                                            subtomo_key, (n + 1,) + volume_slices)
                 print("channel ", n, ", min, max = ", np.min(channel_data),
                       np.max(channel_data))
                 internal_subtomo_data += np.exp(channel_data)
@@ -292,16 +425,17 @@ def write_dataset_from_subtomos_with_overlap_multiclass_exponentiating(
 
 
 def write_subtomograms_from_dataset(output_path, padded_dataset,
-                                    window_centers, crop_shape):
-    for window_center in window_centers:
-        with h5py.File(output_path, 'a') as f:
-            subtomo_name = "subtomo_{0}".format(str(window_center))
-            subtomo_h5_internal_path = join(h5_internal_paths.RAW_SUBTOMOGRAMS,
-                                            subtomo_name)
+                                    window_centers, crop_shape,
+                                    partition_format: int = 1,
+                                    compression: str or None = None):
+    with h5py.File(output_path, 'a') as f:
+        writer = SubtomoWriter(f, partition_format=partition_format,
+                               compression=compression)
+        for window_center in window_centers:
             subtomo_data = crop_window_around_point(input_array=padded_dataset,
                                                     crop_shape=crop_shape,
                                                     window_center=window_center)
-            f[subtomo_h5_internal_path] = subtomo_data
+            writer.write_subtomo(center=window_center, raw_data=subtomo_data)
     print("Partition written to", output_path)
 
 
@@ -310,32 +444,28 @@ def write_joint_raw_and_labels_subtomograms(output_path: str,
                                             padded_labels_dataset: np.array,
                                             label_name: str,
                                             window_centers: list,
-                                            crop_shape: tuple):
+                                            crop_shape: tuple,
+                                            partition_format: int = 1,
+                                            compression: str or None = None):
     with h5py.File(output_path, 'w') as f:
+        writer = SubtomoWriter(f, partition_format=partition_format,
+                               compression=compression)
         for window_center in window_centers:
             print("window_center", window_center)
             subtomo_name = "subtomo_{0}".format(str(window_center))
-            subtomo_raw_h5_internal_path = join(
-                h5_internal_paths.RAW_SUBTOMOGRAMS,
-                subtomo_name)
             subtomo_raw_data = crop_window_around_point(
                 input_array=padded_raw_dataset,
                 crop_shape=crop_shape,
                 window_center=window_center)
 
-            subtomo_label_h5_internal_path = join(
-                h5_internal_paths.LABELED_SUBTOMOGRAMS, label_name)
-            subtomo_label_h5_internal_path = join(
-                subtomo_label_h5_internal_path,
-                subtomo_name)
-
             subtomo_label_data = crop_window_around_point(
                 input_array=padded_labels_dataset,
                 crop_shape=crop_shape,
                 window_center=window_center)
             if np.max(subtomo_label_data) > 0.5:
-                f[subtomo_raw_h5_internal_path] = subtomo_raw_data
-                f[subtomo_label_h5_internal_path] = subtomo_label_data
+                writer.write_subtomo(center=window_center,
+                                     raw_data=subtomo_raw_data,
+                                     labels_data={label_name: subtomo_label_data})
             else:
                 print("subtomo ", subtomo_name, "discarded")
     return
@@ -397,14 +527,14 @@ def write_raw_subtomograms_intersecting_mask(output_path: str,
                                              padded_raw_dataset: np.array,
                                              padded_mask_dataset: np.array,
                                              window_centers: list,
-                                             crop_shape: tuple):
+                                             crop_shape: tuple,
+                                             partition_format: int = 1,
+                                             compression: str or None = None):
     with h5py.File(output_path, 'w') as f:
+        writer = SubtomoWriter(f, partition_format=partition_format,
+                               compression=compression)
         n = len(window_centers)
         for index, window_center in zip(tqdm(range(n)), window_centers):
-            subtomo_name = "subtomo_{0}".format(str(window_center))
-            subtomo_raw_h5_internal_path = join(
-                h5_internal_paths.RAW_SUBTOMOGRAMS,
-                subtomo_name)
             subtomo_raw_data = crop_window_around_point(
                 input_array=padded_raw_dataset,
                 crop_shape=crop_shape,
@@ -415,7 +545,8 @@ def write_raw_subtomograms_intersecting_mask(output_path: str,
                 crop_shape=crop_shape,
                 window_center=window_center)
             if np.max(subtomo_label_data) > 0:
-                f[subtomo_raw_h5_internal_path] = subtomo_raw_data
+                writer.write_subtomo(center=window_center,
+                                     raw_data=subtomo_raw_data)
     return
 
 
@@ -425,21 +556,21 @@ def write_joint_raw_and_labels_subtomograms_dice_multiclass(
         padded_labels_list: list,  # list of padded labeled data sets
         segmentation_names: list,
         window_centers: list,
-        crop_shape: tuple):
+        crop_shape: tuple,
+        partition_format: int = 1,
+        compression: str or None = None):
     with h5py.File(output_path, 'w') as f:
+        writer = SubtomoWriter(f, partition_format=partition_format,
+                               compression=compression)
         for window_center in window_centers:
             print("window_center", window_center)
             subtomo_name = "subtomo_{0}".format(str(window_center))
-            subtomo_raw_h5_internal_path = join(
-                h5_internal_paths.RAW_SUBTOMOGRAMS,
-                subtomo_name)
             subtomo_raw_data = crop_window_around_point(
                 input_array=padded_raw_dataset,
                 crop_shape=crop_shape,
                 window_center=window_center)
 
-            subtomo_label_data_list = []
-            subtomo_label_h5_internal_path_list = []
+            subtomo_labels_data = {}
             segmentation_max = 0
             for label_name, padded_label in zip(segmentation_names,
                                                 padded_labels_list):
@@ -447,23 +578,14 @@ def write_joint_raw_and_labels_subtomograms_dice_multiclass(
                     input_array=padded_label,
                     crop_shape=crop_shape,
                     window_center=window_center)
-                subtomo_label_data_list += [subtomo_label_data]
+                subtomo_labels_data[label_name] = subtomo_label_data
                 print("subtomo_max = ", np.max(subtomo_label_data))
-                subtomo_label_h5_internal_path = join(
-                    h5_internal_paths.LABELED_SUBTOMOGRAMS, label_name)
-                subtomo_label_h5_internal_path = join(
-                    subtomo_label_h5_internal_path,
-                    subtomo_name)
-                subtomo_label_h5_internal_path_list += [
-                    subtomo_label_h5_internal_path]
                 segmentation_max = np.max(
                     [segmentation_max, np.max(subtomo_label_data)])
             if segmentation_max > 0.5:
-                f[subtomo_raw_h5_internal_path] = subtomo_raw_data
-                for subtomo_label_h5_internal_path, subtomo_label_data in zip(
-                        subtomo_label_h5_internal_path_list,
-                        subtomo_label_data_list):
-                    f[subtomo_label_h5_internal_path] = subtomo_label_data
+                writer.write_subtomo(center=window_center,
+                                     raw_data=subtomo_raw_data,
+                                     labels_data=subtomo_labels_data)
             else:
                 print("subtomo ", subtomo_name, "discarded")
     return
@@ -472,86 +594,209 @@ def write_joint_raw_and_labels_subtomograms_dice_multiclass(
 def write_segmented_data(data_path: str, output_segmentation: np.array,
                          label_name: str) -> np.array:
     with h5py.File(data_path, 'a') as f:
-        for subtomo_indx, subtomo_name in enumerate(
-                list(f[h5_internal_paths.RAW_SUBTOMOGRAMS])):
-            segmented_subtomo_path = join(
-                h5_internal_paths.PREDICTED_SEGMENTATION_SUBTOMOGRAMS,
-                label_name)
-            subtomo_h5_internal_path = join(segmented_subtomo_path,
-                                            subtomo_name)
-            f[subtomo_h5_internal_path] = \
-                output_segmentation[subtomo_indx, :, :, :, :]
-
-
-def _check_segmentation_existence(data_file: h5py.File, label_name: str):
-    if 'predictions' in list(data_file['volumes']):
-        predictions = list(
-            data_file[h5_internal_paths.PREDICTED_SEGMENTATION_SUBTOMOGRAMS])
-        if label_name in predictions:
-            flag = 'segmentation_exists'
-        else:
-            flag = 'segmentation_nonexistent'
-    else:
-        flag = 'segmentation_nonexistent'
-    return flag
+        subtomo_keys = list_subtomos(f, h5_internal_paths.RAW_SUBTOMOGRAMS)
+        write_subtomo_predictions(data_file=f, label_name=label_name,
+                                  keys=subtomo_keys,
+                                  segmented_data=output_segmentation[:len(subtomo_keys)])
 
 
-def _get_subtomos_names_to_segment(file: h5py.File, label_name: str, flag: str):
-    if 'segmentation_nonexistent' == flag:
-        print("The segmentation", label_name, " does not exist yet.")
-        subtomo_names = list(file[h5_internal_paths.RAW_SUBTOMOGRAMS])
-        total_subtomos = len(subtomo_names)
-        predicted_subtomos_names = []
-    else:
-        print("The segmentation", label_name, " exists already.")
-        prediction_path = join(
-            h5_internal_paths.PREDICTED_SEGMENTATION_SUBTOMOGRAMS,
-            label_name)
-        predicted_subtomos_names = list(file[prediction_path])
-        subtomo_names = list(file[h5_internal_paths.RAW_SUBTOMOGRAMS])
-        total_subtomos = len(subtomo_names)
-    return predicted_subtomos_names, subtomo_names, total_subtomos
-
+def _read_subtomo_batches(data_file: h5py.File, subtomo_keys: list,
+                          batch_size: int, mean_value: float, std_value: float,
+                          batch_queue: queue.Queue, stop_event: threading.Event, errors: list):
+    """
+    Reader thread: reads and normalizes consecutive batches of raw
+    subtomograms and puts them, together with their keys, in batch_queue.
+    A final None is put in the queue once all batches were read.
+    """
+    try:
+        for start in range(0, len(subtomo_keys), batch_size):
+            if stop_event.is_set():
+                break
+            batch_keys = subtomo_keys[start:start + batch_size]
+            subtomo_data = read_subtomos(data_file, h5_internal_paths.RAW_SUBTOMOGRAMS, batch_keys)
+            # normalize the subtomograms with the data mean and std
+            subtomo_data = (subtomo_data - mean_value) / std_value
+            subtomo_data = subtomo_data[:, None]
+            batch_queue.put((batch_keys, subtomo_data))
+    except Exception as exception:
+        errors.append(exception)
+    finally:
+        batch_queue.put(None)
+
+
+def _write_segmented_batches(data_file: h5py.File, label_name: str,
+                             output_queue: queue.Queue, errors: list):
+    """
+    Writer thread: drains output_queue and writes each segmented subtomogram
+    into the partition file, until a None is received. In format 2, the
+    skipped subtomograms before each run of consecutive keys are filled with
+    BACKGROUND_LOGIT.
+    """
+    partition_format = get_partition_format(data_file)
+    while True:
+        item = output_queue.get()
+        if item is None:
+            break
+        if len(errors) > 0:
+            # keep draining the queue so that the producer never blocks
+            continue
+        batch_keys, segmented_data = item
+        try:
+            if partition_format == 1:
+                write_subtomo_predictions(data_file=data_file, label_name=label_name,
+                                          keys=batch_keys, segmented_data=segmented_data)
+            else:
+                for run in np.split(np.arange(len(batch_keys)), np.where(np.diff(batch_keys) != 1)[0] + 1):
+                    fill_subtomo_predictions(data_file=data_file, label_name=label_name,
+                                             stop_row=batch_keys[run[0]], row_shape=segmented_data.shape[1:],
+                                             dtype=segmented_data.dtype, fill=BACKGROUND_LOGIT)
+                    write_subtomo_predictions(data_file=data_file, label_name=label_name,
+                                              keys=[batch_keys[index] for index in run],
+                                              segmented_data=segmented_data[run])
+        except Exception as exception:
+            errors.append(exception)
+
+
+class SubtomoBatchReader:
+    """
+    Opens a partition file and starts reading the batches of raw
+    subtomograms to segment in a background thread (see
+    _read_subtomo_batches), so that the reading can start before the
+    segmentation, e.g. while the previous partition is being segmented.
+    The subtomograms to segment are listed as in segment_and_write, which
+    consumes the batches and closes the reader.
+    Arguments:
+      data_path: path to the partition .h5 file
+      label_name: name of the predictions set in the partition file
+      mean_value, std_value: used to normalize the subtomograms
+      batch_size: number of subtomograms per batch
+      prefetch_batches: maximum number of batches waiting in the queue
+      min_mask_fraction: see select_occupied_subtomos
+    """
 
-def segment_and_write(data_path: str, model: UNet3D, label_name: str, mean_value: float, std_value: float) -> None:
+    def __init__(self, data_path: str, label_name: str, mean_value: float, std_value: float,
+                 batch_size: int = 1, prefetch_batches: int = 2, min_mask_fraction: float = 0):
+        self.data_path = data_path
+        self.label_name = label_name
+        self.mean_value = mean_value
+        self.std_value = std_value
+        self.batch_size = batch_size
+        self.min_mask_fraction = min_mask_fraction
+        # opened for writing, so that the predictions can be written through
+        # the same handle
+        self.data_file = h5py.File(data_path, 'a')
+        subtomo_keys, self.total_subtomos = list_subtomos_to_segment(self.data_file, label_name)
+        self.subtomo_keys, self.skipped_keys = select_occupied_subtomos(data_file=self.data_file,
+                                                                        keys=subtomo_keys,
+                                                                        min_mask_fraction=min_mask_fraction)
+        self.batch_queue = queue.Queue(maxsize=prefetch_batches)
+        self.stop_event = threading.Event()
+        self.errors = []
+        self.thread = threading.Thread(target=_read_subtomo_batches,
+                                       args=(self.data_file, self.subtomo_keys, batch_size, mean_value,
+                                             std_value, self.batch_queue, self.stop_event, self.errors),
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        # unblock the reader in case it is waiting on a full queue
+        while self.thread.is_alive():
+            try:
+                self.batch_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    def close(self):
+        self.stop()
+        self.data_file.close()
+
+
+def segment_and_write(data_path: str, model: UNet3D, label_name: str, mean_value: float, std_value: float,
+                      batch_size: int = 1, prefetch_batches: int = 2,
+                      min_mask_fraction: float = 0, reader: SubtomoBatchReader or None = None) -> None:
+    """
+    Segments the raw subtomograms of a partition file and writes the
+    predictions under volumes/predictions/<label_name>. Subtomograms that are
+    already segmented are skipped, so that an interrupted job can be resumed.
+    Batches are read and normalized by a background reader thread while the
+    current batch goes through the network with autograd disabled, and the
+    predictions are written by a background writer thread. Subtomograms
+    whose fraction inside the region mask is up to min_mask_fraction (see
+    select_occupied_subtomos) do not go through the network: in format 2,
+    their predictions are filled with BACKGROUND_LOGIT, to keep the order
+    of the raw subtomograms.
+    :param data_path: path to the partition .h5 file
+    :param model: network used for the segmentation
+    :param label_name: name of the predictions set in the partition file
+    :param mean_value: mean used to normalize the subtomograms
+    :param std_value: standard deviation used to normalize the subtomograms
+    :param batch_size: number of subtomograms per forward pass
+    :param prefetch_batches: maximum number of batches waiting in the
+    reading and writing queues
+    :param min_mask_fraction: see select_occupied_subtomos
+    :param reader: optional SubtomoBatchReader of data_path already started,
+    e.g. while the previous partition was segmented. Its normalization,
+    batch size and min_mask_fraction are used instead of the ones above. It
+    is closed once the segmentation is finished.
+    """
     model = model.to(torch.float)
     device = get_device()
-    print("data_mean = {}, data_std = {}".format(mean_value, std_value))
-    with h5py.File(data_path, 'r') as data_file:
-        flag = _check_segmentation_existence(data_file, label_name)
-        predicted_subtomos_names, subtomo_names, total_subtomos = \
-            _get_subtomos_names_to_segment(data_file, label_name, flag)
-
-    with h5py.File(data_path, 'a') as data_file:
-        for index, subtomo_name in zip(tqdm(range(total_subtomos)), subtomo_names):
-            if subtomo_name not in predicted_subtomos_names:
-                # read the subtomogram
-                subtomo_h5_internal_path = join(h5_internal_paths.RAW_SUBTOMOGRAMS,
-                                                subtomo_name)
-                subtomo_data = data_file[subtomo_h5_internal_path][:]
-                subtomo_data = np.array([subtomo_data])
-                # normalize the subtomogram with the data mean and std
-                subtomo_data = (subtomo_data - mean_value) / std_value
-                subtomo_data = subtomo_data[:, None]
-                segmented_data = model(torch.from_numpy(subtomo_data).to(device).to(torch.float))
-                segmented_data = segmented_data.cpu().detach().numpy()
-                _write_segmented_subtomo_data(data_file=data_file,
-                                              segmented_data=segmented_data,
-                                              label_name=label_name,
-                                              subtomo_name=subtomo_name)
-    return
-
-
-def _write_segmented_subtomo_data(data_file: h5py.File,
-                                  segmented_data: np.array,
-                                  label_name: str,
-                                  subtomo_name: str):
-    subtomo_h5_internal_path = join(
-        h5_internal_paths.PREDICTED_SEGMENTATION_SUBTOMOGRAMS,
-        label_name)
-    subtomo_h5_internal_path = join(subtomo_h5_internal_path,
-                                    subtomo_name)
-    data_file[subtomo_h5_internal_path] = segmented_data[0, :, :, :, :]
+    if reader is None:
+        reader = SubtomoBatchReader(data_path=data_path, label_name=label_name, mean_value=mean_value,
+                                    std_value=std_value, batch_size=batch_size,
+                                    prefetch_batches=prefetch_batches, min_mask_fraction=min_mask_fraction)
+    assert os.path.abspath(reader.data_path) == os.path.abspath(data_path), \
+        "The reader was started for another partition: {}".format(reader.data_path)
+    assert reader.label_name == label_name, \
+        "The reader was started for another segmentation: {}".format(reader.label_name)
+    subtomo_keys = reader.subtomo_keys
+    errors = reader.errors
+    try:
+        print("data_mean = {}, data_std = {}".format(reader.mean_value, reader.std_value))
+        print("{} out of {} subtomograms to segment, batch_size = {}".format(len(subtomo_keys),
+                                                                            reader.total_subtomos,
+                                                                            reader.batch_size))
+        if len(reader.skipped_keys) > 0:
+            print(len(reader.skipped_keys), "subtomograms with a region mask fraction up to",
+                  reader.min_mask_fraction, "skipped")
+
+        output_queue = queue.Queue(maxsize=prefetch_batches)
+        start_time = time.time()
+        data_file = reader.data_file
+        writer = threading.Thread(target=_write_segmented_batches,
+                                  args=(data_file, label_name, output_queue, errors),
+                                  daemon=True)
+        writer.start()
+        try:
+            with tqdm(total=len(subtomo_keys)) as progress_bar, torch.inference_mode():
+                while True:
+                    item = reader.batch_queue.get()
+                    if item is None or len(errors) > 0:
+                        break
+                    batch_keys, subtomo_data = item
+                    segmented_data = model(torch.from_numpy(subtomo_data).to(device).to(torch.float))
+                    segmented_data = segmented_data.cpu().numpy()
+                    output_queue.put((batch_keys, segmented_data))
+                    progress_bar.update(len(batch_keys))
+        finally:
+            reader.stop()
+            output_queue.put(None)
+            writer.join()
+        prediction_path = join(h5_internal_paths.PREDICTED_SEGMENTATION_SUBTOMOGRAMS, label_name)
+        if len(errors) == 0 and get_partition_format(data_file) == 2 and prediction_path in data_file:
+            # the skipped subtomograms after the last segmented one
+            fill_subtomo_predictions(data_file=data_file, label_name=label_name, stop_row=reader.total_subtomos,
+                                     row_shape=data_file[prediction_path].shape[1:],
+                                     dtype=data_file[prediction_path].dtype, fill=BACKGROUND_LOGIT)
+    finally:
+        reader.close()
+    if len(errors) > 0:
+        raise errors[0]
+    elapsed_time = time.time() - start_time
+    if len(subtomo_keys) > 0 and elapsed_time > 0:
+        print("Segmented {} subtomograms in {:.1f} s ({:.2f} subtomograms/s)".format(
+            len(subtomo_keys), elapsed_time, len(subtomo_keys) / elapsed_time))
     return
 
 
@@ -614,9 +859,8 @@ def write_particle_mask_from_motl(path_to_motl: str,
             score_values = np.ones(len(coordinates))
 
         predicted_dataset = np.zeros(output_shape)
-        for center, value in zip(coordinates, score_values):
-            paste_sphere_in_dataset(dataset=predicted_dataset, center=center,
-                                    radius=sphere_radius, value=value)
+        paste_spheres_in_dataset(dataset=predicted_dataset, centers=coordinates,
+                                 radius=sphere_radius, values=score_values)
 
         if mask_extension == ".hdf":
             write_dataset_hdf(output_path=output_path,
@@ -688,13 +932,20 @@ def generate_particle_mask_from_motl(path_to_motl: str,
             score_values = np.ones(len(coordinates))
 
         predicted_dataset = np.zeros(output_shape)
-        for center, value in zip(coordinates, score_values):
-            paste_sphere_in_dataset(dataset=predicted_dataset, center=center,
-                                    radius=sphere_radius, value=value)
+        paste_spheres_in_dataset(dataset=predicted_dataset, centers=coordinates,
+                                 radius=sphere_radius, values=score_values)
 
     return predicted_dataset
 
 
+def _get_partition_writer(data_file: h5py.File,
+                          source_file: h5py.File) -> SubtomoWriter:
+    """Writer using the same partition format and compression as source_file."""
+    return SubtomoWriter(data_file,
+                         partition_format=get_partition_format(source_file),
+                         compression=get_partition_compression(source_file))
+
+
 def split_and_write_h5_partition(h5_partition_data_path: str,
                                  h5_train_patition_path: str,
                                  h5_test_patition_path: str,
@@ -702,13 +953,13 @@ def split_and_write_h5_partition(h5_partition_data_path: str,
                                  label_name="particles",
                                  shuffle=True) -> None:
     with h5py.File(h5_partition_data_path, 'r') as f:
-        raw_subtomo_names = list(f[h5_internal_paths.RAW_SUBTOMOGRAMS])
+        raw_subtomo_keys = list_subtomos(f, h5_internal_paths.RAW_SUBTOMOGRAMS)
         if shuffle:
-            random.shuffle(raw_subtomo_names)
+            random.shuffle(raw_subtomo_keys)
         else:
             print("Splitting sets without shuffling")
         if 0 < split < 1:
-            split = int(split * len(raw_subtomo_names))
+            split = int(split * len(raw_subtomo_keys))
             print("split = ", split)
         else:
             split = int(split)
@@ -716,61 +967,25 @@ def split_and_write_h5_partition(h5_partition_data_path: str,
             if split < 0:
                 print("All the subtomos are considered in the training set.")
                 with h5py.File(h5_train_patition_path, "w") as f_train:
-                    for subtomo_name in raw_subtomo_names:
-                        raw_subtomo_h5_internal_path \
-                            = join(h5_internal_paths.RAW_SUBTOMOGRAMS,
-                                   subtomo_name)
-                        data_raw_train = f[raw_subtomo_h5_internal_path][:]
-
-                        labels_subtomo_h5_internal_path = join(
-                            h5_internal_paths.LABELED_SUBTOMOGRAMS, label_name)
-                        labels_subtomo_h5_internal_path = join(
-                            labels_subtomo_h5_internal_path,
-                            subtomo_name)
-                        data_label_train = f[labels_subtomo_h5_internal_path][:]
-
-                        f_train[raw_subtomo_h5_internal_path] = data_raw_train
-                        f_train[
-                            labels_subtomo_h5_internal_path] = data_label_train
+                    copy_partition_subtomos(input_file=f,
+                                            writer=_get_partition_writer(f_train, f),
+                                            keys=raw_subtomo_keys,
+                                            label_names=[label_name])
                 print("The training set has been written in ",
                       h5_train_patition_path)
             else:
                 with h5py.File(h5_train_patition_path, "w") as f_train:
-                    for subtomo_name in raw_subtomo_names[:split]:
-                        raw_subtomo_h5_internal_path \
-                            = join(h5_internal_paths.RAW_SUBTOMOGRAMS,
-                                   subtomo_name)
-                        data_raw_train = f[raw_subtomo_h5_internal_path][:]
-
-                        labels_subtomo_h5_internal_path = join(
-                            h5_internal_paths.LABELED_SUBTOMOGRAMS, label_name)
-                        labels_subtomo_h5_internal_path = join(
-                            labels_subtomo_h5_internal_path,
-                            subtomo_name)
-                        data_label_train = f[labels_subtomo_h5_internal_path][:]
-
-                        f_train[raw_subtomo_h5_internal_path] = data_raw_train
-                        f_train[
-                            labels_subtomo_h5_internal_path] = data_label_train
+                    copy_partition_subtomos(input_file=f,
+                                            writer=_get_partition_writer(f_train, f),
+                                            keys=raw_subtomo_keys[:split],
+                                            label_names=[label_name])
                 print("The training set has been written in ",
                       h5_train_patition_path)
                 with h5py.File(h5_test_patition_path, "w") as f_test:
-                    for subtomo_name in raw_subtomo_names[split:]:
-                        raw_subtomo_h5_internal_path \
-                            = join(h5_internal_paths.RAW_SUBTOMOGRAMS,
-                                   subtomo_name)
-                        data_raw_test = f[raw_subtomo_h5_internal_path][:]
-
-                        labels_subtomo_h5_internal_path = join(
-                            h5_internal_paths.LABELED_SUBTOMOGRAMS, label_name)
-                        labels_subtomo_h5_internal_path = join(
-                            labels_subtomo_h5_internal_path,
-                            subtomo_name)
-                        data_label_test = f[labels_subtomo_h5_internal_path][:]
-
-                        f_test[raw_subtomo_h5_internal_path] = data_raw_test
-                        f_test[
-                            labels_subtomo_h5_internal_path] = data_label_test
+                    copy_partition_subtomos(input_file=f,
+                                            writer=_get_partition_writer(f_test, f),
+                                            keys=raw_subtomo_keys[split:],
+                                            label_names=[label_name])
                 print("The testing set has been written in ",
                       h5_test_patition_path)
     return
@@ -783,41 +998,23 @@ def split_and_write_h5_partition_dice_multi_class(h5_partition_data_path: str,
                                                   segmentation_names: list,
                                                   shuffle=True) -> None:
     with h5py.File(h5_partition_data_path, 'r') as f:
-        raw_subtomo_names = list(f[h5_internal_paths.RAW_SUBTOMOGRAMS])
+        raw_subtomo_keys = list_subtomos(f, h5_internal_paths.RAW_SUBTOMOGRAMS)
         if shuffle:
-            random.shuffle(raw_subtomo_names)
+            random.shuffle(raw_subtomo_keys)
         else:
             print("Splitting sets without shuffling")
-        split = int(split * len(raw_subtomo_names))
+        split = int(split * len(raw_subtomo_keys))
         with h5py.File(h5_train_patition_path, "w") as f_train:
-            for subtomo_name in raw_subtomo_names[:split]:
-                raw_subtomo_h5_internal_path \
-                    = join(h5_internal_paths.RAW_SUBTOMOGRAMS, subtomo_name)
-                data_raw_train = f[raw_subtomo_h5_internal_path][:]
-                f_train[raw_subtomo_h5_internal_path] = data_raw_train
-                for label_name in segmentation_names:
-                    labels_subtomo_h5_internal_path = join(
-                        h5_internal_paths.LABELED_SUBTOMOGRAMS, label_name)
-                    labels_subtomo_h5_internal_path = join(
-                        labels_subtomo_h5_internal_path,
-                        subtomo_name)
-                    data_label_train = f[labels_subtomo_h5_internal_path][:]
-                    f_train[labels_subtomo_h5_internal_path] = data_label_train
+            copy_partition_subtomos(input_file=f,
+                                    writer=_get_partition_writer(f_train, f),
+                                    keys=raw_subtomo_keys[:split],
+                                    label_names=segmentation_names)
 
         with h5py.File(h5_test_patition_path, "w") as f_test:
-            for subtomo_name in raw_subtomo_names[split:]:
-                raw_subtomo_h5_internal_path = join(
-                    h5_internal_paths.RAW_SUBTOMOGRAMS, subtomo_name)
-                data_raw_test = f[raw_subtomo_h5_internal_path][:]
-                f_test[raw_subtomo_h5_internal_path] = data_raw_test
-                for label_name in segmentation_names:
-                    labels_subtomo_h5_internal_path = join(
-                        h5_internal_paths.LABELED_SUBTOMOGRAMS, label_name)
-                    labels_subtomo_h5_internal_path = join(
-                        labels_subtomo_h5_internal_path,
-                        subtomo_name)
-                    data_label_test = f[labels_subtomo_h5_internal_path][:]
-                    f_test[labels_subtomo_h5_internal_path] = data_label_test
+            copy_partition_subtomos(input_file=f,
+                                    writer=_get_partition_writer(f_test, f),
+                                    keys=raw_subtomo_keys[split:],
+                                    label_names=segmentation_names)
     return
 
 
@@ -827,21 +1024,21 @@ def write_strongly_labeled_subtomograms(output_path: str,
                                         segmentation_names: list,
                                         window_centers: list,
                                         crop_shape: tuple,
-                                        min_label_fraction: float = 0):
+                                        min_label_fraction: float = 0,
+                                        partition_format: int = 1,
+                                        compression: str or None = None):
     with h5py.File(output_path, 'w') as f:
+        writer = SubtomoWriter(f, partition_format=partition_format,
+                               compression=compression)
         for window_center in window_centers:
             print("window_center", window_center)
             subtomo_name = "subtomo_{0}".format(str(window_center))
-            subtomo_raw_h5_internal_path = join(
-                h5_internal_paths.RAW_SUBTOMOGRAMS,
-                subtomo_name)
             subtomo_raw_data = crop_window_around_point(
                 input_array=padded_raw_dataset,
                 crop_shape=crop_shape,
                 window_center=window_center)
             volume = crop_shape[0] * crop_shape[1] * crop_shape[2]
-            subtomo_label_data_list = []
-            subtomo_label_h5_internal_path_list = []
+            subtomo_labels_data = {}
             segmentation_max = 0
             label_fraction = 0
             # Getting label channels for our current raw subtomo
@@ -851,15 +1048,8 @@ def write_strongly_labeled_subtomograms(output_path: str,
                     input_array=padded_label,
                     crop_shape=crop_shape,
                     window_center=window_center)
-                subtomo_label_data_list += [subtomo_label_data]
+                subtomo_labels_data[label_name] = subtomo_label_data
                 print("subtomo_max = ", np.max(subtomo_label_data))
-                subtomo_label_h5_internal_path = join(
-                    h5_internal_paths.LABELED_SUBTOMOGRAMS, label_name)
-                subtomo_label_h5_internal_path = join(
-                    subtomo_label_h5_internal_path,
-                    subtomo_name)
-                subtomo_label_h5_internal_path_list += [
-                    subtomo_label_h5_internal_path]
                 segmentation_max = np.max(
                     [segmentation_max, np.max(subtomo_label_data)])
                 label_indicator = np.where(subtomo_label_data > 0)
@@ -870,13 +1060,11 @@ def write_strongly_labeled_subtomograms(output_path: str,
             print("window_center, label_fraction", window_center,
                   label_fraction)
             if segmentation_max > 0.5 and label_fraction > min_label_fraction:
-                print("Saving window_center, subtomo_raw_h5_internal_path",
-                      window_center, subtomo_raw_h5_internal_path)
-                f[subtomo_raw_h5_internal_path] = subtomo_raw_data
-                for subtomo_label_h5_internal_path, subtomo_label_data in zip(
-                        subtomo_label_h5_internal_path_list,
-                        subtomo_label_data_list):
-                    f[subtomo_label_h5_internal_path] = subtomo_label_data
+                print("Saving window_center, subtomo_name",
+                      window_center, subtomo_name)
+                writer.write_subtomo(center=window_center,
+                                     raw_data=subtomo_raw_data,
+                                     labels_data=subtomo_labels_data)
             else:
                 print("subtomo ", subtomo_name, "discarded")
     return
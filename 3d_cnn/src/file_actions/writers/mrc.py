@@ -8,3 +8,42 @@ def write_mrc_dataset(mrc_path: str, array: np.array, dtype="float32"):
         mrc.set_data(array)
     print("Dataset saved in", mrc_path)
     return
+
+
+def new_mrc_mmap(mrc_path: str, shape: tuple, fill: float or None = None):
+    """
+    Creates a float32 .mrc file of the given shape and opens it as a memory
+    map, so that it can be written region by region without holding the
+    whole tomogram in memory.
+    :param mrc_path: output .mrc path (overwritten if it exists)
+    :param shape: (z, y, x) shape of the tomogram
+    :param fill: optional initial value for all voxels
+    :return: an open mrcfile.mrcmemmap.MrcMemmap, to be closed by the caller
+    (preferably through update_mrc_header_stats_and_close)
+    """
+    return mrcfile.new_mmap(mrc_path, shape=tuple(shape), mrc_mode=2, fill=fill, overwrite=True)
+
+
+def update_mrc_header_stats_and_close(mrc, slab_size: int = 32):
+    """
+    Sets the dmin, dmax, dmean and rms header fields of an open memory mapped
+    .mrc file, computing them slab by slab along z (mrcfile's own
+    update_header_stats makes full size temporary copies), and closes it.
+    """
+    data = mrc.data
+    dmin, dmax = np.inf, -np.inf
+    total, total_squares = 0.0, 0.0
+    for z in range(0, data.shape[0], slab_size):
+        slab = np.asarray(data[z:z + slab_size], dtype=np.float64)
+        dmin = min(dmin, slab.min())
+        dmax = max(dmax, slab.max())
+        total += slab.sum()
+        total_squares += np.square(slab).sum()
+    if data.size > 0:
+        mean = total / data.size
+        mrc.header.dmin = np.float32(dmin)
+        mrc.header.dmax = np.float32(dmax)
+        mrc.header.dmean = np.float32(mean)
+        mrc.header.rms = np.float32(np.sqrt(max(total_squares / data.size - mean ** 2, 0)))
+    mrc.close()
+    return
@@ -0,0 +1,305 @@
+from os.path import join
+
+import h5py
+import numpy as np
+
+from constants import h5_internal_paths
+from file_actions.readers.partition import get_partition_compression, \
+    get_partition_format, get_subtomo_center, get_subtomo_name, \
+    list_subtomos, read_subtomo
+
+PARTITION_FORMATS = [1, 2]
+PARTITION_COMPRESSIONS = [None, "gzip", "lzf", "lz4"]
+
+
+def get_compression_options(compression: str or None) -> dict:
+    """
+    Keyword arguments for h5py create_dataset for the given compression.
+    lz4 needs the hdf5plugin package.
+    """
+    assert compression in PARTITION_COMPRESSIONS, \
+        "compression should be one of {}".format(PARTITION_COMPRESSIONS)
+    if compression is None:
+        return {}
+    elif compression == "gzip":
+        return {"compression": "gzip", "compression_opts": 4}
+    elif compression == "lzf":
+        return {"compression": "lzf"}
+    else:
+        try:
+            import hdf5plugin
+        except ImportError:
+            raise ImportError("lz4 compression of partition files needs the hdf5plugin package "
+                              "(pip install hdf5plugin)")
+        return dict(hdf5plugin.LZ4())
+
+
+def _get_rows_dataset(data_file: h5py.File, internal_path: str,
+                      row_shape: tuple, dtype, compression: str or None) -> h5py.Dataset:
+    """
+    Resizable dataset of rows of shape row_shape, chunked one row per chunk,
+    created empty in internal_path if needed.
+    """
+    if internal_path not in data_file:
+        data_file.create_dataset(internal_path, shape=(0,) + tuple(row_shape),
+                                 maxshape=(None,) + tuple(row_shape),
+                                 chunks=(1,) + tuple(row_shape), dtype=dtype,
+                                 **get_compression_options(compression))
+    return data_file[internal_path]
+
+
+def _append_rows(dataset: h5py.Dataset, data: np.array):
+    rows = dataset.shape[0]
+    dataset.resize(rows + data.shape[0], axis=0)
+    dataset[rows:] = data
+    return
+
+
+class SubtomoWriter:
+    """
+    Writes subtomograms (raw data, and optionally labels) into an open
+    partition file, in format 1 (one dataset per subtomogram, named after
+    its box center) or format 2 (one chunked (N, D, H, W) dataset per volume
+    type, with the box centers in volumes/coordinates). Compression is only
+    used in format 2.
+    """
+
+    def __init__(self, data_file: h5py.File, partition_format: int = 1,
+                 compression: str or None = None):
+        assert partition_format in PARTITION_FORMATS, \
+            "partition_format should be one of {}".format(PARTITION_FORMATS)
+        if h5_internal_paths.RAW_SUBTOMOGRAMS in data_file:
+            assert get_partition_format(data_file) == partition_format, \
+                "Cannot append format {} subtomograms to a format {} partition".format(
+                    partition_format, get_partition_format(data_file))
+        self.data_file = data_file
+        self.partition_format = partition_format
+        self.compression = compression
+        self._datasets = {}
+        if partition_format == 2:
+            get_compression_options(compression)
+            data_file.attrs[h5_internal_paths.PARTITION_FORMAT_ATTRIBUTE] = 2
+            data_file.attrs[h5_internal_paths.PARTITION_COMPRESSION_ATTRIBUTE] = \
+                compression if compression is not None else ""
+
+    def write_subtomo(self, center, raw_data: np.array,
+                      labels_data: dict or None = None,
+                      subtomo_name: str or None = None):
+        """
+        :param center: box center of the subtomogram in the padded tomogram
+        :param raw_data: raw subtomogram
+        :param labels_data: dictionary {label_name: label subtomogram}
+        :param subtomo_name: format 1 dataset name, by default
+        subtomo_<center>
+        """
+        if labels_data is None:
+            labels_data = {}
+        if self.partition_format == 1:
+            if subtomo_name is None:
+                subtomo_name = "subtomo_{0}".format(str(center))
+            self.data_file[join(h5_internal_paths.RAW_SUBTOMOGRAMS, subtomo_name)] = raw_data
+            for label_name, label_data in labels_data.items():
+                self.data_file[join(h5_internal_paths.LABELED_SUBTOMOGRAMS, label_name, subtomo_name)] = label_data
+        else:
+            self._append_row(h5_internal_paths.SUBTOMOGRAM_COORDINATES,
+                             np.array(center, dtype=np.int32), compression=None)
+            self._append_row(h5_internal_paths.RAW_SUBTOMOGRAMS, raw_data, self.compression)
+            for label_name, label_data in labels_data.items():
+                self._append_row(join(h5_internal_paths.LABELED_SUBTOMOGRAMS, label_name),
+                                 label_data, self.compression)
+        return
+
+    def write_subtomos(self, centers: list, raw_data: list or np.array,
+                       labels_data: dict or None = None):
+        """
+        Writes several subtomograms at once, in format 2 with a single
+        resize and write of each dataset.
+        :param centers: box centers of the subtomograms in the padded tomogram
+        :param raw_data: raw subtomograms
+        :param labels_data: dictionary {label_name: label subtomograms}
+        """
+        if labels_data is None:
+            labels_data = {}
+        if len(centers) == 0:
+            return
+        if self.partition_format == 1:
+            for index, center in enumerate(centers):
+                self.write_subtomo(center=center, raw_data=raw_data[index],
+                                   labels_data={label_name: label_data[index]
+                                                for label_name, label_data in labels_data.items()})
+        else:
+            self._append_rows(h5_internal_paths.SUBTOMOGRAM_COORDINATES,
+                              np.array(centers, dtype=np.int32), compression=None)
+            self._append_rows(h5_internal_paths.RAW_SUBTOMOGRAMS, np.stack(raw_data), self.compression)
+            for label_name, label_data in labels_data.items():
+                self._append_rows(join(h5_internal_paths.LABELED_SUBTOMOGRAMS, label_name),
+                                  np.stack(label_data), self.compression)
+        return
+
+    def _append_row(self, internal_path: str, data: np.array,
+                    compression: str or None):
+        self._append_rows(internal_path, np.asarray(data)[None], compression)
+        return
+
+    def _append_rows(self, internal_path: str, data: np.array,
+                     compression: str or None):
+        # The dataset handles are kept, since looking them up in the file for
+        # each subtomogram costs as much as writing it
+        if internal_path not in self._datasets:
+            self._datasets[internal_path] = _get_rows_dataset(self.data_file, internal_path, data.shape[1:],
+                                                              data.dtype, compression)
+        _append_rows(self._datasets[internal_path], data)
+        return
+
+
+def write_subtomo_predictions(data_file: h5py.File, label_name: str,
+                              keys: list, segmented_data: np.array):
+    """
+    Writes the predictions segmented_data (M, C, D, H, W) of the subtomograms
+    with the given keys under volumes/predictions/<label_name>. In format 2,
+    predictions are written in the order of the raw subtomograms, so keys
+    must be the consecutive rows following the ones already predicted.
+    """
+    prediction_path = join(h5_internal_paths.PREDICTED_SEGMENTATION_SUBTOMOGRAMS, label_name)
+    if get_partition_format(data_file) == 1:
+        for key, subtomo_data in zip(keys, segmented_data):
+            data_file[join(prediction_path, key)] = subtomo_data
+    else:
+        predicted_rows = data_file[prediction_path].shape[0] if prediction_path in data_file else 0
+        assert list(keys) == list(range(predicted_rows, predicted_rows + len(keys))), \
+            "Predictions should be written in the order of the raw subtomograms"
+        segmented_data = np.asarray(segmented_data)
+        dataset = _get_rows_dataset(data_file, prediction_path, segmented_data.shape[1:],
+                                    segmented_data.dtype, compression=get_partition_compression(data_file))
+        _append_rows(dataset, segmented_data)
+    return
+
+
+def fill_subtomo_predictions(data_file: h5py.File, label_name: str,
+                             stop_row: int, row_shape: tuple, dtype,
+                             fill: float):
+    """
+    Format 2: writes predictions filled with fill for the rows following
+    the ones already predicted, up to stop_row (excluded), e.g. for the
+    subtomograms skipped by the segmentation, so that the predictions stay
+    in the order of the raw subtomograms.
+    """
+    prediction_path = join(h5_internal_paths.PREDICTED_SEGMENTATION_SUBTOMOGRAMS, label_name)
+    predicted_rows = data_file[prediction_path].shape[0] if prediction_path in data_file else 0
+    if stop_row > predicted_rows:
+        write_subtomo_predictions(data_file=data_file, label_name=label_name,
+                                  keys=list(range(predicted_rows, stop_row)),
+                                  segmented_data=np.full((stop_row - predicted_rows,) + tuple(row_shape),
+                                                         fill_value=fill, dtype=dtype))
+    return
+
+
+def write_tile_occupancy(data_file: h5py.File, centers: list,
+                         mask_fractions: np.array, min_mask_fraction: float):
+    """
+    Writes the tile occupancy index of a prediction partition: the box
+    centers of all the tiles of the padded tomogram and the fraction of each
+    tile inside the region mask. Only the tiles whose fraction is above
+    min_mask_fraction are stored in the partition, and the segmentation and
+    the assembly can skip more of them with a larger fraction (see
+    select_occupied_subtomos).
+    """
+    for internal_path in [h5_internal_paths.TILE_OCCUPANCY_CENTERS,
+                          h5_internal_paths.TILE_OCCUPANCY_MASK_FRACTIONS]:
+        if internal_path in data_file:
+            del data_file[internal_path]
+    data_file[h5_internal_paths.TILE_OCCUPANCY_CENTERS] = np.array(centers, dtype=np.int32).reshape(-1, 3)
+    data_file[h5_internal_paths.TILE_OCCUPANCY_MASK_FRACTIONS] = np.asarray(mask_fractions, dtype=np.float64)
+    data_file[h5_internal_paths.TILE_OCCUPANCY_MASK_FRACTIONS].attrs[
+        h5_internal_paths.TILE_OCCUPANCY_MIN_FRACTION_ATTRIBUTE] = min_mask_fraction
+    return
+
+
+def copy_partition_subtomos(input_file: h5py.File, writer: SubtomoWriter,
+                            keys: list, label_names: list):
+    """
+    Copies the raw data and labels of the subtomograms with the given keys
+    from an open partition file into another one.
+    """
+    for key in keys:
+        raw_data = read_subtomo(input_file, h5_internal_paths.RAW_SUBTOMOGRAMS, key)
+        labels_data = {label_name: read_subtomo(input_file, join(h5_internal_paths.LABELED_SUBTOMOGRAMS, label_name),
+                                                key)
+                       for label_name in label_names}
+        writer.write_subtomo(center=get_subtomo_center(input_file, key),
+                             raw_data=raw_data, labels_data=labels_data,
+                             subtomo_name=get_subtomo_name(input_file, key))
+    return
+
+
+def merge_partition_shards(output_path: str, shard_paths: list,
+                           partition_format: int = 1,
+                           compression: str or None = None):
+    """
+    Writes the subtomograms of several partition files (shards), in order,
+    into a new partition file. The stored data is copied as is, without
+    decoding it: with h5py copy in format 1, and chunk by chunk in format 2,
+    where the shards and the output have the same one-row chunks and
+    compression.
+    """
+    with h5py.File(output_path, 'w') as f:
+        SubtomoWriter(f, partition_format=partition_format, compression=compression)
+        for shard_path in shard_paths:
+            with h5py.File(shard_path, 'r') as shard:
+                datasets = []
+                shard.visititems(lambda name, item: datasets.append(name)
+                                 if isinstance(item, h5py.Dataset) else None)
+                for name in datasets:
+                    if partition_format == 1:
+                        group_path, dataset_name = name.rsplit("/", 1)
+                        shard.copy(shard[name], f.require_group(group_path), name=dataset_name)
+                    else:
+                        _copy_rows(shard[name], f, name)
+    return
+
+
+def _copy_rows(source: h5py.Dataset, data_file: h5py.File, internal_path: str):
+    compression = get_partition_compression(data_file) \
+        if internal_path != h5_internal_paths.SUBTOMOGRAM_COORDINATES else None
+    dataset = _get_rows_dataset(data_file, internal_path, source.shape[1:], source.dtype, compression)
+    rows = dataset.shape[0]
+    dataset.resize(rows + source.shape[0], axis=0)
+    chunk_offset = (0,) * (source.ndim - 1)
+    for row in range(source.shape[0]):
+        filter_mask, chunk = source.id.read_direct_chunk((row,) + chunk_offset)
+        dataset.id.write_direct_chunk((rows + row,) + chunk_offset, chunk, filter_mask)
+    return
+
+
+def convert_partition_to_v2(input_path: str, output_path: str,
+                            compression: str or None = None):
+    """
+    Converts a format 1 partition file into format 2, keeping the order in
+    which format 1 lists its subtomograms. Raw data, labels and predictions
+    are converted; predictions are only kept for the leading subtomograms
+    that were all segmented, the rest can be segmented again on the new
+    file. The tile occupancy index is copied as is.
+    """
+    with h5py.File(input_path, 'r') as f:
+        assert get_partition_format(f) == 1, "{} is not a format 1 partition".format(input_path)
+        keys = list_subtomos(f, h5_internal_paths.RAW_SUBTOMOGRAMS)
+        label_names = list(f[h5_internal_paths.LABELED_SUBTOMOGRAMS]) \
+            if h5_internal_paths.LABELED_SUBTOMOGRAMS in f else []
+        prediction_names = list(f[h5_internal_paths.PREDICTED_SEGMENTATION_SUBTOMOGRAMS]) \
+            if h5_internal_paths.PREDICTED_SEGMENTATION_SUBTOMOGRAMS in f else []
+        with h5py.File(output_path, 'w') as f_out:
+            writer = SubtomoWriter(f_out, partition_format=2, compression=compression)
+            copy_partition_subtomos(input_file=f, writer=writer, keys=keys, label_names=label_names)
+            for prediction_name in prediction_names:
+                prediction_path = join(h5_internal_paths.PREDICTED_SEGMENTATION_SUBTOMOGRAMS, prediction_name)
+                predicted_keys = set(list_subtomos(f, prediction_path))
+                for row, key in enumerate(keys):
+                    if key not in predicted_keys:
+                        print("Predictions", prediction_name, "kept for the first", row, "subtomograms")
+                        break
+                    write_subtomo_predictions(data_file=f_out, label_name=prediction_name, keys=[row],
+                                              segmented_data=read_subtomo(f, prediction_path, key)[None])
+            if h5_internal_paths.TILE_OCCUPANCY_MASK_FRACTIONS in f:
+                f.copy(f[h5_internal_paths.TILE_OCCUPANCY_CENTERS].parent, f_out)
+    print("Partition", input_path, "converted to format 2 in", output_path)
+    return
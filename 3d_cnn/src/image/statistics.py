@@ -0,0 +1,158 @@
+import json
+import os
+import warnings
+
+import numpy as np
+
+from file_actions.readers.tomograms import open_tomogram
+
+STATISTICS_CACHE_SUFFIX = ".stats.json"
+CHUNK_VOXELS = 2 ** 24
+HISTOGRAM_BINS = 2 ** 16
+
+
+def get_statistics_cache_path(path_to_dataset: str) -> str:
+    return path_to_dataset + STATISTICS_CACHE_SUFFIX
+
+
+def _get_file_key(path_to_dataset: str) -> dict:
+    file_stat = os.stat(path_to_dataset)
+    return {"path": os.path.abspath(path_to_dataset), "size": file_stat.st_size,
+            "mtime_ns": file_stat.st_mtime_ns}
+
+
+def _read_cache(cache_path: str, file_key: dict) -> dict:
+    """
+    Cached statistics of the regions of a tomogram, empty if there is no
+    cache or if the tomogram changed since it was written.
+    """
+    try:
+        with open(cache_path, 'r') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if any(cache.get(key) != value for key, value in file_key.items()):
+        return {}
+    return cache.get("regions", {})
+
+
+def _write_cache(cache_path: str, file_key: dict, regions: dict):
+    # written to a temporary file first, so that concurrent jobs never read
+    # half a cache
+    temporary_path = cache_path + ".{}.tmp".format(os.getpid())
+    try:
+        with open(temporary_path, 'w') as f:
+            json.dump(dict(file_key, regions=regions), f, indent=1)
+        os.replace(temporary_path, cache_path)
+    except OSError as exception:
+        warnings.warn("Could not write the statistics cache {} ({})".format(cache_path, exception))
+    return
+
+
+def _iterate_chunks(dataset, z_range: tuple):
+    z_start, z_stop = z_range
+    slices_per_chunk = max(CHUNK_VOXELS // max(int(np.prod(dataset.shape[1:])), 1), 1)
+    for z in range(z_start, z_stop, slices_per_chunk):
+        yield np.array(dataset[z:min(z + slices_per_chunk, z_stop)], dtype=np.float64)
+
+
+def _compute_moments(dataset, z_range: tuple) -> dict:
+    """
+    Mean and standard deviation in a single pass over the z-chunks of the
+    dataset, combining the float64 mean and sum of squared deviations of
+    each chunk (Chan et al.).
+    """
+    count, mean, squared_deviations = 0, 0., 0.
+    minimum, maximum = np.inf, -np.inf
+    for chunk in _iterate_chunks(dataset, z_range):
+        chunk_count = chunk.size
+        if chunk_count == 0:
+            continue
+        chunk_mean = np.mean(chunk)
+        minimum = min(minimum, float(np.min(chunk)))
+        maximum = max(maximum, float(np.max(chunk)))
+        chunk = chunk.ravel()
+        chunk -= chunk_mean
+        chunk_squared_deviations = np.dot(chunk, chunk)
+        total_count = count + chunk_count
+        delta = chunk_mean - mean
+        mean += delta * chunk_count / total_count
+        squared_deviations += chunk_squared_deviations + delta ** 2 * count * chunk_count / total_count
+        count = total_count
+    assert count > 0, "Empty tomogram region"
+    return {"count": count, "mean": float(mean), "std": float(np.sqrt(squared_deviations / count)),
+            "min": minimum, "max": maximum}
+
+
+def _compute_percentiles(dataset, z_range: tuple, statistics: dict,
+                         percentiles: list) -> dict:
+    """
+    Percentiles interpolated in a histogram of HISTOGRAM_BINS bins between
+    the minimum and the maximum, accurate to (max - min) / HISTOGRAM_BINS.
+    """
+    minimum, maximum = statistics["min"], statistics["max"]
+    if minimum == maximum:
+        return {str(percentile): minimum for percentile in percentiles}
+    bin_edges = np.linspace(minimum, maximum, HISTOGRAM_BINS + 1)
+    histogram = np.zeros(HISTOGRAM_BINS, dtype=np.int64)
+    for chunk in _iterate_chunks(dataset, z_range):
+        histogram += np.histogram(chunk, bins=bin_edges)[0]
+    cumulative_histogram = np.cumsum(histogram)
+    values = dict()
+    for percentile in percentiles:
+        rank = percentile / 100 * (statistics["count"] - 1)
+        bin_index = min(int(np.searchsorted(cumulative_histogram, rank, side="right")), HISTOGRAM_BINS - 1)
+        previous_count = cumulative_histogram[bin_index - 1] if bin_index > 0 else 0
+        fraction = (rank - previous_count) / max(histogram[bin_index], 1)
+        bin_width = bin_edges[bin_index + 1] - bin_edges[bin_index]
+        values[str(percentile)] = float(bin_edges[bin_index] + np.clip(fraction, 0, 1) * bin_width)
+    return values
+
+
+def get_tomogram_statistics(path_to_dataset: str, percentiles: list or tuple = (),
+                            z_range: tuple or None = None, use_cache: bool = True) -> dict:
+    """
+    Normalization statistics of a tomogram, or of its slices
+    z_range[0] <= z < z_range[1], computed in a streaming pass over the
+    memory-mapped file. The statistics are cached in the sidecar file
+    <path_to_dataset>.stats.json. The cache is ignored if the path, size or
+    modification time of the tomogram changed.
+    :param path_to_dataset: .mrc, .rec, .hdf or .em tomogram
+    :param percentiles: percentiles (between 0 and 100) to compute, in a
+    second pass
+    :param z_range: (z_start, z_stop), by default the whole tomogram
+    :param use_cache: whether to read and write the sidecar file
+    :return: dictionary with count, mean, std, min, max and, if percentiles
+    were asked, percentiles {str(percentile): value}
+    """
+    file_key = _get_file_key(path_to_dataset)
+    cache_path = get_statistics_cache_path(path_to_dataset)
+    regions = _read_cache(cache_path, file_key) if use_cache else {}
+    region_name = "all" if z_range is None else "{}:{}".format(*z_range)
+    statistics = regions.get(region_name, {})
+    missing_percentiles = [percentile for percentile in percentiles
+                           if str(percentile) not in statistics.get("percentiles", {})]
+    if "mean" in statistics and len(missing_percentiles) == 0:
+        print("Statistics of {} read from {}".format(path_to_dataset, cache_path))
+        return statistics
+
+    with open_tomogram(path_to_dataset) as dataset:
+        region = (0, dataset.shape[0]) if z_range is None else tuple(z_range)
+        if "mean" not in statistics:
+            statistics = _compute_moments(dataset, region)
+        if len(missing_percentiles) > 0:
+            statistics["percentiles"] = dict(statistics.get("percentiles", {}),
+                                             **_compute_percentiles(dataset, region, statistics,
+                                                                    missing_percentiles))
+    if use_cache:
+        regions = _read_cache(cache_path, file_key)
+        regions[region_name] = statistics
+        _write_cache(cache_path, file_key, regions)
+    return statistics
+
+
+def get_tomogram_mean_std(path_to_dataset: str, z_range: tuple or None = None,
+                          use_cache: bool = True) -> tuple:
+    statistics = get_tomogram_statistics(path_to_dataset=path_to_dataset, z_range=z_range,
+                                         use_cache=use_cache)
+    return statistics["mean"], statistics["std"]
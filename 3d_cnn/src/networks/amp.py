@@ -0,0 +1,32 @@
+import contextlib
+
+import torch
+
+AMP_MODES = [None, "bf16", "fp16"]
+
+
+def get_autocast(device, amp: str or None = None):
+    """
+    Context for the forward passes of the network: autocast to bfloat16
+    ("bf16") or float16 ("fp16") mixed precision, or plain float32 if amp is
+    None.
+    """
+    assert amp in AMP_MODES, "amp should be one of {}".format(AMP_MODES)
+    if amp is None:
+        return contextlib.nullcontext()
+    dtype = torch.bfloat16 if amp == "bf16" else torch.float16
+    return torch.autocast(device_type=torch.device(device).type, dtype=dtype)
+
+
+def get_grad_scaler(device, amp: str or None = None):
+    """
+    Loss scaler for float16 training, which would otherwise lose the small
+    gradients. None for bf16 and float32, that have the float32 range.
+    """
+    assert amp in AMP_MODES, "amp should be one of {}".format(AMP_MODES)
+    if amp != "fp16":
+        return None
+    device_type = torch.device(device).type
+    if hasattr(torch.amp, "GradScaler"):
+        return torch.amp.GradScaler(device_type)
+    return torch.cuda.amp.GradScaler(enabled=device_type == "cuda")
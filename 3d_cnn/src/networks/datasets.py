@@ -0,0 +1,215 @@
+import os
+from os.path import join
+
+import h5py
+import numpy as np
+import torch
+import torch.utils.data as du
+
+from constants import h5_internal_paths
+from file_actions.readers.partition import get_subtomo_name, list_subtomos, \
+    read_subtomo
+from networks.distributed import get_distributed_sampler, get_rank, \
+    is_distributed
+from tomogram_utils.volume_actions.actions import _chunkify_list, \
+    split_subtomo_keys
+
+
+def _read_labels(data_file: h5py.File, key: str or int,
+                 segmentation_names: list) -> np.array:
+    return np.array([read_subtomo(data_file, join(h5_internal_paths.LABELED_SUBTOMOGRAMS, label_name), key)
+                     for label_name in segmentation_names])
+
+
+def _combine_statistics(statistics: list) -> tuple:
+    """
+    Mean and standard deviation of the union of several sets of values,
+    given the (number of values, mean, sum of squared deviations) of each.
+    """
+    counts = np.array([count for count, _, _ in statistics], dtype=np.float64)
+    means = np.array([mean for _, mean, _ in statistics], dtype=np.float64)
+    squared_deviations = np.array([deviations for _, _, deviations in statistics], dtype=np.float64)
+    total_mean = np.sum(counts * means) / np.sum(counts)
+    total_deviations = np.sum(squared_deviations) + np.sum(counts * (means - total_mean) ** 2)
+    return total_mean, np.sqrt(total_deviations / np.sum(counts))
+
+
+def get_labeled_subtomos_statistics(training_data_path: str, segmentation_names: list,
+                                    DA_rounds: int = 0) -> tuple:
+    """
+    Reads a training partition once, subtomogram by subtomogram, to list the
+    subtomograms that contain labels (those kept by
+    read_training_data_dice_multi_class) and the mean and standard deviation
+    of their raw data, computed per data augmentation round as
+    split_and_preprocess_dataset normalizes them.
+    :return: (keys, statistics) where statistics[i] = (mean, std) of keys[i]
+    """
+    keys = list()
+    keys_statistics = list()
+    with h5py.File(training_data_path, 'r') as f:
+        if len(list(f)) == 0:
+            print("Empty training set")
+            return keys, []
+        for subtomo_key in list_subtomos(f, h5_internal_paths.RAW_SUBTOMOGRAMS):
+            if np.max(_read_labels(f, subtomo_key, segmentation_names)) > 0.5:
+                raw_data = read_subtomo(f, h5_internal_paths.RAW_SUBTOMOGRAMS, subtomo_key).astype(np.float64)
+                raw_mean = np.mean(raw_data)
+                keys += [subtomo_key]
+                keys_statistics += [(raw_data.size, raw_mean, np.sum((raw_data - raw_mean) ** 2))]
+            else:
+                print("Due to lack of annotations, discarding", get_subtomo_name(f, subtomo_key))
+    if len(keys) == DA_rounds + 1:
+        chunks = [np.arange(len(keys))]
+    else:
+        chunks = _chunkify_list(lst=np.arange(len(keys)), n=DA_rounds + 1)
+    statistics = [None for _ in keys]
+    for chunk in chunks:
+        if len(chunk) > 0:
+            chunk_statistics = _combine_statistics([keys_statistics[index] for index in chunk])
+            for index in chunk:
+                statistics[index] = chunk_statistics
+    return keys, statistics
+
+
+class PartitionDataset(du.Dataset):
+    """
+    Training set of subtomograms read on demand from partition files.
+    Each item is the pair (raw data of shape 1 x Dz x Dy x Dx normalized
+    with the given mean and std, labels of shape S x Dz x Dy x Dx), as in the
+    TensorDatasets built from load_and_normalize_dataset_list. The partition
+    files are opened by each DataLoader worker on its first access.
+    With an augmentation (see tensors.transformations.SubtomoAugmentation),
+    the dataset has augmentation_rounds randomly transformed copies of each
+    subtomogram after the original ones, transformed when they are read.
+    """
+
+    def __init__(self, samples: list, segmentation_names: list,
+                 augmentation=None, augmentation_rounds: int = 0,
+                 seed: int or None = None):
+        """
+        :param samples: list of (partition path, subtomogram key, mean, std)
+        :param segmentation_names: names of the S semantic classes
+        :param augmentation: callable (raw_data, labels, rng) -> (raw_data,
+        labels)
+        :param augmentation_rounds: number of augmented copies of the samples
+        :param seed: seed of the augmentation random generators, one per
+        DataLoader worker and training process (by default, seeded from the
+        OS)
+        """
+        self.samples = samples
+        self.segmentation_names = segmentation_names
+        self.augmentation = augmentation
+        self.augmentation_rounds = augmentation_rounds if augmentation is not None else 0
+        self.seed = seed
+        # the workers of a distributed training do not join its process group
+        self._rank = get_rank()
+        self._files = {}
+        self._rng = None
+        self._pid = None
+
+    def __len__(self):
+        return len(self.samples) * (self.augmentation_rounds + 1)
+
+    def __getitem__(self, index):
+        partition_path, subtomo_key, mean, std = self.samples[index % len(self.samples)]
+        data_file = self._get_file(partition_path)
+        raw_data = read_subtomo(data_file, h5_internal_paths.RAW_SUBTOMOGRAMS, subtomo_key)
+        raw_data = ((raw_data - mean) / std).astype(np.float32)[None]
+        labels = _read_labels(data_file, subtomo_key, self.segmentation_names).astype(int)
+        if index >= len(self.samples):
+            raw_data, labels = self.augmentation(raw_data, labels, rng=self._rng)
+            raw_data = np.ascontiguousarray(raw_data, dtype=np.float32)
+            labels = np.ascontiguousarray(labels, dtype=int)
+        return torch.from_numpy(raw_data), torch.from_numpy(labels)
+
+    def _check_process(self):
+        # h5py file handles can not be shared with forked workers, and each
+        # worker draws its own random transforms
+        if self._pid != os.getpid():
+            self._files = {}
+            self._pid = os.getpid()
+            worker_info = du.get_worker_info()
+            worker_id = 0 if worker_info is None else worker_info.id + 1
+            self._rng = np.random.default_rng(None if self.seed is None else
+                                              [self.seed, self._rank, worker_id])
+        return
+
+    def _get_file(self, partition_path: str) -> h5py.File:
+        self._check_process()
+        if partition_path not in self._files:
+            self._files[partition_path] = h5py.File(partition_path, 'r')
+        return self._files[partition_path]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_files"] = {}
+        state["_rng"] = None
+        state["_pid"] = None
+        return state
+
+    def close(self):
+        if self._pid == os.getpid():
+            for data_file in self._files.values():
+                data_file.close()
+        self._files = {}
+        return
+
+
+def get_partition_datasets(training_partition_paths: list,
+                           data_aug_rounds_list: list,
+                           segmentation_names: list,
+                           split: int or float) -> tuple:
+    """
+    Lazily loaded counterpart of load_and_normalize_dataset_list: splits the
+    labeled subtomograms of each partition into training and validation
+    sets in the same way, and normalizes them with the statistics of their
+    partition, without loading them in memory.
+    :return: train_set, val_set (PartitionDataset)
+    """
+    train_samples = list()
+    val_samples = list()
+    for DA_rounds, training_data_path in zip(data_aug_rounds_list,
+                                             training_partition_paths):
+        print("\n")
+        print("Indexing training set from ", training_data_path)
+        print("DA_rounds", DA_rounds)
+        keys, statistics = get_labeled_subtomos_statistics(training_data_path=training_data_path,
+                                                           segmentation_names=segmentation_names,
+                                                           DA_rounds=DA_rounds)
+        if len(keys) == 0:
+            print('Empty training set in ', training_data_path)
+            continue
+        elif len(keys) == DA_rounds + 1:
+            print('Single training example in ', training_data_path)
+            train_keys, val_keys = keys, []
+        else:
+            train_keys, val_keys = split_subtomo_keys(keys=keys, split=split, DA_rounds=DA_rounds)
+        key_statistics = dict(zip(keys, statistics))
+        train_samples += [(training_data_path, key) + key_statistics[key] for key in train_keys]
+        val_samples += [(training_data_path, key) + key_statistics[key] for key in val_keys]
+    print("Training and validation subtomograms:", len(train_samples), len(val_samples))
+    train_set = PartitionDataset(samples=train_samples, segmentation_names=segmentation_names)
+    val_set = PartitionDataset(samples=val_samples, segmentation_names=segmentation_names)
+    return train_set, val_set
+
+
+def get_data_loader(dataset: du.Dataset, batch_size: int, shuffle: bool = False,
+                    num_workers: int = 0, seed: int or None = None) -> du.DataLoader:
+    """
+    DataLoader reading the batches with num_workers processes that are kept
+    between epochs, into pinned memory when a GPU is available. The
+    workers being persistent, augmented samples differ between epochs.
+    In a distributed training, each process loads its own share of the
+    dataset (see networks.distributed.set_loader_epoch).
+    :param seed: seed of the shuffling, for reproducibility
+    """
+    generator = torch.Generator().manual_seed(seed) if seed is not None else None
+    sampler = None
+    if is_distributed():
+        sampler = get_distributed_sampler(dataset, shuffle=shuffle, seed=seed)
+        shuffle = False
+    return du.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle,
+                         sampler=sampler, num_workers=num_workers,
+                         pin_memory=torch.cuda.is_available(),
+                         persistent_workers=num_workers > 0,
+                         generator=generator)
@@ -0,0 +1,125 @@
+import os
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+import torch.utils.data as du
+from torch.nn.parallel import DistributedDataParallel
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process() -> bool:
+    return get_rank() == 0
+
+
+def init_distributed(backend: str or None = None) -> bool:
+    """
+    Initializes the process group when the script is launched by torchrun
+    with more than one process (WORLD_SIZE > 1), with the nccl backend if
+    GPUs are available and gloo otherwise. Each process uses the GPU of its
+    LOCAL_RANK.
+    :return: True if the training is distributed
+    """
+    if int(os.environ.get("WORLD_SIZE", 1)) <= 1:
+        return False
+    if backend is None:
+        backend = "nccl" if torch.cuda.is_available() else "gloo"
+    if torch.cuda.is_available():
+        torch.cuda.set_device(int(os.environ.get("LOCAL_RANK", 0)))
+    dist.init_process_group(backend=backend)
+    print("Process", get_rank(), "of", get_world_size(), "with backend", backend)
+    return True
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+    return
+
+
+def get_distributed_device() -> torch.device:
+    if torch.cuda.is_available():
+        return torch.device("cuda", int(os.environ.get("LOCAL_RANK", 0)))
+    return torch.device("cpu")
+
+
+def wrap_distributed(net: nn.Module, device) -> nn.Module:
+    """
+    Moves the network to the device of this process and wraps it in
+    DistributedDataParallel, which averages the gradients of all processes
+    in the backward pass. On GPUs, batch normalization statistics are
+    synchronized across processes.
+    """
+    device = torch.device(device)
+    if device.type == "cuda":
+        net = nn.SyncBatchNorm.convert_sync_batchnorm(net)
+    net = net.to(device)
+    device_ids = [device.index] if device.type == "cuda" else None
+    return DistributedDataParallel(net, device_ids=device_ids)
+
+
+def unwrap_model(net: nn.Module) -> nn.Module:
+    """
+    Network inside a DataParallel or DistributedDataParallel wrapper, whose
+    state dict keys have no 'module.' prefix.
+    """
+    while isinstance(net, (nn.DataParallel, DistributedDataParallel)):
+        net = net.module
+    return net
+
+
+def remove_module_prefix(state_dict: dict) -> dict:
+    return {(key[len("module."):] if key.startswith("module.") else key): value
+            for key, value in state_dict.items()}
+
+
+def reduce_mean(value: float) -> float:
+    """
+    Mean of a scalar over all processes (the value itself if the training
+    is not distributed).
+    """
+    if not is_distributed():
+        return value
+    device = get_distributed_device() if dist.get_backend() == "nccl" else torch.device("cpu")
+    tensor = torch.tensor(float(value), dtype=torch.float64, device=device)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.item() / get_world_size()
+
+
+def broadcast_object(obj, src: int = 0):
+    """
+    The object of process src, in all processes.
+    """
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
+
+
+def get_distributed_sampler(dataset: du.Dataset, shuffle: bool,
+                            seed: int or None = None) -> du.DistributedSampler:
+    """
+    Sampler giving each process a distinct 1 / world size share of the
+    dataset, reshuffled every epoch by set_loader_epoch.
+    """
+    return du.DistributedSampler(dataset, num_replicas=get_world_size(),
+                                 rank=get_rank(), shuffle=shuffle,
+                                 seed=seed if seed is not None else 0)
+
+
+def set_loader_epoch(loader: du.DataLoader, epoch: int):
+    if isinstance(loader.sampler, du.DistributedSampler):
+        loader.sampler.set_epoch(epoch)
+    return
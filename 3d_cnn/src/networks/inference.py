@@ -0,0 +1,191 @@
+import os
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import torch.nn as nn
+
+from networks.amp import get_autocast
+
+COMPILE_MODES = [None, "trace", "compile"]
+
+
+def get_job_cores() -> int:
+    """
+    Number of cores allocated to the current job: SLURM_CPUS_PER_TASK when
+    running under slurm, otherwise the cores this process is allowed to run on.
+    """
+    slurm_cores = os.environ.get("SLURM_CPUS_PER_TASK")
+    if slurm_cores is not None and slurm_cores.isdigit():
+        return int(slurm_cores)
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def set_inference_threads(num_threads: int or None = None) -> int:
+    """
+    Pins the number of intra-op torch threads, so that several jobs sharing a
+    node do not oversubscribe it.
+    :param num_threads: number of threads, if None the job core allocation is
+    used.
+    :return: the number of threads that was set
+    """
+    if num_threads is None:
+        num_threads = get_job_cores()
+    num_threads = max(int(num_threads), 1)
+    torch.set_num_threads(num_threads)
+    print("torch intra-op threads set to", num_threads)
+    return num_threads
+
+
+class InferenceModel(nn.Module):
+    """
+    Wraps a network for inference, converting the input to the memory format
+    the network was converted to.
+    Arguments:
+      model: the (possibly traced or compiled) network
+      memory_format: torch.contiguous_format or torch.channels_last_3d
+      fallback_model: eager network used if the first call to a compiled
+      network fails
+      amp: None, "bf16" or "fp16", mixed precision of the forward pass (the
+      output is returned in float32)
+    """
+
+    def __init__(self, model, memory_format=torch.contiguous_format,
+                 fallback_model=None, amp=None):
+        super().__init__()
+        self.model = model
+        self.memory_format = memory_format
+        self.fallback_model = fallback_model
+        self.amp = amp
+
+    def forward(self, input_tensor):
+        if self.memory_format != torch.contiguous_format:
+            input_tensor = input_tensor.contiguous(memory_format=self.memory_format)
+        with get_autocast(input_tensor.device, self.amp):
+            output = self._forward(input_tensor)
+        return output.float()
+
+    def _forward(self, input_tensor):
+        if self.fallback_model is None:
+            return self.model(input_tensor)
+        try:
+            output = self.model(input_tensor)
+        except Exception as exception:
+            warnings.warn("compiled network failed ({}), using the eager network".format(exception))
+            self.model = self.fallback_model
+            output = self.model(input_tensor)
+        # the compiled network works, no need to keep checking
+        self.fallback_model = None
+        return output
+
+
+def prepare_model_for_inference(model: nn.Module, device, channels_last: bool = False,
+                                compile_mode: str or None = None,
+                                example_input_shape: tuple or None = None,
+                                amp: str or None = None) -> InferenceModel:
+    """
+    Prepares a network for inference: eval mode, float32 weights on device,
+    optional channels_last_3d memory format, optional torch.jit.trace or
+    torch.compile, and optional bf16/fp16 autocast of the forward pass. If
+    tracing or compiling fails, the eager network is used.
+    :param model: network to prepare
+    :param device: torch device where the inference will run
+    :param channels_last: whether to convert the network to channels_last_3d
+    :param compile_mode: None, "trace" or "compile"
+    :param example_input_shape: (batch, channels, z, y, x) shape used to
+    trace the network, only needed if compile_mode == "trace"
+    :param amp: None, "bf16" or "fp16" (see networks.amp)
+    :return: an InferenceModel wrapping the prepared network
+    """
+    assert compile_mode in COMPILE_MODES, "compile_mode should be one of {}".format(COMPILE_MODES)
+    model = model.to(device).to(torch.float).eval()
+    memory_format = torch.contiguous_format
+    fallback_model = None
+    if channels_last:
+        memory_format = torch.channels_last_3d
+        model = model.to(memory_format=memory_format)
+        print("Network converted to channels_last_3d memory format")
+
+    if compile_mode == "trace":
+        assert example_input_shape is not None, "An example input shape is needed to trace the network"
+        example_input = torch.zeros(example_input_shape, dtype=torch.float, device=device)
+        example_input = example_input.contiguous(memory_format=memory_format)
+        try:
+            with torch.no_grad():
+                traced_model = torch.jit.trace(model, example_input)
+                traced_model = torch.jit.freeze(traced_model)
+                traced_model(example_input)
+            model = traced_model
+            print("Network traced with torch.jit.trace")
+        except Exception as exception:
+            warnings.warn("torch.jit.trace failed ({}), using the eager network".format(exception))
+    elif compile_mode == "compile":
+        if hasattr(torch, "compile"):
+            try:
+                fallback_model = model
+                model = torch.compile(model)
+                print("Network compiled with torch.compile")
+            except Exception as exception:
+                fallback_model = None
+                warnings.warn("torch.compile failed ({}), using the eager network".format(exception))
+        else:
+            warnings.warn("torch.compile is not available, using the eager network")
+    return InferenceModel(model=model, memory_format=memory_format, fallback_model=fallback_model, amp=amp)
+
+
+def _timed_call(function, job):
+    start_time = time.time()
+    result = function(job)
+    return result, time.time() - start_time
+
+
+def run_pipelined_jobs(jobs: list, prepare, process) -> list:
+    """
+    Runs process(job, prepare(job)) for each job in order. prepare, that
+    should do the reading, runs in a background thread one job ahead, so
+    that the reading for job N + 1 overlaps the computation of job N.
+    :param jobs: list of jobs
+    :param prepare: function job -> prepared data
+    :param process: function (job, prepared data) -> None, run in the
+    calling thread
+    :return: list of the latency breakdown of each job, as dictionaries with
+    the job, the prepare time, the time process waited for prepare to finish
+    (the part of the prepare time that was not overlapped), the process time
+    and the total (wait + process) time
+    """
+    timings = list()
+    if len(jobs) == 0:
+        return timings
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_prepared = executor.submit(_timed_call, prepare, jobs[0])
+        for index, job in enumerate(jobs):
+            start_time = time.time()
+            prepared, prepare_time = next_prepared.result()
+            wait_time = time.time() - start_time
+            if index + 1 < len(jobs):
+                next_prepared = executor.submit(_timed_call, prepare, jobs[index + 1])
+            process_start_time = time.time()
+            process(job, prepared)
+            process_time = time.time() - process_start_time
+            timings += [{"job": job, "prepare": prepare_time, "wait": wait_time,
+                         "process": process_time, "total": wait_time + process_time}]
+    return timings
+
+
+def print_job_timings(timings: list, startup_time: float = 0):
+    """
+    Prints the latency breakdown of run_pipelined_jobs, in seconds.
+    :param startup_time: time spent before the first job (e.g. loading the
+    model), shared by all the jobs
+    """
+    print("{:<20} {:>10} {:>10} {:>10} {:>10}".format("job", "prepare", "wait", "process", "total"))
+    for timing in timings:
+        print("{:<20} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}".format(str(timing["job"]), timing["prepare"],
+                                                                       timing["wait"], timing["process"],
+                                                                       timing["total"]))
+    total_time = startup_time + sum(timing["total"] for timing in timings)
+    print("Startup: {:.2f} s, total: {:.2f} s for {} jobs".format(startup_time, total_time, len(timings)))
+    return
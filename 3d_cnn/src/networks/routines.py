@@ -1,5 +1,7 @@
 import torch
 
+from networks.amp import get_autocast
+from networks.distributed import reduce_mean
 from tensors import actions
 import numpy as np
 
@@ -63,7 +65,15 @@ def train_float(model, loader, optimizer, loss_function,
 
 def train(model, loader, optimizer, loss_function,
           epoch, device, log_interval=20, tb_logger=None, log_image=True,
-          lr_scheduler=None):
+          lr_scheduler=None, amp=None, grad_scaler=None):
+    """
+    Trains the model for one epoch. With amp ("bf16" or "fp16", see
+    networks.amp), the forward pass runs in mixed precision while the loss
+    is computed in float32; grad_scaler (needed for fp16) scales the loss
+    and skips the steps with non-finite gradients. In a distributed
+    training, the loss given to lr_scheduler is averaged over the processes
+    so that all of them keep the same learning rate.
+    """
     # set the model to train mode
     model.train()
     train_loss = 0
@@ -76,10 +86,17 @@ def train(model, loader, optimizer, loss_function,
         optimizer.zero_grad()
 
         # apply model, calculate loss and run backwards pass
-        prediction = model(x)
+        with get_autocast(device, amp):
+            prediction = model(x)
+        prediction = prediction.float()
         loss = loss_function(prediction, y.long())
-        loss.backward()
-        optimizer.step()
+        if grad_scaler is None:
+            loss.backward()
+            optimizer.step()
+        else:
+            grad_scaler.scale(loss).backward()
+            grad_scaler.step(optimizer)
+            grad_scaler.update()
         train_loss += loss.item()
 
         # log to console
@@ -163,6 +180,7 @@ def train(model, loader, optimizer, loss_function,
                                   "isnt loggable")
                     else:
                         print("Not logging images.")
+    train_loss = reduce_mean(train_loss)
     lr_scheduler.step(train_loss)
 
     train_loss /= len(loader)
@@ -173,7 +191,7 @@ def train(model, loader, optimizer, loss_function,
 
 
 def validate(model, loader, loss_function, metric, device, step=None,
-             tb_logger=None, log_image_interval=None):
+             tb_logger=None, log_image_interval=None, amp=None):
     # set model to eval mode
     model.eval()
     # running loss and metric values
@@ -186,7 +204,9 @@ def validate(model, loader, loss_function, metric, device, step=None,
         for index, data in enumerate(loader):
             x, y = data
             x, y = x.to(device), y.to(device)
-            prediction = model(x)
+            with get_autocast(device, amp):
+                prediction = model(x)
+            prediction = prediction.float()
             val_loss += loss_function(prediction, y.long()).item()
             val_metric += metric(prediction, y.long()).item()
             if tb_logger is not None:
@@ -211,8 +231,8 @@ def validate(model, loader, loss_function, metric, device, step=None,
                                             step=step)
 
         # normalize loss and metric
-        val_loss /= len(loader)
-        val_metric /= len(loader)
+        val_loss = reduce_mean(val_loss / len(loader))
+        val_metric = reduce_mean(val_metric / len(loader))
 
         if tb_logger is not None:
             assert step is not None, \
@@ -225,7 +245,7 @@ def validate(model, loader, loss_function, metric, device, step=None,
     return val_loss
 
 
-def compute_global_dice(model, loader, device, overlap):
+def compute_global_dice(model, loader, device, overlap, amp=None):
     # set model to eval mode
     model.eval()
     # running loss and metric values
@@ -244,7 +264,9 @@ def compute_global_dice(model, loader, device, overlap):
                                                                                overlap:-overlap]
             mask = torch.from_numpy(mask).to(device)
             x, y = x.to(device), y.to(device)
-            prediction = model(x)
+            with get_autocast(device, amp):
+                prediction = model(x)
+            prediction = prediction.float()
             numerator += (prediction * y.long() * mask).sum()
             denominator += (prediction * prediction * mask).sum() + (y.long() * y.long() * mask).sum()
 
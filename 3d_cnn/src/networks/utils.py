@@ -1,4 +1,5 @@
 import os
+import warnings
 from os.path import join
 
 import h5py
@@ -9,16 +10,18 @@ import torch.nn as nn
 import torch.optim as optim
 import torch.utils.data as du
 from constants import h5_internal_paths
-from constants.config import Config, CV_DATA_FILE
+from constants.config import Config, CV_DATA_FILE, model_descriptor_from_config
 from constants.statistics import ModelDescriptor
 from file_actions.readers.h5 import read_training_data
+from file_actions.readers.partition import list_subtomos, read_subtomo
 from image.filters import preprocess_data
+from networks.datasets import get_data_loader, get_partition_datasets
+from networks.distributed import broadcast_object, remove_module_prefix, \
+    unwrap_model
 from networks.io import get_device
 from networks.unet import UNet3D
 from paths.pipeline_dirs import training_partition_path
-from tensors.transformations import apply_transformation_iteration
-from tomogram_utils.volume_actions.actions import \
-    load_and_normalize_dataset_list
+from tensors.transformations import SubtomoAugmentation
 from tomogram_utils.volume_actions.actions import split_and_preprocess_dataset
 
 
@@ -51,12 +54,58 @@ def save_unet_model(path_to_model: str, epoch, net, optimizer, loss, model_descr
     torch.save({
         'model_descriptor': model_descriptor,
         'epoch': epoch,
-        'model_state_dict': net.state_dict(),
+        'model_state_dict': unwrap_model(net).state_dict(),
         'optimizer_state_dict': optimizer.state_dict(),
         'loss': loss
     }, path_to_model)
 
 
+def load_unet_model_for_prediction(path_to_model: str, config: Config, device) -> nn.Module:
+    """
+    Loads a trained UNet3D checkpoint for prediction, without final
+    activation. If the checkpoint has no model descriptor, one is generated
+    from the config and saved into the checkpoint. When several GPUs are
+    available the network is wrapped in nn.DataParallel. Checkpoints saved
+    from a wrapped network, with 'module.' prefixed state dict keys, are
+    also loaded.
+    """
+    checkpoint = torch.load(path_to_model, map_location=device, weights_only=False)
+
+    if 'model_descriptor' not in checkpoint.keys():
+        warnings.warn("Model without model descriptor... it will be added")
+        print("WARNING: model without model descriptor... it will be added")
+        model_descriptor = model_descriptor_from_config(config)
+        checkpoint["model_descriptor"] = model_descriptor
+        torch.save({
+            'model_descriptor': model_descriptor,
+            'epoch': checkpoint['epoch'],
+            'model_state_dict': checkpoint['model_state_dict'],
+            'optimizer_state_dict': checkpoint['optimizer_state_dict'],
+            'loss': checkpoint['loss'],
+        }, path_to_model)
+    else:
+        print(f"Model trained under the following original settings: {checkpoint['model_descriptor']}")
+
+    model_descriptor = checkpoint['model_descriptor']
+
+    net_conf = {'final_activation': None,
+                'depth': model_descriptor.depth,
+                'initial_features': model_descriptor.initial_features,
+                "out_channels": model_descriptor.output_classes,
+                "BN": model_descriptor.batch_norm,
+                "encoder_dropout": model_descriptor.encoder_dropout,
+                "decoder_dropout": model_descriptor.decoder_dropout}
+
+    model = UNet3D(**net_conf)
+    model.load_state_dict(remove_module_prefix(checkpoint['model_state_dict']))
+    model.to(device)
+
+    if torch.cuda.device_count() > 1:
+        print(f"Let's use {torch.cuda.device_count()} GPUs!")
+        model = nn.DataParallel(model)
+    return model
+
+
 def get_testing_and_training_sets_from_partition(training_data_path: str,
                                                  label_name: str,
                                                  split=0.8) -> tuple:
@@ -105,26 +154,25 @@ def data_loader(data_path: str, semantic_class: str,
             h5_path_raw = h5_internal_paths.RAW_SUBTOMOGRAMS
             h5_path_label = join(h5_internal_paths.LABELED_SUBTOMOGRAMS,
                                  semantic_class)
-            source_raw_names = list(f[h5_path_raw])
-            source_label_names = list(f[h5_path_label])
-            assert set(source_raw_names) == set(source_label_names)
+            source_raw_keys = list_subtomos(f, h5_path_raw)
+            source_label_keys = list_subtomos(f, h5_path_label)
+            assert set(source_raw_keys) == set(source_label_keys)
             if number_vols == -1:
-                number_vols = len(source_raw_names)
-            for vol_name in source_raw_names[:number_vols]:
-                src_raw_path = join(h5_path_raw, vol_name)
-                src_label_path = join(h5_path_label, vol_name)
+                number_vols = len(source_raw_keys)
+            for vol_key in source_raw_keys[:number_vols]:
+                label_data = read_subtomo(f, h5_path_label, vol_key)
                 if labeled_only:
                     # Only read if at least one label is positive:
-                    if np.max(f[src_label_path][:]) > 0:
-                        raw_array += [f[src_raw_path][:]]
-                        label_array += [f[src_label_path][:]]
+                    if np.max(label_data) > 0:
+                        raw_array += [read_subtomo(f, h5_path_raw, vol_key)]
+                        label_array += [label_data]
                     else:
                         print(
                             "Partition element with no label data: not included.")
                 else:
                     # Read all of the data.
-                    raw_array += [f[src_raw_path][:]]
-                    label_array += [f[src_label_path][:]]
+                    raw_array += [read_subtomo(f, h5_path_raw, vol_key)]
+                    label_array += [label_data]
             # Add channel dimension
     raw_array, label_array = np.array(raw_array)[:, None], np.array(
         label_array)[:, None]
@@ -185,7 +233,7 @@ def get_training_testing_lists(config: Config, fold: int):
     return tomo_training_list, tomo_testing_list
 
 
-def generate_data_loaders(config: Config, tomo_training_list: list, fold: int or None = None):
+def _get_training_datasets(config: Config, tomo_training_list: list, fold: int or None = None) -> tuple:
     training_partition_paths = list()
     data_aug_rounds_list = list()
     for tomo_name in tomo_training_list:
@@ -196,83 +244,47 @@ def generate_data_loaders(config: Config, tomo_training_list: list, fold: int or
         training_partition_paths += [partition_path]
         data_aug_rounds_list += [0]
 
-    train_data, train_labels, val_data, val_labels = \
-        load_and_normalize_dataset_list(training_partition_paths,
-                                        data_aug_rounds_list,
-                                        config.semantic_classes, config.split)
-
-    print("Train data: mean = {}, std = {}".format(np.mean(train_data), np.std(train_data)))
-    print("unique labels = {}".format(np.unique(train_labels)))
-    print("training data shape =", train_data.shape)
-    print("validation data shape =", val_data.shape)
-    train_set = du.TensorDataset(torch.from_numpy(train_data),
-                                 torch.from_numpy(train_labels))
-    val_set = du.TensorDataset(torch.from_numpy(val_data),
-                               torch.from_numpy(val_labels))
-
-    train_loader = du.DataLoader(train_set, shuffle=True, batch_size=config.batch_size)
-    val_loader = du.DataLoader(val_set, batch_size=config.batch_size)
+    train_set, val_set = get_partition_datasets(training_partition_paths=training_partition_paths,
+                                                data_aug_rounds_list=data_aug_rounds_list,
+                                                segmentation_names=config.semantic_classes,
+                                                split=config.split)
+    # the split is random: all the processes of a distributed training
+    # take the one of the first process
+    train_set.samples, val_set.samples = broadcast_object((train_set.samples, val_set.samples))
+    return train_set, val_set
+
+
+def _get_training_loaders(config: Config, train_set: du.Dataset, val_set: du.Dataset) -> tuple:
+    train_loader = get_data_loader(train_set, batch_size=config.batch_size, shuffle=True,
+                                   num_workers=config.num_workers, seed=config.da_seed)
+    val_loader = get_data_loader(val_set, batch_size=config.batch_size,
+                                 num_workers=config.num_workers)
     return train_loader, val_loader
 
 
-def generate_data_loaders_data_augmentation(config: Config, tomo_training_list: list, fold: int or None = None):
-    training_partition_paths = list()
-    data_aug_rounds_list = list()
-    for tomo_name in tomo_training_list:
-        print(tomo_name)
-        _, partition_path = training_partition_path(output_dir=config.work_dir,
-                                                    tomo_name=tomo_name,
-                                                    fold=fold)
-        training_partition_paths += [partition_path]
-        data_aug_rounds_list += [0]
+def generate_data_loaders(config: Config, tomo_training_list: list, fold: int or None = None):
+    train_set, val_set = _get_training_datasets(config=config, tomo_training_list=tomo_training_list, fold=fold)
+    return _get_training_loaders(config=config, train_set=train_set, val_set=val_set)
 
-    train_data, train_labels, val_data, val_labels = \
-        load_and_normalize_dataset_list(training_partition_paths,
-                                        data_aug_rounds_list,
-                                        config.semantic_classes, config.split)
-
-    # Data augmentation rounds:
-    if train_data.shape[0] > 0:
-        data_aug_rounds = config.da_rounds
-        rot_angle = config.da_rot_angle
-        elastic_alpha = config.da_elastic_alpha
-        sigma_gauss = config.da_sigma_gauss
-        salt_pepper_p = config.da_salt_pepper_p
-        salt_pepper_ampl = config.da_salt_pepper_ampl
-        print(train_labels.shape)
-        assert len(train_labels.shape) in [5, 6]
-        if len(train_labels.shape) == 6:
-            src_label_data = train_labels
-        else:
-            print("one single label")
-            src_label_data = train_labels[None, :]
-        train_data_aug = train_data.copy()
-        train_labels_aug = src_label_data.copy()
-        for iteration in range(data_aug_rounds):
-            transf_raw_tensor, transf_label_tensors = \
-                apply_transformation_iteration(
-                    src_raw=train_data,
-                    src_label_data=src_label_data,
-                    rot_range=rot_angle,
-                    elastic_alpha=elastic_alpha,
-                    sigma_noise=sigma_gauss,
-                    salt_pepper_p=salt_pepper_p,
-                    salt_pepper_ampl=salt_pepper_ampl)
-            print("train_data_aug.shape, train_labels_aug.shape:", train_data_aug.shape, train_labels_aug.shape)
-            print("np.array(transf_raw_tensor).shape, np.array(transf_label_tensors).shape:")
-            print(np.array(transf_raw_tensor).shape, np.array(transf_label_tensors).shape)
-            train_data_aug = np.append(train_data_aug, np.array(transf_raw_tensor), axis=0)
-            train_labels_aug = np.append(train_labels_aug, np.array(transf_label_tensors), axis=1)
-        print("train_labels_aug.shape", train_labels_aug.shape)
-        print("train_data_aug.shape", train_data_aug.shape)
-    train_set = du.TensorDataset(torch.from_numpy(train_data),
-                                 torch.from_numpy(train_labels))
-    val_set = du.TensorDataset(torch.from_numpy(val_data),
-                               torch.from_numpy(val_labels))
 
-    train_loader = du.DataLoader(train_set, shuffle=True, batch_size=config.batch_size)
-    val_loader = du.DataLoader(val_set, batch_size=config.batch_size)
-    return train_loader, val_loader
+def generate_data_loaders_data_augmentation(config: Config, tomo_training_list: list, fold: int or None = None):
+    """
+    Training and validation loaders where, if config.da_rounds > 0, each
+    epoch of the training loader goes through the training subtomograms and
+    config.da_rounds randomly transformed copies of them, transformed on the
+    fly by the DataLoader workers.
+    """
+    train_set, val_set = _get_training_datasets(config=config, tomo_training_list=tomo_training_list, fold=fold)
+    if config.da_rounds > 0:
+        train_set.augmentation = SubtomoAugmentation(rot_range=config.da_rot_angle,
+                                                     elastic_alpha=config.da_elastic_alpha,
+                                                     sigma_noise=config.da_sigma_gauss,
+                                                     salt_pepper_p=config.da_salt_pepper_p,
+                                                     salt_pepper_ampl=config.da_salt_pepper_ampl)
+        train_set.augmentation_rounds = config.da_rounds
+        train_set.seed = config.da_seed
+        print("Training subtomograms with data augmentation:", len(train_set))
+    return _get_training_loaders(config=config, train_set=train_set, val_set=val_set)
 
 
 if __name__ == "__main__":
@@ -1,4 +1,5 @@
 import numpy as np
+from scipy.spatial import cKDTree
 
 
 def get_max_F1(F1_score: list):
@@ -53,33 +54,33 @@ def precision_recall_calculator(predicted_coordinates: np.array or list,
     else:
         predicted_false_positives = list()
         value_predicted_false_positives = list()
-        for value, point in zip(value_predicted, predicted_coordinates):
-            close_to_point, distances = get_clean_points_close2point(
-                point,
-                true_coordinates,
-                radius
-            )
-            if len(close_to_point) > 0:
-                flag = "true_positive_candidate"
-                flag_tmp = "not_redundant_yet"
-                for dist, clean_p in sorted(zip(distances, close_to_point)):
-                    if flag == "true_positive_candidate":
-                        if tuple(clean_p) not in detected_true:
-                            detected_true.append(tuple(clean_p))
-                            flag = "true_positive"
-                        else:
-                            flag_tmp = "redundant_candidate"
-                    # else:
-                    # print(point, "is already flagged as true positive")
-                if flag == "true_positive":
+        true_array = np.array(true_coordinates)
+        # Points with the same coordinates are detected together
+        _, true_point_ids = np.unique(true_array, axis=0, return_inverse=True)
+        true_point_ids = true_point_ids.ravel()
+        is_detected = np.zeros(np.max(true_point_ids) + 1, dtype=bool)
+        # The tree query is slightly wider than the radius, the exact
+        # distances are checked below
+        true_tree = cKDTree(true_array)
+        candidates_lists = true_tree.query_ball_point(np.array(predicted_coordinates, dtype=float),
+                                                      r=radius * (1 + 1e-9) + 1e-9)
+        for value, point, candidates in zip(value_predicted, predicted_coordinates, candidates_lists):
+            candidates = np.array(candidates, dtype=int)
+            distances = np.linalg.norm(true_array[candidates] - np.asarray(point), axis=1)
+            candidates, distances = candidates[distances <= radius], distances[distances <= radius]
+            if len(candidates) > 0:
+                # Closest true point first (ties broken by coordinates) that
+                # is not detected yet, otherwise the point is redundant
+                order = np.lexsort(tuple(true_array[candidates].T[::-1]) + (distances,))
+                free_candidates = [c for c in candidates[order] if not is_detected[true_point_ids[c]]]
+                if len(free_candidates) > 0:
+                    is_detected[true_point_ids[free_candidates[0]]] = True
+                    detected_true.append(tuple(true_coordinates[free_candidates[0]]))
                     predicted_true_positives.append(tuple(point))
                     value_predicted_true_positives.append(value)
-                elif flag == "true_positive_candidate" and \
-                        flag_tmp == "redundant_candidate":
+                else:
                     predicted_redundant.append(tuple(point))
                     value_predicted_redundant.append(value)
-                else:
-                    print("This should never happen!")
             else:
                 predicted_false_positives.append(tuple(point))
                 value_predicted_false_positives.append(value)
@@ -89,7 +90,8 @@ def precision_recall_calculator(predicted_coordinates: np.array or list,
                                              false_positives_total
             precision.append(true_positives_total / total_current_predicted_points)
             recall.append(true_positives_total)
-        false_negatives = [point for point in true_coordinates if tuple(point) not in detected_true]
+        false_negatives = [point for point, point_id in zip(true_coordinates, true_point_ids)
+                           if not is_detected[point_id]]
         N_inv = 1 / total_true_points
         recall = np.array(recall) * N_inv
         recall = list(recall)
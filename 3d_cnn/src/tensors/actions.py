@@ -43,9 +43,55 @@ def crop_window(input_array: np.array, shape_to_crop: tuple or list,
     return input_array[crop]
 
 
-def crop_window_around_point(input_array: np.array, crop_shape: tuple or list,
+class PaddedView:
+    """
+    Read-only view of a dataset as if it was padded, without copying it.
+    padding_indices gives, along each axis, the index in the dataset of each
+    padded coordinate (e.g. the reflected indices of np.pad). Indexing with
+    slices reads the region of the dataset bounding the requested indices:
+    regions of consecutive indices are plain slices of the dataset (views
+    of arrays), and only the regions crossing a padded border are copied.
+    The dataset can be an array or any object indexable by slices with a
+    shape and a dtype (e.g. a TomogramVolume).
+    """
+
+    def __init__(self, dataset, padding_indices: list):
+        assert len(padding_indices) == len(dataset.shape), \
+            "padding indices are needed along every axis"
+        self.dataset = dataset
+        self.padding_indices = [np.asarray(indices) for indices in padding_indices]
+        self.dtype = dataset.dtype
+
+    @property
+    def shape(self) -> tuple:
+        return tuple(len(indices) for indices in self.padding_indices)
+
+    @property
+    def ndim(self) -> int:
+        return len(self.padding_indices)
+
+    def __getitem__(self, key) -> np.array:
+        key = key if isinstance(key, tuple) else (key,)
+        key = key + (slice(None),) * (self.ndim - len(key))
+        assert all(isinstance(axis_key, slice) and axis_key.step in [None, 1] for axis_key in key), \
+            "a padded view can only be indexed with slices"
+        region_indices = [indices[axis_key] for indices, axis_key in zip(self.padding_indices, key)]
+        if any(len(indices) == 0 for indices in region_indices):
+            return np.empty([len(indices) for indices in region_indices], dtype=self.dtype)
+        region = self.dataset[tuple(slice(int(indices.min()), int(indices.max()) + 1)
+                                    for indices in region_indices)]
+        for axis, indices in enumerate(region_indices):
+            if indices[-1] - indices[0] != len(indices) - 1 or np.any(np.diff(indices) != 1):
+                axis_key = [slice(None)] * region.ndim
+                axis_key[axis] = indices - indices.min()
+                region = region[tuple(axis_key)]
+        return region
+
+
+def crop_window_around_point(input_array: np.array or PaddedView, crop_shape: tuple or list,
                              window_center: tuple or list) -> np.array:
-    # The window center is not in tom_coordinates, it is (z, y, x)
+    # The window center is not in tom_coordinates, it is (z, y, x). A
+    # PaddedView input is only read (and reflected) inside the window.
     input_shape = input_array.shape
     assert all(ish - csh // 2 - center >= 0 for ish, csh, center in
                zip(input_shape, crop_shape, window_center)), \
@@ -57,3 +103,33 @@ def crop_window_around_point(input_array: np.array, crop_shape: tuple or list,
     crop = tuple(slice(center - csh // 2, center + csh // 2)
                  for csh, center in zip(crop_shape, window_center))
     return input_array[crop]
+
+
+def get_blending_window(window_shape: tuple or list, mode: str = "gaussian",
+                        sigma_scale: float = 1 / 8,
+                        min_weight: float = 1e-3) -> np.array:
+    """
+    Separable weighting window used to blend overlapping predictions, which
+    is maximal at the center of the window and decays towards its borders.
+    :param window_shape: shape of the window (cz, cy, cx)
+    :param mode: "gaussian" or "cosine"
+    :param sigma_scale: standard deviation of the gaussian window, relative to
+    the window side length
+    :param min_weight: minimum weight, relative to the maximum, so that every
+    voxel of the window has a positive weight
+    :return: float32 np.array of shape window_shape, with maximum 1
+    """
+    assert mode in ["gaussian", "cosine"], "blending mode should be gaussian or cosine"
+    window = np.ones(window_shape, dtype=np.float32)
+    for axis, length in enumerate(window_shape):
+        position = np.arange(length) + 0.5
+        if mode == "gaussian":
+            sigma = sigma_scale * length
+            profile = np.exp(-(position - length / 2) ** 2 / (2 * sigma ** 2))
+        else:
+            profile = 0.5 * (1 - np.cos(2 * np.pi * position / length))
+        profile_shape = [1] * len(window_shape)
+        profile_shape[axis] = length
+        window *= profile.reshape(profile_shape).astype(np.float32)
+    window /= window.max()
+    return np.maximum(window, min_weight)
@@ -37,16 +37,26 @@ class Transform(object):
     not 5D batch-tensors of 3D volumes, a `NotImplementedError` is raised.
     """
 
-    def __init__(self, apply_to=None):
+    def __init__(self, apply_to=None, rng=None):
         """
         Parameters
         ----------
         apply_to : list or tuple
             Indices of tensors to apply this transform to. The indices are with respect
             to the list of arguments this object is called with.
+        rng : np.random.Generator
+            Generator of the random variables (by default, the global numpy
+            random state, reseeded from the OS).
         """
         self._random_variables = {}
         self._apply_to = list(apply_to) if apply_to is not None else None
+        self.rng = rng
+
+    def get_random_state(self):
+        if self.rng is None:
+            np.random.seed()
+            return np.random
+        return self.rng
 
     def build_random_variables(self, **kwargs):
         pass
@@ -172,10 +182,10 @@ class RandomFlip3D(Transform):
         super(RandomFlip3D, self).__init__(**super_kwargs)
 
     def build_random_variables(self, **kwargs):
-        np.random.seed()
-        self.set_random_variable('flip_lr', np.random.uniform() > 0.5)
-        self.set_random_variable('flip_ud', np.random.uniform() > 0.5)
-        self.set_random_variable('flip_z', np.random.uniform() > 0.5)
+        random_state = self.get_random_state()
+        self.set_random_variable('flip_lr', random_state.uniform() > 0.5)
+        self.set_random_variable('flip_ud', random_state.uniform() > 0.5)
+        self.set_random_variable('flip_z', random_state.uniform() > 0.5)
 
     def volume_function(self, volume):
         if self.get_random_variable('flip_lr'):
@@ -194,10 +204,10 @@ class RandomRot3D(Transform):
         self.p = p
 
     def build_random_variables(self, **kwargs):
-        np.random.seed()
-        self.set_random_variable('angle_z', np.random.uniform(-self.rot_range,
-                                                              self.rot_range))
-        p_rotate = np.random.uniform(low=0, high=1, size=1)[0]
+        random_state = self.get_random_state()
+        self.set_random_variable('angle_z', random_state.uniform(-self.rot_range,
+                                                                 self.rot_range))
+        p_rotate = random_state.uniform(low=0, high=1, size=1)[0]
         self.set_random_variable('p_rotate', p_rotate)
 
     def volume_function(self, volume):
@@ -237,11 +247,11 @@ class ElasticTransform(Transform):
 
     def build_random_variables(self, **kwargs):
         # All this is done just once per batch (i.e. until `clear_random_variables` is called)
-        np.random.seed()
+        random_state = self.get_random_state()
         imshape = kwargs.get('imshape')
         # Build and scale random fields
-        random_field_x = np.random.uniform(-1, 1, imshape) * self.alpha
-        random_field_y = np.random.uniform(-1, 1, imshape) * self.alpha
+        random_field_x = random_state.uniform(-1, 1, imshape) * self.alpha
+        random_field_y = random_state.uniform(-1, 1, imshape) * self.alpha
         # Smooth random field (this has to be done just once per reset)
         sdx = gaussian_filter(random_field_x, self.sigma, mode='reflect')
         sdy = gaussian_filter(random_field_y, self.sigma, mode='reflect')
@@ -301,12 +311,12 @@ class ElasticTransform3D(Transform):
 
     def build_random_variables(self, **kwargs):
         # All this is done just once per batch (i.e. until `clear_random_variables` is called)
-        np.random.seed()
+        random_state = self.get_random_state()
         imshape = kwargs.get('imshape')
         # Build and scale random fields
-        random_field_x = np.random.uniform(-1, 1, imshape) * self.alpha
-        random_field_y = np.random.uniform(-1, 1, imshape) * self.alpha
-        random_field_z = np.random.uniform(-1, 1, imshape) * self.alpha
+        random_field_x = random_state.uniform(-1, 1, imshape) * self.alpha
+        random_field_y = random_state.uniform(-1, 1, imshape) * self.alpha
+        random_field_z = random_state.uniform(-1, 1, imshape) * self.alpha
         # Smooth random field (this has to be done just once per reset)
         sdx = gaussian_filter(random_field_x, self.sigma, mode='reflect')
         sdy = gaussian_filter(random_field_y, self.sigma, mode='reflect')
@@ -375,14 +385,14 @@ class SinusoidalElasticTransform3D(Transform):
         return image
 
     def build_random_variables(self, **kwargs):
-        np.random.seed()
+        random_state = self.get_random_state()
         imshape = kwargs.get('imshape')
         nz, ny, nx = [sh // self.interp_factor for sh in imshape]
         coarse_imshape = nz, ny, nx
 
-        coarse_random_field_x = np.random.uniform(0, 2 * np.pi, coarse_imshape)
-        coarse_random_field_y = np.random.uniform(0, 2 * np.pi, coarse_imshape)
-        coarse_random_field_z = np.random.uniform(0, 2 * np.pi, coarse_imshape)
+        coarse_random_field_x = random_state.uniform(0, 2 * np.pi, coarse_imshape)
+        coarse_random_field_y = random_state.uniform(0, 2 * np.pi, coarse_imshape)
+        coarse_random_field_z = random_state.uniform(0, 2 * np.pi, coarse_imshape)
 
         coarse_random_field_x = np.sin(coarse_random_field_x) * self.alpha
         coarse_random_field_y = np.sin(coarse_random_field_y) * self.alpha
@@ -449,13 +459,13 @@ class AdditiveGaussianNoise(Transform):
         self.epsilon = epsilon
 
     def build_random_variables(self, **kwargs):
-        np.random.seed()
-        noise_radius = np.random.uniform(low=0, high=self.sigma, size=1)[0]
-        gaussian_noise = np.random.normal(loc=0, scale=noise_radius,
-                                          size=kwargs.get('imshape'))
+        random_state = self.get_random_state()
+        noise_radius = random_state.uniform(low=0, high=self.sigma, size=1)[0]
+        gaussian_noise = random_state.normal(loc=0, scale=noise_radius,
+                                             size=kwargs.get('imshape'))
         self.set_random_variable('noise', gaussian_noise)
 
-        noise_amplitude = np.random.uniform(low=0, high=self.epsilon, size=1)[0]
+        noise_amplitude = random_state.uniform(low=0, high=self.epsilon, size=1)[0]
         self.set_random_variable("noise_amplitude", noise_amplitude)
 
     def image_function(self, image):
@@ -479,11 +489,11 @@ class AdditiveSaltAndPepperNoise(Transform):
         self.amplitude = amplitude
 
     def build_random_variables(self, **kwargs):
-        np.random.seed()
-        noise_p = np.random.uniform(low=0, high=self.p, size=1)[0]
-        noise_ampl = np.random.uniform(low=0, high=self.amplitude, size=1)[0]
-        salt = np.random.binomial(n=1, p=noise_p, size=kwargs.get('imshape'))
-        pepper = np.random.binomial(n=1, p=noise_p, size=kwargs.get('imshape'))
+        random_state = self.get_random_state()
+        noise_p = random_state.uniform(low=0, high=self.p, size=1)[0]
+        noise_ampl = random_state.uniform(low=0, high=self.amplitude, size=1)[0]
+        salt = random_state.binomial(n=1, p=noise_p, size=kwargs.get('imshape'))
+        pepper = random_state.binomial(n=1, p=noise_p, size=kwargs.get('imshape'))
         salt_pepper = noise_ampl * (salt - pepper)
         self.set_random_variable('noise', salt_pepper)
 
@@ -616,7 +626,7 @@ def transform_data_from_h5(training_data_path: str, label_name: str,
 
 def get_transforms(rot_range: float, elastic_alpha: int,
                    sigma_noise: float, salt_pepper_p: float = 0.04,
-                   salt_pepper_ampl: float = 0.8) -> tuple:
+                   salt_pepper_ampl: float = 0.8, rng=None) -> tuple:
     """
 
     :param rot_range:
@@ -624,17 +634,20 @@ def get_transforms(rot_range: float, elastic_alpha: int,
     :param sigma_noise:
     :param salt_pepper_p:
     :param salt_pepper_ampl:
+    :param rng: np.random.Generator of the random variables of the transforms
     :return:
     """
-    rotation_transform = RandomRot3D(rot_range=rot_range, p=0.5)
+    rotation_transform = RandomRot3D(rot_range=rot_range, p=0.5, rng=rng)
 
-    gaussian_transform = AdditiveGaussianNoise(sigma=sigma_noise)
+    gaussian_transform = AdditiveGaussianNoise(sigma=sigma_noise, rng=rng)
     salt_pepper_noise = AdditiveSaltAndPepperNoise(p=salt_pepper_p,
-                                                   amplitude=salt_pepper_ampl)
+                                                   amplitude=salt_pepper_ampl,
+                                                   rng=rng)
     if elastic_alpha >= 1:
 
         elastic_transform = SinusoidalElasticTransform3D(alpha=elastic_alpha,
-                                                         interp_step=32)
+                                                         interp_step=32,
+                                                         rng=rng)
         raw_transforms = [rotation_transform, elastic_transform,
                           gaussian_transform, salt_pepper_noise]
         label_transforms = [rotation_transform, elastic_transform]
@@ -783,3 +796,39 @@ def apply_transformation_iteration(src_raw, src_label_data, rot_range,
     return transf_raw_tensor, transf_label_tensors
 
 
+class SubtomoAugmentation(object):
+    """
+    Random transforms of get_transforms applied to a single training
+    subtomogram, so that data augmentation can run in the DataLoader
+    workers. The raw data and the labels share the rotation and elastic
+    deformation, and the noise is only added to the raw data.
+    """
+
+    def __init__(self, rot_range: float, elastic_alpha: int,
+                 sigma_noise: float, salt_pepper_p: float,
+                 salt_pepper_ampl: float):
+        self.rot_range = rot_range
+        self.elastic_alpha = elastic_alpha
+        self.sigma_noise = sigma_noise
+        self.salt_pepper_p = salt_pepper_p
+        self.salt_pepper_ampl = salt_pepper_ampl
+
+    def __call__(self, raw_data: np.array, labels: np.array, rng) -> tuple:
+        """
+        :param raw_data: array of shape 1 x Dz x Dy x Dx
+        :param labels: array of shape S x Dz x Dy x Dx
+        :param rng: np.random.Generator of the transforms
+        :return: transformed raw_data, labels
+        """
+        raw_transforms, label_transforms = \
+            get_transforms(rot_range=self.rot_range,
+                           elastic_alpha=self.elastic_alpha,
+                           sigma_noise=self.sigma_noise,
+                           salt_pepper_p=self.salt_pepper_p,
+                           salt_pepper_ampl=self.salt_pepper_ampl,
+                           rng=rng)
+        for transform in raw_transforms:
+            raw_data = transform._apply_volume_function(tensor=raw_data)
+        for transform in label_transforms:
+            labels = transform._apply_volume_function(tensor=labels)
+        return raw_data, labels
@@ -2,8 +2,6 @@ import h5py
 import numpy as np
 from os.path import join
 from scipy import ndimage
-from skimage import morphology as morph
-from skimage.measure import regionprops_table
 from tqdm import tqdm
 from scipy import ndimage
 
@@ -12,76 +10,116 @@ from tomogram_utils.coordinates_toolbox.subtomos import get_subtomo_corner_side_
 from tomogram_utils.coordinates_toolbox.utils import shift_coordinates_by_vector
 
 
-def get_clusters_within_size_range(dataset: np.array, min_cluster_size: int,
-                                   max_cluster_size: int or None, connectivity=1):
+def get_labeled_clusters(dataset: np.array, connectivity=1) -> tuple:
+    """
+    Labels the connected components of the non-zero voxels of dataset, with
+    labels 1, ..., num in the order of their first voxel (as
+    skimage.morphology.label), in an int32 array when the number of voxels
+    allows it.
+    :return: (labeled_clusters, num)
+    """
+    structure = ndimage.generate_binary_structure(dataset.ndim, connectivity)
+    dtype = np.int32 if dataset.size < np.iinfo(np.int32).max else np.int64
+    labeled_clusters = np.empty(dataset.shape, dtype=dtype)
+    num = ndimage.label(dataset, structure=structure, output=labeled_clusters)
+    return labeled_clusters, num
+
+
+def get_clusters_sizes_and_centroids(labeled_clusters: np.array, num: int,
+                                     slab_size: int = 16) -> tuple:
+    """
+    Sizes and centroids of the clusters 1, ..., num of a labeled volume,
+    accumulated with np.bincount over the foreground voxels of slabs along
+    the first axis, so that no full-size temporary is created.
+    :return: (sizes, centroids) of shapes (num + 1,) and (num + 1, ndim),
+    where index 0 corresponds to the background and is not filled.
+    """
+    sizes = np.zeros(num + 1, dtype=np.int64)
+    coordinates_sums = np.zeros((num + 1, labeled_clusters.ndim))
+    for z0 in range(0, labeled_clusters.shape[0], slab_size):
+        slab = labeled_clusters[z0:z0 + slab_size]
+        foreground = np.flatnonzero(slab)
+        labels = slab.ravel()[foreground]
+        sizes += np.bincount(labels, minlength=num + 1)
+        coordinates = np.unravel_index(foreground, slab.shape)
+        for axis, axis_coordinates in enumerate(coordinates):
+            if axis == 0:
+                axis_coordinates = axis_coordinates + z0
+            coordinates_sums[:, axis] += np.bincount(labels, weights=axis_coordinates, minlength=num + 1)
+    sizes[0] = 0
+    centroids = coordinates_sums / np.maximum(sizes, 1)[:, None]
+    return sizes, centroids
+
+
+def _get_clusters_in_range_map(labeled_clusters: np.array, labels: np.array,
+                               num: int) -> np.array:
+    # int8 binary map of the given labels, through a lookup table
+    labels_lut = np.zeros(num + 1, dtype=np.int8)
+    labels_lut[labels] = 1
+    return labels_lut[labeled_clusters]
+
+
+def _label_and_filter_clusters(dataset: np.array, min_cluster_size: int,
+                               max_cluster_size: int or None, connectivity=1) -> tuple:
     if max_cluster_size is None:
         max_cluster_size = np.inf
     assert min_cluster_size <= max_cluster_size
 
-    labeled_clusters, num = morph.label(dataset,
-                                        background=0,
-                                        return_num=True,
-                                        connectivity=connectivity)
-    labels_list, cluster_size = np.unique(labeled_clusters, return_counts=True)
-    # excluding the background cluster:
-    labels_list, cluster_size = labels_list[1:], cluster_size[1:]
+    labeled_clusters, num = get_labeled_clusters(dataset=dataset, connectivity=connectivity)
+    sizes, centroids = get_clusters_sizes_and_centroids(labeled_clusters=labeled_clusters, num=num)
+    labels_list, cluster_size = np.arange(1, num + 1), sizes[1:]
     print("cluster_sizes:", cluster_size)
     maximum = np.max(cluster_size)
     print("number of clusters before size filtering = ", len(labels_list))
     print("size range before size filtering: ", np.min(cluster_size), "to",
           maximum)
-    labels_list_within_range = labels_list[(cluster_size > min_cluster_size) & (
-            cluster_size <= max_cluster_size)]
-    cluster_size_within_range = list(
-        cluster_size[(cluster_size > min_cluster_size) & (
-                cluster_size <= max_cluster_size)])
+    in_range = (cluster_size > min_cluster_size) & (cluster_size <= max_cluster_size)
+    labels_list_within_range = labels_list[in_range]
+    cluster_size_within_range = list(cluster_size[in_range])
+    centroids_within_range = centroids[1:][in_range]
+    return labeled_clusters, num, labels_list_within_range, cluster_size_within_range, \
+        centroids_within_range
+
+
+def get_clusters_within_size_range(dataset: np.array, min_cluster_size: int,
+                                   max_cluster_size: int or None, connectivity=1):
+    labeled_clusters, _, labels_list_within_range, cluster_size_within_range, _ = \
+        _label_and_filter_clusters(dataset=dataset,
+                                   min_cluster_size=min_cluster_size,
+                                   max_cluster_size=max_cluster_size,
+                                   connectivity=connectivity)
     return labeled_clusters, labels_list_within_range, cluster_size_within_range
 
 
 def get_cluster_centroids(dataset: np.array, min_cluster_size: int,
                           max_cluster_size: int, connectivity=1) -> tuple:
-    labeled_clusters, labels_list_within_range, cluster_size_within_range = \
-        get_clusters_within_size_range(dataset=dataset,
-                                       min_cluster_size=min_cluster_size,
-                                       max_cluster_size=max_cluster_size,
-                                       connectivity=connectivity)
+    labeled_clusters, num, labels_list_within_range, cluster_size_within_range, centroids = \
+        _label_and_filter_clusters(dataset=dataset,
+                                   min_cluster_size=min_cluster_size,
+                                   max_cluster_size=max_cluster_size,
+                                   connectivity=connectivity)
     # Create binary mask of the labels within range
-    clusters_map_in_range = np.zeros(labeled_clusters.shape)
-    clusters_map_in_range[np.isin(labeled_clusters, labels_list_within_range)] = 1
-    # Find out the centroids of the labels within range
-    filtered_labeled_clusters = (labeled_clusters * clusters_map_in_range).astype(int)
-    props = regionprops_table(filtered_labeled_clusters, properties=('label', 'centroid'))
-    centroids_list = [np.rint([x, y, z]) for _, x, y, z in sorted(zip(props['label'].tolist(),
-                                                                      props['centroid-0'].tolist(),
-                                                                      props['centroid-1'].tolist(),
-                                                                      props['centroid-2'].tolist()))]
+    clusters_map_in_range = _get_clusters_in_range_map(labeled_clusters, labels_list_within_range, num)
+    centroids_list = list(np.rint(centroids))
     return clusters_map_in_range, centroids_list, cluster_size_within_range
 
 
 def get_cluster_centroids_in_contact(dataset: np.array, min_cluster_size: int,
                                      max_cluster_size: int, contact_mask: np.array,
                                      connectivity=1) -> tuple:
-    labeled_clusters, labels_list_within_range, cluster_size_within_range = \
-        get_clusters_within_size_range(dataset=dataset,
-                                       min_cluster_size=min_cluster_size,
-                                       max_cluster_size=max_cluster_size,
-                                       connectivity=connectivity)
-    # Apply mask for labels within range and labels with contact mask
-    labeled_clusters_in_contact = (labeled_clusters * contact_mask).astype(int)
-    labels_list_in_contact = np.unique(labeled_clusters_in_contact)[1:]
-    final_labels = np.intersect1d(labels_list_within_range, labels_list_in_contact)
+    labeled_clusters, num, labels_list_within_range, cluster_size_within_range, centroids = \
+        _label_and_filter_clusters(dataset=dataset,
+                                   min_cluster_size=min_cluster_size,
+                                   max_cluster_size=max_cluster_size,
+                                   connectivity=connectivity)
+    # Keep the labels within range that have voxels in the contact mask
+    labels_list_in_contact = np.unique(labeled_clusters[contact_mask != 0])
+    in_contact = np.isin(labels_list_within_range, labels_list_in_contact)
+    final_labels = labels_list_within_range[in_contact]
     # Create binary mask of the labels within range and contact
-    clusters_map_in_range = np.zeros(labeled_clusters.shape)
-    clusters_map_in_range[np.isin(labeled_clusters, final_labels)] = 1
-    # Find out the centroids of the labels within range
-    filtered_labeled_clusters = (labeled_clusters * clusters_map_in_range).astype(int)
-    props = regionprops_table(filtered_labeled_clusters, properties=('label', 'centroid'))
-    centroids_list = [np.rint([x, y, z]) for _, x, y, z in sorted(zip(props['label'].tolist(),
-                                                                      props['centroid-0'].tolist(),
-                                                                      props['centroid-1'].tolist(),
-                                                                      props['centroid-2'].tolist()))]
-    _, cluster_size = np.unique(filtered_labeled_clusters, return_counts=True)
-    centroids_size_list = cluster_size[1:].tolist()
+    clusters_map_in_range = _get_clusters_in_range_map(labeled_clusters, final_labels, num)
+    centroids_list = list(np.rint(centroids[in_contact]))
+    centroids_size_list = np.array(cluster_size_within_range, dtype=np.int64)[in_contact].tolist()
     return clusters_map_in_range, centroids_list, centroids_size_list
 
 
@@ -89,34 +127,23 @@ def get_cluster_centroids_colocalization(dataset: np.array, min_cluster_size: in
                                          max_cluster_size: int, contact_mask: np.array,
                                          tol_contact: float = 0,
                                          connectivity=1) -> tuple:
-    labeled_clusters, labels_list_within_range, cluster_size_within_range = \
-        get_clusters_within_size_range(dataset=dataset,
-                                       min_cluster_size=min_cluster_size,
-                                       max_cluster_size=max_cluster_size,
-                                       connectivity=connectivity)
-    # Create binary mask of the labels within range
-    clusters_map_in_range = np.zeros(labeled_clusters.shape)
-    clusters_map_in_range[np.isin(labeled_clusters, labels_list_within_range)] = 1
-    # Find out the centroids of the labels within range
-    filtered_labeled_clusters = (labeled_clusters * clusters_map_in_range).astype(int)
-    props = regionprops_table(filtered_labeled_clusters, properties=('label', 'centroid'))
-    centroids_list = [np.rint([x, y, z]) for _, x, y, z in sorted(zip(props['label'].tolist(),
-                                                                      props['centroid-0'].tolist(),
-                                                                      props['centroid-1'].tolist(),
-                                                                      props['centroid-2'].tolist()))]
+    labeled_clusters, num, labels_list_within_range, cluster_size_within_range, centroids = \
+        _label_and_filter_clusters(dataset=dataset,
+                                   min_cluster_size=min_cluster_size,
+                                   max_cluster_size=max_cluster_size,
+                                   connectivity=connectivity)
+    centroids_list = np.rint(centroids)
     # Find centroids that in given radius have voxels of the contact mask
-    inverted_mask = (contact_mask == 0).astype(int)
+    inverted_mask = (contact_mask == 0).astype(np.int8)
     distance_from_mask = ndimage.distance_transform_cdt(inverted_mask)
-    thresh_distance_mask = (distance_from_mask <= tol_contact).astype(int)
-    labels_list_filtered, cluster_size = np.unique(filtered_labeled_clusters, return_counts=True)
-    labels_list_filtered, cluster_size = labels_list_filtered[1:], cluster_size[1:]
-    mask = np.array([True if thresh_distance_mask[int(centroid[0]), int(centroid[1]), int(centroid[2])] == 1 else False
-                     for centroid in centroids_list])
-    labels_list_filtered = labels_list_filtered[mask]
-    centroids_list = np.array(centroids_list)[mask].tolist()
-    centroids_size_list = cluster_size[mask]
-    clusters_map_in_range = np.zeros(labeled_clusters.shape)
-    clusters_map_in_range[np.isin(labeled_clusters, labels_list_filtered)] = 1
+    thresh_distance_mask = distance_from_mask <= tol_contact
+    del distance_from_mask
+    mask = np.array([bool(thresh_distance_mask[int(centroid[0]), int(centroid[1]), int(centroid[2])])
+                     for centroid in centroids_list], dtype=bool)
+    labels_list_filtered = labels_list_within_range[mask]
+    centroids_list = centroids_list[mask].tolist()
+    centroids_size_list = np.array(cluster_size_within_range, dtype=np.int64)[mask]
+    clusters_map_in_range = _get_clusters_in_range_map(labeled_clusters, labels_list_filtered, num)
 
     return clusters_map_in_range, centroids_list, centroids_size_list
 
@@ -0,0 +1,193 @@
+import contextlib
+
+import numpy as np
+from scipy import ndimage
+
+from file_actions.readers.tomograms import open_tomogram
+from file_actions.writers.h5 import open_output_tomo
+
+CONTACT_MODES = [None, "intersection", "contact"]
+
+
+def _find(parent: np.array, label: int) -> int:
+    root = label
+    while parent[root] != root:
+        root = parent[root]
+    while parent[label] != root:
+        parent[label], label = root, parent[label]
+    return root
+
+
+def _get_boundary_label_pairs(previous_plane: np.array, plane: np.array,
+                              structure: np.array) -> np.array:
+    """
+    Pairs (label in previous_plane, label in plane) of foreground voxels
+    that are neighbors across the two consecutive z-planes, according to
+    the first plane of the connectivity structure.
+    """
+    height, width = plane.shape
+    pairs = [np.zeros((0, 2), dtype=plane.dtype)]
+    for dy, dx in zip(*np.nonzero(structure[0])):
+        dy, dx = dy - 1, dx - 1
+        previous_labels = previous_plane[max(dy, 0):height + min(dy, 0), max(dx, 0):width + min(dx, 0)]
+        labels = plane[max(-dy, 0):height + min(-dy, 0), max(-dx, 0):width + min(-dx, 0)]
+        connected = (previous_labels != 0) & (labels != 0)
+        pairs.append(np.stack([previous_labels[connected], labels[connected]], axis=1))
+    return np.unique(np.concatenate(pairs), axis=0)
+
+
+def _label_slab(slab: np.array, structure: np.array) -> tuple:
+    labels = np.empty(slab.shape, dtype=np.int32)
+    num = ndimage.label(slab, structure=structure, output=labels)
+    return labels, num
+
+
+class _SlabReader:
+    """
+    Reads thresholded (int8) z-slabs of a probability map, with the border
+    set to zero and the region mask applied as in clustering_and_cleaning.py.
+    """
+
+    def __init__(self, prediction, threshold: float, ignore_border_thickness,
+                 mask=None, contact_mode: str or None = None):
+        assert mask is None or contact_mode in CONTACT_MODES, \
+            "contact_mode should be one of {} for clustering by slabs".format(CONTACT_MODES)
+        self.prediction = prediction
+        self.threshold = threshold
+        self.mask = mask
+        self.contact_mode = contact_mode if mask is not None else None
+        if isinstance(ignore_border_thickness, int):
+            ignore_border_thickness = [ignore_border_thickness] * 3
+        ix, iy, iz = ignore_border_thickness
+        self.border = iz, iy, ix
+        if mask is None:
+            self.shape = tuple(prediction.shape)
+        else:
+            self.shape = tuple(np.minimum(prediction.shape, mask.shape))
+
+    def read(self, z0: int, z1: int) -> tuple:
+        """
+        :return: (thresholded slab, mask slab or None) of z-planes z0:z1
+        """
+        sz, sy, sx = self.shape
+        z1 = min(z1, sz)
+        slab = (np.asarray(self.prediction[z0:z1, :sy, :sx]) > self.threshold).astype(np.int8)
+        iz, iy, ix = self.border
+        if iz > 0:
+            z = np.arange(z0, z1)
+            slab[(z < iz) | (z >= self.prediction.shape[0] - iz)] = 0
+        if iy > 0:
+            slab[:, :iy] = 0
+            slab[:, max(self.prediction.shape[1] - iy, 0):] = 0
+        if ix > 0:
+            slab[:, :, :ix] = 0
+            slab[:, :, max(self.prediction.shape[2] - ix, 0):] = 0
+        if self.contact_mode is None:
+            return slab, None
+        mask_slab = np.asarray(self.mask[z0:z1, :sy, :sx]).astype(np.int8)
+        if self.contact_mode == "intersection":
+            slab *= mask_slab
+        return slab, mask_slab
+
+
+def get_cluster_centroids_by_slabs(prediction_path: str, output_path: str,
+                                   threshold: float, min_cluster_size: int,
+                                   max_cluster_size: int or None,
+                                   ignore_border_thickness=0,
+                                   mask_path: str or None = None,
+                                   contact_mode: str or None = None,
+                                   connectivity=1, slab_size: int = 64) -> tuple:
+    """
+    Out-of-core version of get_cluster_centroids (and of the intersection
+    and contact modes of clustering_and_cleaning.py), for probability maps
+    that do not fit in memory. The map (and mask) are read in z-slabs of
+    slab_size planes; each slab is labeled on its own, and the labels of
+    clusters crossing slab boundaries are merged with a union-find over the
+    boundary planes. Sizes and centroid sums are accumulated per slab label.
+    A second pass writes the binary map of the clusters within size range
+    into output_path (.mrc or .hdf).
+    The clusters, their order, centroids and sizes are the same as those
+    of the in-memory labeling with the same connectivity.
+    :return: (centroids_list, cluster_size_list)
+    """
+    if max_cluster_size is None:
+        max_cluster_size = np.inf
+    assert min_cluster_size <= max_cluster_size
+    structure = ndimage.generate_binary_structure(3, connectivity)
+    with contextlib.ExitStack() as stack:
+        prediction = stack.enter_context(open_tomogram(prediction_path))
+        mask = stack.enter_context(open_tomogram(mask_path)) if mask_path is not None else None
+        reader = _SlabReader(prediction=prediction, threshold=threshold,
+                             ignore_border_thickness=ignore_border_thickness,
+                             mask=mask, contact_mode=contact_mode)
+        # First pass: label slabs, merge across boundaries and accumulate
+        parent = np.zeros(1, dtype=np.int64)
+        sizes = np.zeros(1, dtype=np.int64)
+        coordinates_sums = np.zeros((1, 3))
+        in_contact = np.zeros(1, dtype=bool)
+        slab_offsets = []
+        previous_plane = None
+        for z0 in range(0, reader.shape[0], slab_size):
+            slab, mask_slab = reader.read(z0, z0 + slab_size)
+            labels, num = _label_slab(slab, structure)
+            # Slab labels l = 1, ..., num become offset + l in the whole map
+            offset = parent.shape[0] - 1
+            slab_offsets.append((offset, num))
+            parent = np.concatenate([parent, np.arange(offset + 1, offset + num + 1)])
+            foreground = np.flatnonzero(labels)
+            slab_labels = labels.ravel()[foreground]
+            sizes = np.concatenate([sizes, np.bincount(slab_labels, minlength=num + 1)[1:]])
+            slab_sums = np.zeros((num, 3))
+            for axis, axis_coordinates in enumerate(np.unravel_index(foreground, slab.shape)):
+                if axis == 0:
+                    axis_coordinates = axis_coordinates + z0
+                slab_sums[:, axis] = np.bincount(slab_labels, weights=axis_coordinates,
+                                                 minlength=num + 1)[1:]
+            coordinates_sums = np.concatenate([coordinates_sums, slab_sums])
+            slab_in_contact = np.zeros(num, dtype=bool)
+            if reader.contact_mode == "contact":
+                slab_in_contact[np.unique(labels[(labels > 0) & (mask_slab != 0)]) - 1] = True
+            in_contact = np.concatenate([in_contact, slab_in_contact])
+            plane = np.where(labels[0] > 0, labels[0].astype(np.int64) + offset, 0)
+            if previous_plane is not None:
+                for previous_label, label in _get_boundary_label_pairs(previous_plane, plane, structure):
+                    previous_root, root = _find(parent, previous_label), _find(parent, label)
+                    if previous_root != root:
+                        parent[max(previous_root, root)] = min(previous_root, root)
+            previous_plane = np.where(labels[-1] > 0, labels[-1].astype(np.int64) + offset, 0)
+            del slab, mask_slab, labels
+
+        # Each cluster is labeled by the rank of its smallest slab label,
+        # which is the order of its first voxel, as in the in-memory labeling
+        roots = parent.copy()
+        while True:
+            next_roots = roots[roots]
+            if np.array_equal(next_roots, roots):
+                break
+            roots = next_roots
+        cluster_roots, slab_label_to_cluster = np.unique(roots, return_inverse=True)
+        num = cluster_roots.shape[0] - 1
+        cluster_size = np.bincount(slab_label_to_cluster, weights=sizes, minlength=num + 1)[1:].astype(np.int64)
+        centroids = np.stack([np.bincount(slab_label_to_cluster, weights=coordinates_sums[:, axis],
+                                          minlength=num + 1)[1:]
+                              for axis in range(3)], axis=1) / np.maximum(cluster_size, 1)[:, None]
+        print("number of clusters before size filtering = ", num)
+        if num > 0:
+            print("size range before size filtering: ", np.min(cluster_size), "to", np.max(cluster_size))
+        selected = (cluster_size > min_cluster_size) & (cluster_size <= max_cluster_size)
+        if reader.contact_mode == "contact":
+            selected &= np.bincount(slab_label_to_cluster, weights=in_contact, minlength=num + 1)[1:] > 0
+        slab_label_selected = np.concatenate([[False], selected])[slab_label_to_cluster].astype(np.int8)
+
+        # Second pass: write the binary map of the selected clusters
+        with open_output_tomo(output_path, reader.shape, fill=0) as clusters_map:
+            for z0, (offset, num) in zip(range(0, reader.shape[0], slab_size), slab_offsets):
+                slab, _ = reader.read(z0, z0 + slab_size)
+                labels, _ = _label_slab(slab, structure)
+                slab_selected = np.concatenate([np.zeros(1, dtype=np.int8),
+                                                slab_label_selected[offset + 1:offset + num + 1]])
+                clusters_map[z0:z0 + slab.shape[0]] = slab_selected[labels]
+    centroids_list = list(np.rint(centroids[selected]))
+    cluster_size_list = list(cluster_size[selected])
+    print(len(centroids_list), "clusters within size range")
+    return centroids_list, cluster_size_list
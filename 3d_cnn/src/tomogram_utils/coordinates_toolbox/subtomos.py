@@ -27,6 +27,64 @@ def get_subtomo_corners(output_shape: tuple, subtomo_shape: tuple,
     return start_corners, end_corners, side_lengths
 
 
+def get_inner_subtomo_slices(output_shape: tuple, subtomo_shape: tuple,
+                             subtomo_center: tuple or list,
+                             overlap: int) -> tuple or None:
+    """
+    Slices of the output tomogram and of a subtomogram that correspond to the
+    inner (non-overlapping) region of the subtomogram, where subtomo_center is
+    given in the coordinates of the padded tomogram the subtomogram was
+    cropped from.
+    :param output_shape: shape of the unpadded tomogram
+    :param subtomo_shape: shape of the subtomogram, including the overlap
+    :param subtomo_center: center of the subtomogram in the padded tomogram
+    :param overlap: thickness of the overlap on each side of the subtomogram
+    :return: (tomo_slices, subtomo_slices), or None if the inner region lies
+    outside of the tomogram
+    """
+    inner_subtomo_shape = tuple([subtomo_dim - 2 * overlap for
+                                 subtomo_dim in subtomo_shape])
+    output_shape_overlap = tuple([sh + overlap for sh in output_shape])
+    start_corner, end_corner, lengths = \
+        get_subtomo_corners(output_shape=output_shape_overlap,
+                            subtomo_shape=inner_subtomo_shape,
+                            subtomo_center=subtomo_center)
+    if np.min(lengths) <= 0:
+        return None
+    subtomo_slices = tuple([slice(overlap, overlap + l) for l in lengths])
+    tomo_slices = tuple([slice(s - overlap, e - overlap) for s, e in
+                         zip(start_corner, end_corner)])
+    return tomo_slices, subtomo_slices
+
+
+def get_subtomo_slices(output_shape: tuple, subtomo_shape: tuple,
+                       subtomo_center: tuple or list,
+                       overlap: int) -> tuple or None:
+    """
+    Slices of the output tomogram and of a subtomogram covering the whole
+    subtomogram (including its overlap), clipped to the tomogram, where
+    subtomo_center is given in the coordinates of the padded tomogram the
+    subtomogram was cropped from.
+    :param output_shape: shape of the unpadded tomogram
+    :param subtomo_shape: shape of the subtomogram, including the overlap
+    :param subtomo_center: center of the subtomogram in the padded tomogram
+    :param overlap: thickness of the padding on the left of each dimension
+    :return: (tomo_slices, subtomo_slices), or None if the subtomogram lies
+    outside of the tomogram
+    """
+    start_corner = [int(center) - sh // 2 - overlap for center, sh in
+                    zip(subtomo_center, subtomo_shape)]
+    tomo_start = [max(start, 0) for start in start_corner]
+    tomo_end = [min(start + sh, dim) for start, sh, dim in
+                zip(start_corner, subtomo_shape, output_shape)]
+    if any(end <= start for start, end in zip(tomo_start, tomo_end)):
+        return None
+    tomo_slices = tuple([slice(s, e) for s, e in zip(tomo_start, tomo_end)])
+    subtomo_slices = tuple([slice(s - c, e - c) for s, e, c in
+                            zip(tomo_start, tomo_end, start_corner)])
+    return tomo_slices, subtomo_slices
+
+
 def get_particle_coordinates_grid_with_overlap(dataset_shape: Tuple,
                                                shape_to_crop_zyx: Tuple,
                                                overlap_thickness: int):
@@ -1,6 +1,9 @@
+import itertools
+import math
 from typing import Tuple
 
 import numpy as np
+from scipy.spatial import cKDTree
 
 from constants.particles import create_particle_file_name
 
@@ -109,19 +112,75 @@ def extract_coordinates_from_txt_shrec(motive_list: np.array,
     return coordinates
 
 
+# Number of cells per axis in the grid keys of average_duplicated_centroids
+_CELL_KEY_BASE = 2 ** 20
+
+
+def _get_earlier_neighbors(coordinates: np.array, min_peak_distance: float) -> tuple:
+    """
+    For each point j, the points i < j at distance <= min_peak_distance,
+    found with a KD-tree, in compressed row format: the neighbors of j are
+    indices[indptr[j]:indptr[j + 1]].
+    """
+    n_points = coordinates.shape[0]
+    # The tree query is slightly wider than the distance, which is then
+    # checked exactly as np.linalg.norm(x - point) <= min_peak_distance
+    pairs = cKDTree(coordinates).query_pairs(r=min_peak_distance * (1 + 1e-9) + 1e-9,
+                                             output_type='ndarray')
+    pairs = pairs[np.linalg.norm(coordinates[pairs[:, 0]] - coordinates[pairs[:, 1]], axis=1)
+                  <= min_peak_distance]
+    earlier, later = np.min(pairs, axis=1), np.max(pairs, axis=1)
+    order = np.lexsort((earlier, later))
+    indptr = np.zeros(n_points + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(later, minlength=n_points))
+    return indptr, earlier[order]
+
+
+def get_unique_points_indices(coordinates: np.array, values: np.array or None,
+                              min_peak_distance: float,
+                              preference_by_score: bool = False,
+                              max_num_points: float = np.inf) -> list:
+    """
+    Greedy non-maximum suppression in the order of the points: a point is
+    kept unless it is within min_peak_distance of an already kept point.
+    With preference_by_score, a point with a higher value than the first
+    kept point within the distance replaces it. Points are not considered
+    once max_num_points points are kept.
+    :return: indices of the kept points, in order of first appearance
+    """
+    n_points = coordinates.shape[0]
+    if n_points == 0:
+        return []
+    indptr, neighbors = _get_earlier_neighbors(coordinates, min_peak_distance)
+    has_neighbors = (np.diff(indptr) > 0).tolist()
+    # slot_of_point[i]: position in the kept list of point i, or -1
+    slot_of_point = np.full(n_points, -1, dtype=np.int64)
+    kept_points = []
+    for point in range(n_points):
+        if len(kept_points) >= max_num_points:
+            break
+        if has_neighbors[point]:
+            slots = slot_of_point[neighbors[indptr[point]:indptr[point + 1]]]
+            slots = slots[slots >= 0]
+        else:
+            slots = []
+        if len(slots) == 0:
+            slot_of_point[point] = len(kept_points)
+            kept_points.append(point)
+        elif preference_by_score:
+            slot = np.min(slots)
+            if values[kept_points[slot]] < values[point]:
+                slot_of_point[kept_points[slot]] = -1
+                slot_of_point[point] = slot
+                kept_points[slot] = point
+    return kept_points
+
+
 def filtering_duplicate_coords(motl_coords: list, min_peak_distance: int):
-    unique_motl_coords = [motl_coords[0]]
-    for point in motl_coords[1:]:
-        flag = "unique"
-        n_point = 0
-        while flag == "unique" and n_point < len(unique_motl_coords):
-            x = unique_motl_coords[n_point]
-            n_point += 1
-            if np.linalg.norm(x - point) <= min_peak_distance:
-                flag = "repeated"
-                # print("repeated point = ", point)
-        if flag == "unique":
-            unique_motl_coords += [point]
+    kept_points = get_unique_points_indices(coordinates=np.array(motl_coords),
+                                            values=None,
+                                            min_peak_distance=min_peak_distance)
+    unique_motl_coords = [motl_coords[index] for index in kept_points]
     return unique_motl_coords
 
 
@@ -145,56 +204,76 @@ def filtering_duplicate_coords_with_values(motl_coords: list,
     rest by the given radius
     """
     motl_coords = np.array(motl_coords)
-    unique_motl_coords = [motl_coords[0]]
-    unique_motl_values = [motl_values[0]]
-
-    for value, point in zip(motl_values[1:], motl_coords[1:]):
-        flag = "unique"
-        n_point = 0
-        n_unique_points = len(unique_motl_coords)
-        if n_unique_points < max_num_points:
-            while flag == "unique" and n_point < n_unique_points:
-                x = unique_motl_coords[n_point]
-                x_val = unique_motl_values[n_point]
-                n_point += 1
-                if np.linalg.norm(x - point) <= min_peak_distance:
-                    flag = "repeated"
-                    if preference_by_score and (x_val < value):
-                        unique_motl_coords[n_point] = point
-                        unique_motl_values[n_point] = value
-            if flag == "unique":
-                unique_motl_coords += [point]
-                unique_motl_values += [value]
+    kept_points = get_unique_points_indices(coordinates=motl_coords,
+                                            values=np.array(motl_values),
+                                            min_peak_distance=min_peak_distance,
+                                            preference_by_score=preference_by_score,
+                                            max_num_points=max_num_points)
+    unique_motl_coords = [motl_coords[index] for index in kept_points]
+    unique_motl_values = [motl_values[index] for index in kept_points]
     print("Number of unique coordinates after filtering:",
           len(unique_motl_coords))
     return unique_motl_values, unique_motl_coords
 
 
+def _get_cell_key(point, cell_side: float) -> int:
+    # Integer key of the grid cell of point, such that the keys of the
+    # neighbouring cells are obtained by adding _get_neighbor_cell_deltas
+    key = 0
+    for coord in point:
+        key = key * _CELL_KEY_BASE + int(math.floor(coord / cell_side)) + _CELL_KEY_BASE // 2
+    return key
+
+
+def _get_neighbor_cell_deltas(ndim: int) -> list:
+    return [sum(offset * _CELL_KEY_BASE ** (ndim - 1 - axis) for axis, offset in enumerate(offsets))
+            for offsets in itertools.product((-1, 0, 1), repeat=ndim)]
+
+
 def average_duplicated_centroids(motl_coords: list, cluster_size_list: list,
                                  min_peak_distance: int):
-    unique_motl_coords = [motl_coords[0]]
-    unique_cluster_size_list = [cluster_size_list[0]]
-    for point, weight_point in zip(motl_coords[1:], cluster_size_list[1:]):
-        flag = "unique"
-        n_point = 0
-        while flag == "unique" and n_point < len(unique_motl_coords):
-            x = unique_motl_coords[n_point]
-            weight_x = unique_cluster_size_list[n_point]
-            n_point += 1
-            distance = np.linalg.norm(np.array(x) - np.array(point))
-            if distance <= min_peak_distance:
-                flag = "repeated"
-                total_weight = weight_point + weight_x
-                rel_weight_x = weight_x / total_weight
-                rel_weight_point = weight_point / total_weight
-                relative_mean = np.array(x) * rel_weight_x + \
-                                np.array(point) * rel_weight_point
-                print("relative_mean", relative_mean)
-                unique_motl_coords[n_point - 1] = [int(coord) for coord in
-                                                   relative_mean]
-                unique_cluster_size_list[n_point - 1] = np.mean(
-                    [weight_point, weight_x])
-        if flag == "unique":
+    """
+    Merges each point with the first kept point within min_peak_distance
+    into their weighted mean. As kept points move when merged, they are
+    looked up in a grid of cells of side min_peak_distance.
+    """
+    unique_motl_coords = []
+    unique_cluster_size_list = []
+    if len(motl_coords) == 0:
+        return unique_motl_coords, unique_cluster_size_list
+    cell_side = min_peak_distance if min_peak_distance > 0 else 1
+    cell_deltas = _get_neighbor_cell_deltas(len(motl_coords[0]))
+    max_squared_distance = (min_peak_distance * (1 + 1e-9) + 1e-9) ** 2
+    cells = {}
+    kept_positions = []
+    for point, weight_point in zip(motl_coords, cluster_size_list):
+        position = np.asarray(point, dtype=float).tolist()
+        key = _get_cell_key(position, cell_side)
+        slots = []
+        for delta in cell_deltas:
+            slots += cells.get(key + delta, [])
+        # Distances are checked exactly only for the slots that are roughly
+        # within the distance
+        slots = sorted(slot for slot in slots
+                       if sum((a - b) ** 2 for a, b in zip(kept_positions[slot], position)) <= max_squared_distance)
+        slot = next((slot for slot in slots if np.linalg.norm(
+            np.array(unique_motl_coords[slot]) - np.array(point)) <= min_peak_distance), None)
+        if slot is not None:
+            x = unique_motl_coords[slot]
+            weight_x = unique_cluster_size_list[slot]
+            total_weight = weight_point + weight_x
+            rel_weight_x = weight_x / total_weight
+            rel_weight_point = weight_point / total_weight
+            relative_mean = np.array(x) * rel_weight_x + \
+                            np.array(point) * rel_weight_point
+            unique_motl_coords[slot] = [int(coord) for coord in relative_mean]
+            unique_cluster_size_list[slot] = np.mean([weight_point, weight_x])
+            cells[_get_cell_key(kept_positions[slot], cell_side)].remove(slot)
+            kept_positions[slot] = [float(coord) for coord in unique_motl_coords[slot]]
+            cells.setdefault(_get_cell_key(kept_positions[slot], cell_side), []).append(slot)
+        else:
+            cells.setdefault(key, []).append(len(unique_motl_coords))
+            kept_positions.append(position)
             unique_motl_coords += [point]
             unique_cluster_size_list += [weight_point]
     return unique_motl_coords, unique_cluster_size_list
@@ -11,99 +11,212 @@ from osactions.filesystem import create_dir
 from tomogram_utils.coordinates_toolbox.utils import \
     extract_coordinates_and_values_from_em_motl
 from tomogram_utils.coordinates_toolbox.utils import \
-    filtering_duplicate_coords_with_values
+    get_unique_points_indices
 
 
-def _generate_unit_particle(radius: float):
+def _get_ball_offsets(radius: float) -> np.array:
+    """
+    Offsets of the voxels of a ball as an (M, 3) int array: the points of
+    the cube of half side radius - 1 within distance radius.
+    """
     radius = int(radius)
-    unit_particle = [(0, 0, 0)]
-    for i in range(radius):
-        for j in range(radius):
-            for k in range(radius):
-                if np.sqrt(i ** 2 + j ** 2 + k ** 2) <= radius:
-                    unit_particle += [(i, j, k), (-i, j, k), (i, -j, k),
-                                      (i, j, -k), (-i, -j, k), (-i, j, -k),
-                                      (i, -j, -k), (-i, -j, -k)]
-    return unit_particle
+    side = max(radius - 1, 0)
+    offsets = np.mgrid[-side:side + 1, -side:side + 1, -side:side + 1].reshape(3, -1).T
+    return offsets[np.sqrt(np.sum(offsets ** 2, axis=1)) <= radius]
+
+
+def _get_horizontal_disk_offsets(radius: int, thickness: int) -> np.array:
+    """
+    Offsets of the voxels of a disk normal to the first axis as an (M, 3)
+    int array: the points of the box of half sides
+    (thickness // 2 - 1, radius - 1, radius - 1) within distance radius of
+    that axis.
+    """
+    side, half_thickness = radius - 1, thickness // 2 - 1
+    if side < 0 or half_thickness < 0:
+        return np.zeros((0, 3), dtype=int)
+    offsets = np.mgrid[-half_thickness:half_thickness + 1, -side:side + 1,
+                       -side:side + 1].reshape(3, -1).T
+    return offsets[np.sqrt(np.sum(offsets[:, 1:] ** 2, axis=1)) <= radius]
+
+
+def _get_zxz_rotation_matrix(ZXZ_angles: tuple) -> np.array:
+    """
+    Rotation matrix of the ZXZ Euler angles (psi, theta, sigma), in degrees,
+    acting on hdf (z, y, x) coordinates.
+    """
+    psi, theta, sigma = np.array(ZXZ_angles) * np.pi / 180
+
+    rot_z = lambda psi: np.array(
+        [[np.cos(psi), -np.sin(psi), 0], [np.sin(psi), np.cos(psi), 0],
+         [0, 0, 1]])
+
+    rot_x = lambda psi: np.array([[1, 0, 0], [0, np.cos(psi), -np.sin(psi)],
+                                  [0, np.sin(psi), np.cos(psi)]])
+
+    # To fit hdf coordinate system:
+    hdf_coords = np.array([[0, 0, 1], [0, 1, 0], [1, 0, 0]])
+    swap_coords = np.array([[0, 1, 0], [1, 0, 0], [0, 0, 1]])
+    ZXZ_matrix = rot_z(psi).dot(rot_x(theta))
+    ZXZ_matrix = ZXZ_matrix.dot(rot_z(sigma))
+    ZXZ_matrix = hdf_coords.dot(ZXZ_matrix)
+    ZXZ_matrix = ZXZ_matrix.dot(swap_coords)
+    return ZXZ_matrix
+
+
+def _get_stamp_points(shape: tuple, centers: np.array,
+                      offsets: np.array) -> tuple:
+    """
+    Voxels centers + offsets that fall inside a volume of the given shape.
+    :param offsets: (M, 3) offsets shared by all the centers, or (N, M, 3)
+    offsets of each of the N centers
+    :return: (index tuple of the voxels, particle index of each voxel)
+    """
+    if offsets.ndim == 2:
+        offsets = offsets[None, :, :]
+    points = (centers[:, None, :] + offsets).reshape(-1, 3)
+    particles = np.repeat(np.arange(centers.shape[0]), points.shape[0] // max(centers.shape[0], 1))
+    inside = np.all((points >= 0) & (points < shape), axis=1)
+    return tuple(points[inside].T), particles[inside]
+
+
+def paste_offsets_in_dataset(dataset: np.array, centers: np.array,
+                             offsets: np.array, values: float or np.array = 1,
+                             mask: np.array or None = None,
+                             keep_maximum: bool = False,
+                             chunk_size: int = 2 ** 22) -> np.array:
+    """
+    Pastes the stencil given by offsets around each of the centers, clipped
+    to the volume. Where stencils overlap, the value of the last particle
+    is kept, or the largest value if keep_maximum.
+    :param dataset: volume, modified in place
+    :param centers: (N, 3) voxel coordinates
+    :param offsets: (M, 3) offsets shared by all the centers, or (N, M, 3)
+    offsets of each center
+    :param values: value pasted for each center, or a common value
+    :param mask: if given, only the centers inside the mask shape whose
+    mask voxel is 1 are pasted
+    :param chunk_size: maximum number of voxels indexed at once
+    """
+    centers = np.array(centers, dtype=int).reshape(-1, 3)
+    values = np.broadcast_to(np.asarray(values), (centers.shape[0],))
+    offsets = np.asarray(offsets, dtype=int)
+    if mask is not None:
+        in_mask = np.all(centers < mask.shape, axis=1) & np.all(centers >= 0, axis=1)
+        in_mask[in_mask] = mask[tuple(centers[in_mask].T)] == 1
+        centers, values = centers[in_mask], values[in_mask]
+        if offsets.ndim == 3:
+            offsets = offsets[in_mask]
+    particles_per_chunk = max(chunk_size // max(offsets.shape[-2], 1), 1)
+    for start in range(0, centers.shape[0], particles_per_chunk):
+        chunk = slice(start, start + particles_per_chunk)
+        points, particles = _get_stamp_points(dataset.shape, centers[chunk],
+                                              offsets[chunk] if offsets.ndim == 3 else offsets)
+        chunk_values = values[chunk][particles]
+        if keep_maximum:
+            np.maximum.at(dataset, points, chunk_values)
+        elif chunk_values.shape[0] > 0 and np.all(chunk_values == chunk_values[0]):
+            dataset[points] = chunk_values[0]
+        else:
+            # Fancy assignment does not define which of the repeated voxels
+            # wins, so the last occurrence of each voxel is selected
+            flat_points = np.ravel_multi_index(points, dataset.shape)
+            _, last = np.unique(flat_points[::-1], return_index=True)
+            last = flat_points.shape[0] - 1 - last
+            dataset[tuple(axis_points[last] for axis_points in points)] = chunk_values[last]
+    return dataset
+
+
+def paste_spheres_in_dataset(dataset: np.array, centers: np.array,
+                             radius: int, values: float or np.array = 1,
+                             mask: np.array or None = None,
+                             keep_maximum: bool = False) -> np.array:
+    """
+    Pastes a ball of the given radius (see _get_ball_offsets) around each
+    of the centers; see paste_offsets_in_dataset.
+    """
+    return paste_offsets_in_dataset(dataset=dataset, centers=centers,
+                                    offsets=_get_ball_offsets(radius),
+                                    values=values, mask=mask,
+                                    keep_maximum=keep_maximum)
 
 
 def paste_sphere_in_dataset(dataset: np.array, center: tuple or list,
                             radius: int, value: float = 1):
-    dataset_shape = dataset.shape
-    cx, cy, cz = center
-    ball = _generate_unit_particle(radius)
-    for point in ball:
-        i, j, k = point
-        i, j, k = int(i), int(j), int(k)
-        rel_point = np.array([i + cx, j + cy, k + cz])
-        inside_criterion = rel_point < np.array(dataset_shape)
-        if np.min(rel_point) >= 0 and np.min(inside_criterion):
-            dataset[i + cx, j + cy, k + cz] = value
-    return dataset
+    return paste_spheres_in_dataset(dataset=dataset, centers=[center],
+                                    radius=radius, values=value)
 
 
-def _get_next_max(dataset: np.array, coordinates_list: list, radius: int,
-                  numb_peaks: int, global_min: float) -> tuple:
-    unit_particle = _generate_unit_particle(radius)
-    if len(coordinates_list) < numb_peaks:
-        for p in coordinates_list:
-            particle = [np.array(p) + np.array(dp) for dp in unit_particle]
-            for coord in particle:
-                x, y, z = coord.astype(int)
-                if (coord < dataset.shape).all() and 0 <= np.min(coord):
-                    dataset[x, y, z] = global_min - 1
-        next_max = np.ndarray.max(dataset)
-        next_max_coords = np.where(next_max == dataset)
-        dataset[next_max_coords] = global_min - 1
-        n = len(next_max_coords[0])
-        next_max_coords_list = \
-            list(np.transpose(np.array(next_max_coords)).astype(int))
-        next_values_list = next_max * np.ones(n)
-        _, unique_next_coords = filtering_duplicate_coords_with_values(
-            motl_coords=next_max_coords_list,
-            motl_values=next_values_list,
-            min_peak_distance=radius,
-            preference_by_score=False,
-            max_num_points=numb_peaks)
-        flag = "not_overloaded"
-    else:
-        next_max = global_min - 1
-        unique_next_coords = []
-        flag = "overloaded"
-    return next_max, unique_next_coords, flag
+def _suppress_balls(suppressed: np.array, centers: np.array,
+                    ball_offsets: np.array):
+    points, _ = _get_stamp_points(suppressed.shape, centers, ball_offsets)
+    suppressed[points] = True
+    return
+
+
+def _get_next_candidate(suppressed_flat: np.array, order: np.array,
+                        position: int, chunk_size: int = 4096) -> int:
+    # Position in order of the next candidate that is not suppressed
+    while position < order.shape[0]:
+        free = np.flatnonzero(~suppressed_flat[order[position:position + chunk_size]])
+        if free.shape[0] > 0:
+            return position + free[0]
+        position += chunk_size
+    return order.shape[0]
 
 
 def extract_peaks(dataset: np.array, numb_peaks: int, radius: int,
                   threshold: float = -np.inf):
-    global_max = np.ndarray.max(dataset)
+    """
+    Greedy extraction of the maxima of dataset: voxels are visited by
+    decreasing value (threshold by default: the minimum of dataset), and
+    the balls (see _get_ball_offsets) around the extracted peaks are
+    suppressed. Voxels of equal value are extracted together, keeping
+    those that are not within radius of each other (in raster order, up to
+    numb_peaks), and the extraction stops after such a group of numb_peaks
+    peaks. The global maximum is always the first peak.
+    :return: (list_of_maxima, list_of_maxima_coords)
+    """
     if threshold == -np.inf:
         global_min = np.ndarray.min(dataset)
     else:
         global_min = threshold
-    # print("global_min =", global_min)
-    global_max_coords = np.where(dataset == global_max)
-    # print("global_max_coords =", global_max_coords)
-    coordinates_list = [(global_max_coords[0][0],
-                         global_max_coords[1][0],
-                         global_max_coords[2][0])]
-    # print("coordinates_list =", coordinates_list)
+    flat_dataset = dataset.reshape(-1)
+    first_max_index = np.argmax(flat_dataset)
+    global_max = flat_dataset[first_max_index]
+    coordinates_list = np.array([np.unravel_index(first_max_index, dataset.shape)])
     list_of_maxima = [global_max]
-    list_of_maxima_coords = coordinates_list
-    # for n in range(numb_peaks):
-    flag = "not_overloaded"
-    while flag != "overloaded":
-        next_max, coordinates_list, flag = \
-            _get_next_max(dataset, coordinates_list, radius, numb_peaks,
-                          global_min)
-        # print("next_max =", next_max)
-        # print("len(coordinates_list) =", len(coordinates_list))
-        # print("flag =", flag)
-        if next_max < global_min:
+    list_of_maxima_coords = [tuple(coordinates_list[0])]
+
+    # Candidates by decreasing value, in raster order for equal values
+    candidates = np.flatnonzero(flat_dataset >= global_min)
+    decreasing_values = -flat_dataset[candidates].astype(np.float64)
+    sorting = np.argsort(decreasing_values, kind="stable")
+    order, decreasing_values = candidates[sorting], decreasing_values[sorting]
+    del candidates, sorting
+
+    ball_offsets = _get_ball_offsets(radius)
+    suppressed = np.zeros(dataset.shape, dtype=bool)
+    suppressed_flat = suppressed.reshape(-1)
+    position = 0
+    while len(coordinates_list) < numb_peaks:
+        _suppress_balls(suppressed, coordinates_list, ball_offsets)
+        position = _get_next_candidate(suppressed_flat, order, position)
+        if position == order.shape[0]:
             print("Either reached indicator == global_min - 1, or threshold.")
-            flag = "overloaded"
-        else:
-            list_of_maxima += [next_max for _ in coordinates_list]
-            list_of_maxima_coords += coordinates_list
+            break
+        group_end = np.searchsorted(decreasing_values, decreasing_values[position], side="right")
+        group = order[position:group_end]
+        group = group[~suppressed_flat[group]]
+        next_max = flat_dataset[group[0]]
+        group_coordinates = np.transpose(np.unravel_index(group, dataset.shape)).astype(int)
+        unique_points = get_unique_points_indices(coordinates=group_coordinates, values=None,
+                                                  min_peak_distance=radius,
+                                                  max_num_points=numb_peaks)
+        coordinates_list = group_coordinates[unique_points]
+        list_of_maxima += [next_max for _ in coordinates_list]
+        list_of_maxima_coords += list(coordinates_list)
+        position = group_end
     return list_of_maxima, list_of_maxima_coords
 
 
@@ -132,63 +245,32 @@ def extract_motl_coordinates_and_score_values(motl: list) -> tuple:
     return score_values, coordinates
 
 
-def _generate_horizontal_disk(radius: int, thickness: int) -> list:
-    disk = []
-    for i in range(radius):
-        for j in range(radius):
-            for k in range(thickness // 2):
-                if np.sqrt(i ** 2 + j ** 2) <= radius:
-                    disk += [(k, i, j), (k, -i, j), (k, i, -j), (k, -i, -j)]
-                    if k > 0:
-                        disk += [(-k, i, j), (-k, -i, j), (-k, i, -j),
-                                 (-k, -i, -j)]
-                        # disk += [(i, j, k), (-i, j, k), (i, -j, k), (-i, -j, k)]
-                        # if k > 0:
-                        #     disk += [(i, j, -k), (-i, j, -k), (i, -j, -k),
-                        #              (-i, -j, -k)]
-
-    return disk
+def paste_rotated_disks_in_dataset(dataset: np.array, centers: np.array,
+                                   radius: int, thickness: int,
+                                   ZXZ_angles_list: list,
+                                   values: float or np.array = 1,
+                                   mask: np.array or None = None) -> np.array:
+    """
+    Pastes around each center a disk (see _get_horizontal_disk_offsets)
+    rotated by the corresponding ZXZ angles (psi, theta, sigma) in degrees;
+    see paste_offsets_in_dataset.
+    """
+    disk = _get_horizontal_disk_offsets(radius, thickness)
+    rotations = np.array([_get_zxz_rotation_matrix(ZXZ_angles)
+                          for ZXZ_angles in ZXZ_angles_list]).reshape(-1, 3, 3)
+    # Rotated offsets are truncated towards 0
+    offsets = np.einsum("nij,mj->nmi", rotations, disk).astype(int)
+    return paste_offsets_in_dataset(dataset=dataset, centers=centers,
+                                    offsets=offsets, values=values,
+                                    mask=mask)
 
 
 def paste_rotated_disk(dataset: np.array, center: tuple, radius: int,
                        thickness: int,
                        ZXZ_angles: tuple):
-    cx, cy, cz = center
-    psi, theta, sigma = ZXZ_angles
-    to_radians = lambda theta: theta * np.pi / 180
-    #
-    psi = to_radians(psi)
-    theta = to_radians(theta)
-    sigma = to_radians(sigma)
-
-    rot_z = lambda psi: np.array(
-        [[np.cos(psi), -np.sin(psi), 0], [np.sin(psi), np.cos(psi), 0],
-         [0, 0, 1]])
-
-    rot_x = lambda psi: np.array([[1, 0, 0], [0, np.cos(psi), -np.sin(psi)],
-                                  [0, np.sin(psi), np.cos(psi)]])
-
-    # To fit hdf coordinate system:
-    hdf_coords = np.array([[0, 0, 1], [0, 1, 0], [1, 0, 0]])
-    swap_coords = np.array([[0, 1, 0], [1, 0, 0], [0, 0, 1]])
-    ZXZ_matrix = rot_z(psi).dot(rot_x(theta))
-    ZXZ_matrix = ZXZ_matrix.dot(rot_z(sigma))
-    print(ZXZ_matrix)
-    ZXZ_matrix = hdf_coords.dot(ZXZ_matrix)
-    ZXZ_matrix = ZXZ_matrix.dot(swap_coords)
-
-    disk = _generate_horizontal_disk(radius, thickness)
-    new_disk = []
-    for point in disk:
-        new_disk += [ZXZ_matrix.dot(np.array(point))]
-    for point in new_disk:
-        i, j, k = point
-        i = int(i)
-        j = int(j)
-        k = int(k)
-        dataset[i + cx, j + cy, k + cz] = 1
-
-    return dataset
+    return paste_rotated_disks_in_dataset(dataset=dataset, centers=[center],
+                                          radius=radius, thickness=thickness,
+                                          ZXZ_angles_list=[ZXZ_angles])
 
 
 def read_motl_coordinates_and_values(path_to_motl: str) -> tuple:
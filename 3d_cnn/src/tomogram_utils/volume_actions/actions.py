@@ -1,22 +1,33 @@
+import contextlib
+import multiprocessing
+import os
 import random
-from os.path import join
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 import h5py
 import numpy as np
+import torch
 from tqdm import tqdm
 
-from constants import h5_internal_paths
 from file_actions.readers.h5 import read_training_data_dice_multi_class
-from file_actions.readers.tomograms import load_tomogram
+from file_actions.readers.tomograms import load_tomogram, open_tomogram
 from file_actions.writers.h5 import \
     write_joint_raw_and_labels_subtomograms_dice_multiclass
-from file_actions.writers.h5 import write_raw_subtomograms_intersecting_mask
-from file_actions.writers.h5 import write_subtomograms_from_dataset, \
+from file_actions.writers.h5 import BACKGROUND_LOGIT, write_subtomograms_from_dataset, \
     write_joint_raw_and_labels_subtomograms
+from file_actions.writers.partition import SubtomoWriter, merge_partition_shards, \
+    write_tile_occupancy
 from image.filters import preprocess_data
-from tensors.actions import crop_window_around_point
+from networks.io import get_device
+from tensors.actions import PaddedView, crop_window_around_point, get_blending_window
 from tomogram_utils.coordinates_toolbox.subtomos import \
-    get_particle_coordinates_grid_with_overlap, get_random_particle_coordinates
+    get_particle_coordinates_grid_with_overlap, get_random_particle_coordinates, \
+    get_inner_subtomo_slices, get_subtomo_slices
+
+# Number of subtomograms cropped and written together by
+# write_strongly_labeled_subtomograms
+WRITE_BATCH_SIZE = 32
 
 
 def _chunkify_list(lst, n):
@@ -248,6 +259,34 @@ def split_and_preprocess_dataset(data: np.array, labels: np.array, split: float,
     return train_data, train_labels, val_data, val_labels, final_data_order
 
 
+def split_subtomo_keys(keys: list, split: int or float, DA_rounds: int = 0,
+                       shuffle: bool = True) -> tuple:
+    """
+    Splits the keys of the subtomograms of a partition into a training and a
+    validation set, as split_and_preprocess_dataset does with the
+    subtomograms themselves: the keys are divided into DA_rounds + 1 chunks
+    of data augmentation rounds, and the i-th key of every chunk goes to the
+    same set.
+    :return: train_keys, val_keys
+    """
+    n_chunks = DA_rounds + 1
+    if len(keys) <= 1:
+        return list(keys), []
+    split = _define_splitting(split=split, n_total=len(keys) // n_chunks)
+    if split <= 1:
+        print("Single training example, it will be considered for training.")
+        return list(keys), []
+    keys_chunks = [list(chunk) for chunk in _chunkify_list(lst=np.arange(len(keys)), n=n_chunks)]
+    # As zip in _split_data_augmentation_chunks, keep the volumes present in
+    # all the chunks
+    volumes_order = list(range(np.min([len(chunk) for chunk in keys_chunks])))
+    if shuffle:
+        random.shuffle(volumes_order)
+    train_keys = [keys[chunk[volume]] for chunk in keys_chunks for volume in volumes_order[:split]]
+    val_keys = [keys[chunk[volume]] for chunk in keys_chunks for volume in volumes_order[split:]]
+    return train_keys, val_keys
+
+
 def load_and_normalize_dataset_list(training_partition_paths: list,
                                     data_aug_rounds_list: list,
                                     segmentation_names: list,
@@ -351,17 +390,119 @@ def pad_dataset(dataset: np.array, cubes_with_border_shape: tuple,
     return padded_dataset
 
 
+def get_padding_indices(dataset_shape: tuple, cubes_with_border_shape: tuple,
+                        overlap_thickness: int = 12) -> list:
+    """
+    Indices along each axis such that
+    dataset[np.ix_(*indices)] == pad_dataset(dataset, ...) (see PaddedView).
+    """
+    internal_cube_shape = [dim - 2 * overlap_thickness for dim in
+                           cubes_with_border_shape]
+    right_padding = get_right_padding_lengths(dataset_shape,
+                                              internal_cube_shape)
+    right_padding = [[overlap_thickness, padding + overlap_thickness] for
+                     padding in right_padding]
+    if np.min(right_padding) > 0:
+        return [np.pad(np.arange(dim), pad_width=padding, mode="reflect")
+                for dim, padding in zip(dataset_shape, right_padding)]
+    return [np.arange(dim) for dim in dataset_shape]
+
+
+def _get_window_bounds(window_centers: list, crop_shape: tuple) -> tuple:
+    # same windows as crop_window_around_point
+    half_shape = np.array(crop_shape) // 2
+    window_centers = np.array(window_centers, dtype=np.int64).reshape(-1, 3)
+    return window_centers - half_shape, window_centers + half_shape
+
+
+def pad_dataset_view(dataset: np.array, cubes_with_border_shape: tuple,
+                     overlap_thickness: int = 12) -> PaddedView:
+    """
+    Same padded dataset as pad_dataset, as a PaddedView that reflects the
+    borders only in the windows read from it, instead of a padded copy.
+    """
+    return PaddedView(dataset, get_padding_indices(dataset.shape, cubes_with_border_shape,
+                                                   overlap_thickness))
+
+
+def _get_block_bounds(window_starts: np.array, window_stops: np.array) -> list:
+    # bounds, along each axis, of the blocks such that every window is a
+    # union of consecutive blocks
+    return [np.unique(np.concatenate([window_starts[:, axis], window_stops[:, axis]]))
+            for axis in range(window_starts.shape[1])]
+
+
+def count_window_voxels_above(dataset: np.array or PaddedView, threshold: float,
+                              window_centers: list, crop_shape: tuple) -> np.array:
+    """
+    Number of voxels above threshold in each window of the (padded) dataset,
+    for all windows at once, by block reductions: the dataset is cut into
+    the blocks between consecutive window bounds along each axis, the
+    indicator is summed in each block in a single pass over the z-slices,
+    and the count of each window is read from the summed-volume table of the
+    (small) grid of block sums.
+    :param dataset: dataset, or PaddedView of it
+    :param threshold: voxels strictly above it are counted
+    :param window_centers: centers of the windows
+    :param crop_shape: shape of the windows
+    :return: np.array of counts, one per window
+    """
+    if not isinstance(dataset, PaddedView):
+        dataset = PaddedView(dataset, [np.arange(dim) for dim in dataset.shape])
+    z_indices, y_indices, x_indices = dataset.padding_indices
+    dataset = dataset.dataset
+    window_starts, window_stops = _get_window_bounds(window_centers, crop_shape)
+    if len(window_starts) == 0:
+        return np.zeros(0, dtype=np.int64)
+    z_bounds, y_bounds, x_bounds = _get_block_bounds(window_starts, window_stops)
+    y_region = y_indices[y_bounds[0]:y_bounds[-1]]
+    x_region = x_indices[x_bounds[0]:x_bounds[-1]]
+    block_sums = np.zeros((len(z_bounds), len(y_bounds), len(x_bounds)), dtype=np.int64)
+    plane_counts = np.zeros(dataset.shape[1:], dtype=np.int32)
+    for z_block, (z_start, z_stop) in enumerate(zip(z_bounds[:-1], z_bounds[1:])):
+        plane_counts[:] = 0
+        for z_index in z_indices[z_start:z_stop]:
+            plane_counts += dataset[z_index] > threshold
+        region_counts = np.take(np.take(plane_counts, y_region, axis=0), x_region, axis=1)
+        block_sums[z_block + 1, 1:, 1:] = np.add.reduceat(
+            np.add.reduceat(region_counts, y_bounds[:-1] - y_bounds[0], axis=0, dtype=np.int64),
+            x_bounds[:-1] - x_bounds[0], axis=1)
+    summed_blocks = block_sums.cumsum(axis=0).cumsum(axis=1).cumsum(axis=2)
+    z0, y0, x0 = [np.searchsorted(bounds, window_starts[:, axis])
+                  for axis, bounds in enumerate([z_bounds, y_bounds, x_bounds])]
+    z1, y1, x1 = [np.searchsorted(bounds, window_stops[:, axis])
+                  for axis, bounds in enumerate([z_bounds, y_bounds, x_bounds])]
+    return (summed_blocks[z1, y1, x1] - summed_blocks[z0, y1, x1] - summed_blocks[z1, y0, x1]
+            - summed_blocks[z1, y1, x0] + summed_blocks[z0, y0, x1] + summed_blocks[z0, y1, x0]
+            + summed_blocks[z1, y0, x0] - summed_blocks[z0, y0, x0])
+
+
+def get_tile_mask_fractions(mask_dataset: np.array or PaddedView,
+                            window_centers: list, crop_shape: tuple) -> np.array:
+    """
+    Tile occupancy index: fraction of each window of the (padded) region
+    mask that is inside the mask (above 0), for all windows at once (see
+    count_window_voxels_above).
+    """
+    volume = crop_shape[0] * crop_shape[1] * crop_shape[2]
+    return count_window_voxels_above(mask_dataset, 0, window_centers, crop_shape) / volume
+
+
 def partition_tomogram(dataset: np.array, output_h5_file_path: str,
                        subtomo_shape: tuple,
-                       overlap: int):
-    padded_dataset = pad_dataset(dataset, subtomo_shape, overlap)
+                       overlap: int,
+                       partition_format: int = 1,
+                       compression: str or None = None):
+    padded_dataset = pad_dataset_view(dataset, subtomo_shape, overlap)
     padded_particles_coordinates = get_particle_coordinates_grid_with_overlap(
         padded_dataset.shape,
         subtomo_shape,
         overlap)
     write_subtomograms_from_dataset(output_h5_file_path, padded_dataset,
                                     padded_particles_coordinates,
-                                    subtomo_shape)
+                                    subtomo_shape,
+                                    partition_format=partition_format,
+                                    compression=compression)
 
 
 def partition_raw_and_labels_tomograms(raw_dataset: np.array,
@@ -369,10 +510,12 @@ def partition_raw_and_labels_tomograms(raw_dataset: np.array,
                                        label_name: str,
                                        output_h5_file_path: str,
                                        subtomo_shape: tuple,
-                                       overlap: int
+                                       overlap: int,
+                                       partition_format: int = 1,
+                                       compression: str or None = None
                                        ):
-    padded_raw_dataset = pad_dataset(raw_dataset, subtomo_shape, overlap)
-    padded_labels_dataset = pad_dataset(labels_dataset, subtomo_shape, overlap)
+    padded_raw_dataset = pad_dataset_view(raw_dataset, subtomo_shape, overlap)
+    padded_labels_dataset = pad_dataset_view(labels_dataset, subtomo_shape, overlap)
     assert padded_raw_dataset.shape == padded_labels_dataset.shape
 
     padded_particles_coordinates = get_particle_coordinates_grid_with_overlap(
@@ -385,29 +528,140 @@ def partition_raw_and_labels_tomograms(raw_dataset: np.array,
         padded_labels_dataset=padded_labels_dataset,
         label_name=label_name,
         window_centers=padded_particles_coordinates,
-        crop_shape=subtomo_shape)
+        crop_shape=subtomo_shape,
+        partition_format=partition_format,
+        compression=compression)
 
 
 def partition_raw_intersecting_mask(dataset: np.array,
                                     mask_dataset: np.array,
                                     output_h5_file_path: str,
                                     subtomo_shape: tuple,
-                                    overlap: int
+                                    overlap: int,
+                                    partition_format: int = 1,
+                                    compression: str or None = None,
+                                    min_mask_fraction: float = 0
                                     ):
-    padded_raw_dataset = pad_dataset(dataset, subtomo_shape, overlap)
-    padded_mask_dataset = pad_dataset(mask_dataset, subtomo_shape, overlap)
+    """
+    Prediction partition of the tiles whose fraction inside the region mask
+    is above min_mask_fraction. The fractions of all the tiles (the tile
+    occupancy index, see get_tile_mask_fractions) are computed once and
+    written into the partition (see write_tile_occupancy).
+    """
+    padded_raw_dataset = pad_dataset_view(dataset, subtomo_shape, overlap)
+    padded_mask_dataset = pad_dataset_view(mask_dataset, subtomo_shape, overlap)
 
     padded_particles_coordinates = get_particle_coordinates_grid_with_overlap(
         padded_raw_dataset.shape,
         subtomo_shape,
         overlap)
-
-    write_raw_subtomograms_intersecting_mask(
-        output_path=output_h5_file_path,
-        padded_raw_dataset=padded_raw_dataset,
-        padded_mask_dataset=padded_mask_dataset,
-        window_centers=padded_particles_coordinates,
-        crop_shape=subtomo_shape)
+    mask_fractions = get_tile_mask_fractions(padded_mask_dataset, padded_particles_coordinates,
+                                             subtomo_shape)
+    window_centers = [center for center, fraction in zip(padded_particles_coordinates, mask_fractions)
+                      if fraction > min_mask_fraction]
+    print("Writing", len(window_centers), "of", len(padded_particles_coordinates), "tiles")
+    with h5py.File(output_h5_file_path, 'w') as f:
+        writer = SubtomoWriter(f, partition_format=partition_format,
+                               compression=compression)
+        write_padded_windows(writer=writer, raw_dataset=padded_raw_dataset, labels_datasets={},
+                             window_centers=window_centers, crop_shape=subtomo_shape)
+        write_tile_occupancy(f, centers=padded_particles_coordinates, mask_fractions=mask_fractions,
+                             min_mask_fraction=min_mask_fraction)
+
+
+def segment_tomogram(dataset: np.array, mask_dataset: np.array or None,
+                     model, output_shape: tuple, subtomo_shape: tuple,
+                     overlap: int, class_number: int, mean_value: float,
+                     std_value: float, batch_size: int = 1,
+                     final_activation: None or 'sigmoid' = 'sigmoid',
+                     blending: None or str = None,
+                     min_mask_fraction: float = 0) -> np.array:
+    """
+    Single-pass prediction of a tomogram, without writing a partition file.
+    The dataset is padded (as a PaddedView) and tiled exactly as in
+    partition_raw_intersecting_mask, the tiles whose fraction inside the mask
+    is above min_mask_fraction are segmented in batches, and the inner region of each prediction is written
+    straight into the output volume, as in assemble_tomo_from_subtomos.
+    :param dataset: raw tomogram, cropped to the shape of mask_dataset
+    :param mask_dataset: region mask, only tiles intersecting it are segmented.
+    If None, all tiles are segmented.
+    :param min_mask_fraction: tiles with a fraction inside the mask up to it
+    are skipped, and left to the background
+    :param model: network used for the segmentation
+    :param output_shape: shape of the output probability map
+    :param subtomo_shape: shape of the tiles, including the overlap
+    :param overlap: thickness of the overlap on each side of the tiles
+    :param class_number: output channel of the network to keep
+    :param mean_value: mean used to normalize the tiles
+    :param std_value: standard deviation used to normalize the tiles
+    :param batch_size: number of tiles per forward pass
+    :param final_activation: None or 'sigmoid'
+    :param blending: None to paste only the inner region of each tile, or
+    "gaussian"/"cosine" to average the whole tiles weighted by the
+    corresponding window, as in assemble_tomo_from_subtomos
+    :return: float32 array of shape output_shape
+    """
+    device = get_device()
+    padded_dataset = pad_dataset_view(dataset, subtomo_shape, overlap)
+    window_centers = get_particle_coordinates_grid_with_overlap(
+        padded_dataset.shape,
+        subtomo_shape,
+        overlap)
+    if mask_dataset is not None:
+        padded_mask_dataset = pad_dataset_view(mask_dataset, subtomo_shape, overlap)
+        mask_fractions = get_tile_mask_fractions(padded_mask_dataset, window_centers, subtomo_shape)
+        window_centers = [window_center for window_center, fraction in zip(window_centers, mask_fractions)
+                          if fraction > min_mask_fraction]
+    print("{} tiles to segment, batch_size = {}".format(len(window_centers), batch_size))
+
+    if blending is None:
+        tomo_data = np.full(output_shape, fill_value=BACKGROUND_LOGIT, dtype=np.float32)
+    else:
+        window = get_blending_window(window_shape=subtomo_shape, mode=blending)
+        tomo_data = np.zeros(output_shape, dtype=np.float32)
+        weights = np.zeros(output_shape, dtype=np.float32)
+    with torch.inference_mode():
+        for start in tqdm(range(0, len(window_centers), batch_size)):
+            batch_centers = window_centers[start:start + batch_size]
+            subtomo_data = np.array([crop_window_around_point(input_array=padded_dataset,
+                                                              crop_shape=subtomo_shape,
+                                                              window_center=window_center)
+                                     for window_center in batch_centers])
+            # normalize the subtomograms with the data mean and std
+            subtomo_data = (subtomo_data - mean_value) / std_value
+            subtomo_data = subtomo_data[:, None]
+            segmented_data = model(torch.from_numpy(subtomo_data).to(device).to(torch.float))
+            if blending is None:
+                segmented_data = segmented_data.cpu().numpy()
+                for window_center, segmented_subtomo in zip(batch_centers, segmented_data):
+                    inner_slices = get_inner_subtomo_slices(output_shape=output_shape, subtomo_shape=subtomo_shape,
+                                                            subtomo_center=window_center, overlap=overlap)
+                    if inner_slices is not None:
+                        tomo_slices, volume_slices = inner_slices
+                        tomo_data[tomo_slices] = segmented_subtomo[(class_number,) + volume_slices]
+            else:
+                segmented_data = segmented_data[:, class_number].float()
+                if final_activation is not None:
+                    segmented_data = torch.sigmoid(segmented_data)
+                segmented_data = segmented_data.cpu().numpy()
+                for window_center, segmented_subtomo in zip(batch_centers, segmented_data):
+                    slices = get_subtomo_slices(output_shape=output_shape, subtomo_shape=subtomo_shape,
+                                                subtomo_center=window_center, overlap=overlap)
+                    if slices is not None:
+                        tomo_slices, volume_slices = slices
+                        tomo_data[tomo_slices] += window[volume_slices] * segmented_subtomo[volume_slices]
+                        weights[tomo_slices] += window[volume_slices]
+    if blending is None:
+        if final_activation is not None:
+            torch.sigmoid_(torch.from_numpy(tomo_data))
+    else:
+        background = torch.tensor(BACKGROUND_LOGIT, dtype=torch.float)
+        if final_activation is not None:
+            background = torch.sigmoid(background)
+        covered = weights > 0
+        tomo_data[covered] /= weights[covered]
+        tomo_data[~covered] = background.item()
+    return tomo_data
 
 
 def partition_raw_and_labels_tomograms_dice_multiclass(
@@ -416,10 +670,12 @@ def partition_raw_and_labels_tomograms_dice_multiclass(
         segmentation_names: list,
         output_h5_file_path: str,
         subtomo_shape: tuple,
-        overlap: int
+        overlap: int,
+        partition_format: int = 1,
+        compression: str or None = None
 ):
     raw_dataset = load_tomogram(path_to_raw)
-    padded_raw_dataset = pad_dataset(raw_dataset, subtomo_shape, overlap)
+    padded_raw_dataset = pad_dataset_view(raw_dataset, subtomo_shape, overlap)
     padded_particles_coordinates = get_particle_coordinates_grid_with_overlap(
         padded_raw_dataset.shape,
         subtomo_shape,
@@ -429,8 +685,8 @@ def partition_raw_and_labels_tomograms_dice_multiclass(
         labels_dataset = load_tomogram(path_to_labeled)
         labels_dataset = np.array(labels_dataset)
         print(path_to_labeled, "shape", labels_dataset.shape)
-        padded_labels_dataset = pad_dataset(labels_dataset, subtomo_shape,
-                                            overlap)
+        padded_labels_dataset = pad_dataset_view(labels_dataset, subtomo_shape,
+                                                 overlap)
         padded_labels_dataset_list += [padded_labels_dataset]
     datasets_shapes = [padded.shape for padded in padded_labels_dataset_list]
     datasets_shapes += [padded_raw_dataset.shape]
@@ -441,7 +697,9 @@ def partition_raw_and_labels_tomograms_dice_multiclass(
         padded_labels_list=padded_labels_dataset_list,
         segmentation_names=segmentation_names,
         window_centers=padded_particles_coordinates,
-        crop_shape=subtomo_shape)
+        crop_shape=subtomo_shape,
+        partition_format=partition_format,
+        compression=compression)
     return
 
 
@@ -452,42 +710,154 @@ def generate_strongly_labeled_partition(path_to_raw: str,
                                         subtomo_shape: tuple,
                                         overlap: int,
                                         min_label_fraction: float = 0,
-                                        max_label_fraction: float = 1) -> list:
-    raw_dataset = load_tomogram(path_to_dataset=path_to_raw, dtype=float)
-    min_shape = raw_dataset.shape
-    labels_dataset_list = []
-    for path_to_labeled in labels_dataset_paths_list:
-        print("loading", path_to_labeled)
-        labels_dataset = load_tomogram(path_to_labeled)
-        dataset_shape = labels_dataset.shape
-        labels_dataset_list.append(labels_dataset)
-        min_shape = np.minimum(min_shape, dataset_shape)
-    min_x, min_y, min_z = min_shape
-    raw_dataset = raw_dataset[:min_x, :min_y, :min_z]
-    padded_raw_dataset = pad_dataset(raw_dataset, subtomo_shape, overlap)
-    padded_particles_coordinates = get_particle_coordinates_grid_with_overlap(
-        padded_raw_dataset.shape,
-        subtomo_shape,
-        overlap)
+                                        max_label_fraction: float = 1,
+                                        partition_format: int = 1,
+                                        compression: str or None = None,
+                                        workers: int = 1) -> list:
+    """
+    Training partition of the grid windows of a tomogram that are strongly
+    labeled (see select_strongly_labeled_windows). The tomogram and labels
+    are read through memory maps, cropped to their common shape, and the
+    windows are read from PaddedViews of them (see get_padding_indices).
+    :param workers: number of processes cropping and writing the accepted
+    windows (see write_partition_with_workers)
+    :return: label fractions of each window and label, in window order
+    """
+    print("opening", path_to_raw, "and", labels_dataset_paths_list)
+    with contextlib.ExitStack() as stack:
+        raw_volume = stack.enter_context(open_tomogram(path_to_raw))
+        label_volumes = [stack.enter_context(open_tomogram(path)) for path in labels_dataset_paths_list]
+        min_shape = np.min([raw_volume.shape] + [volume.shape for volume in label_volumes], axis=0)
+        print("min_shape = ", min_shape)
+        padding_indices = get_padding_indices(min_shape, subtomo_shape, overlap)
+        padded_labels = [PaddedView(volume, padding_indices) for volume in label_volumes]
+        padded_particles_coordinates = get_particle_coordinates_grid_with_overlap(
+            padded_labels[0].shape,
+            subtomo_shape,
+            overlap)
+        accepted, label_fractions = select_strongly_labeled_windows(
+            labels_list=padded_labels,
+            window_centers=padded_particles_coordinates,
+            crop_shape=subtomo_shape,
+            min_label_fraction=min_label_fraction,
+            max_label_fraction=max_label_fraction)
+        accepted_centers = [padded_particles_coordinates[index] for index in accepted]
+        print("Writing", len(accepted), "of", len(padded_particles_coordinates), "windows")
+        if workers <= 1:
+            with h5py.File(output_h5_file_path, 'w') as f:
+                writer = SubtomoWriter(f, partition_format=partition_format,
+                                       compression=compression)
+                write_padded_windows(writer=writer, raw_dataset=PaddedView(raw_volume, padding_indices),
+                                     labels_datasets=dict(zip(segmentation_names, padded_labels)),
+                                     window_centers=accepted_centers, crop_shape=subtomo_shape)
+    if workers > 1:
+        write_partition_with_workers(output_path=output_h5_file_path, path_to_raw=path_to_raw,
+                                     labels_paths=dict(zip(segmentation_names, labels_dataset_paths_list)),
+                                     padding_indices=padding_indices, window_centers=accepted_centers,
+                                     crop_shape=subtomo_shape, workers=workers,
+                                     partition_format=partition_format, compression=compression)
+    return label_fractions.ravel().tolist()
+
+
+def generate_partition_with_workers(path_to_raw: str,
+                                    output_h5_file_path: str,
+                                    subtomo_shape: tuple,
+                                    overlap: int,
+                                    workers: int,
+                                    path_to_mask: str or None = None,
+                                    partition_format: int = 1,
+                                    compression: str or None = None,
+                                    min_mask_fraction: float = 0):
+    """
+    Prediction partition of a tomogram written by several processes: the
+    same windows and tile occupancy index as partition_raw_intersecting_mask
+    (or the windows of partition_tomogram if there is no mask), read from
+    PaddedViews of the memory-mapped tomogram and mask.
+    """
+    with contextlib.ExitStack() as stack:
+        raw_volume = stack.enter_context(open_tomogram(path_to_raw))
+        volumes = [raw_volume]
+        if path_to_mask is not None:
+            mask_volume = stack.enter_context(open_tomogram(path_to_mask))
+            volumes.append(mask_volume)
+        min_shape = np.min([volume.shape for volume in volumes], axis=0)
+        padding_indices = get_padding_indices(min_shape, subtomo_shape, overlap)
+        window_centers = get_particle_coordinates_grid_with_overlap(
+            tuple(len(indices) for indices in padding_indices),
+            subtomo_shape,
+            overlap)
+        if path_to_mask is not None:
+            tile_centers = window_centers
+            mask_fractions = get_tile_mask_fractions(PaddedView(mask_volume, padding_indices),
+                                                     tile_centers, subtomo_shape)
+            window_centers = [center for center, fraction in zip(tile_centers, mask_fractions)
+                              if fraction > min_mask_fraction]
+    print("Writing", len(window_centers), "windows with", workers, "processes")
+    write_partition_with_workers(output_path=output_h5_file_path, path_to_raw=path_to_raw, labels_paths={},
+                                 padding_indices=padding_indices, window_centers=window_centers,
+                                 crop_shape=subtomo_shape, workers=workers,
+                                 partition_format=partition_format, compression=compression)
+    if path_to_mask is not None:
+        with h5py.File(output_h5_file_path, 'a') as f:
+            write_tile_occupancy(f, centers=tile_centers, mask_fractions=mask_fractions,
+                                 min_mask_fraction=min_mask_fraction)
+    return
 
-    padded_labels_dataset_list = []
-    for labels_dataset in labels_dataset_list:
-        labels_dataset = labels_dataset[:min_x, :min_y, :min_z]
-        padded_labels_dataset = pad_dataset(labels_dataset, subtomo_shape,
-                                            overlap)
-        padded_labels_dataset_list.append(padded_labels_dataset)
 
-    label_fractions_list = write_strongly_labeled_subtomograms(
-        output_path=output_h5_file_path,
-        padded_raw_dataset=padded_raw_dataset,
-        padded_labels_list=padded_labels_dataset_list,
-        segmentation_names=segmentation_names,
-        window_centers=padded_particles_coordinates,
-        crop_shape=subtomo_shape,
-        min_label_fraction=min_label_fraction,
-        max_label_fraction=max_label_fraction,
-        unpadded_dataset_shape=min_shape)
-    return label_fractions_list
+def _write_partition_shard(shard_path: str, path_to_raw: str, labels_paths: dict,
+                           padding_indices: list, window_centers: list, crop_shape: tuple,
+                           partition_format: int, compression: str or None) -> str:
+    with contextlib.ExitStack() as stack:
+        raw_volume = PaddedView(stack.enter_context(open_tomogram(path_to_raw)), padding_indices)
+        label_volumes = {label_name: PaddedView(stack.enter_context(open_tomogram(path)), padding_indices)
+                         for label_name, path in labels_paths.items()}
+        with h5py.File(shard_path, 'w') as f:
+            writer = SubtomoWriter(f, partition_format=partition_format,
+                                   compression=compression)
+            write_padded_windows(writer=writer, raw_dataset=raw_volume, labels_datasets=label_volumes,
+                                 window_centers=window_centers, crop_shape=crop_shape,
+                                 progress_bar=False)
+    return shard_path
+
+
+def write_partition_with_workers(output_path: str, path_to_raw: str,
+                                 labels_paths: dict, padding_indices: list,
+                                 window_centers: list, crop_shape: tuple,
+                                 workers: int, partition_format: int = 1,
+                                 compression: str or None = None):
+    """
+    Writes a partition with a pool of processes. Each process memory-maps
+    the tomogram and labels, and crops, compresses and writes a consecutive
+    part of the windows into a shard file <output_path>.shard<i>. The shards
+    are then merged, in order, into output_path without decoding their
+    chunks (see merge_partition_shards), so the partition is the same as the
+    one written by a single process.
+    :param output_path: partition file
+    :param path_to_raw: tomogram
+    :param labels_paths: dictionary {label_name: path to the label tomogram}
+    :param padding_indices: see get_padding_indices
+    :param window_centers: windows to write, in the padded tomogram
+    :param crop_shape: shape of the windows
+    :param workers: number of processes
+    """
+    shard_paths = ["{}.shard{}".format(output_path, index) for index in range(workers)]
+    shards_centers = [[window_centers[index] for index in chunk]
+                      for chunk in _chunkify_list(np.arange(len(window_centers)), workers)]
+    start = time.time()
+    # fork, so that the workers do not import the calling script again
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as executor:
+        futures = [executor.submit(_write_partition_shard, shard_path, path_to_raw, labels_paths,
+                                   padding_indices, shard_centers, crop_shape, partition_format,
+                                   compression)
+                   for shard_path, shard_centers in zip(shard_paths, shards_centers)]
+        for future in futures:
+            future.result()
+    print("Shards written by {} processes in {:.1f} s".format(workers, time.time() - start))
+    merge_partition_shards(output_path=output_path, shard_paths=shard_paths,
+                           partition_format=partition_format, compression=compression)
+    for shard_path in shard_paths:
+        os.remove(shard_path)
+    return
 
 
 def generate_random_labeled_partition(path_to_raw: str,
@@ -497,7 +867,9 @@ def generate_random_labeled_partition(path_to_raw: str,
                                       subtomo_shape: tuple,
                                       n_total: int,
                                       min_label_fraction: float = 0,
-                                      max_label_fraction: float = 1) -> list:
+                                      max_label_fraction: float = 1,
+                                      partition_format: int = 1,
+                                      compression: str or None = None) -> list:
     raw_dataset = load_tomogram(path_to_raw)
     min_shape = raw_dataset.shape
     print(path_to_raw, "shape", min_shape)
@@ -531,71 +903,92 @@ def generate_random_labeled_partition(path_to_raw: str,
         crop_shape=subtomo_shape,
         min_label_fraction=min_label_fraction,
         max_label_fraction=max_label_fraction,
-        unpadded_dataset_shape=min_shape)
+        unpadded_dataset_shape=min_shape,
+        partition_format=partition_format,
+        compression=compression)
     return label_fractions_list
 
 
+def select_strongly_labeled_windows(labels_list: list, window_centers: list,
+                                    crop_shape: tuple,
+                                    min_label_fraction: float = 0,
+                                    max_label_fraction: float = 1) -> tuple:
+    """
+    Windows where some label is above 0.5 and whose largest label fraction
+    (fraction of voxels above 0) is strictly between min_label_fraction and
+    max_label_fraction. The label fractions of all windows are computed at
+    once (see count_window_voxels_above).
+    :param labels_list: padded labels, as arrays or PaddedViews
+    :return: indices of the accepted windows, and label fractions
+    (n_windows, n_labels)
+    """
+    volume = crop_shape[0] * crop_shape[1] * crop_shape[2]
+    label_fractions = np.zeros((len(window_centers), len(labels_list)))
+    above_half = np.zeros(len(window_centers), dtype=bool)
+    for label_index, label in enumerate(labels_list):
+        positive_counts = count_window_voxels_above(label, 0, window_centers, crop_shape)
+        label_fractions[:, label_index] = positive_counts / volume
+        if np.issubdtype(label.dtype, np.integer) or label.dtype == bool:
+            above_half |= positive_counts > 0
+        else:
+            above_half |= count_window_voxels_above(label, 0.5, window_centers, crop_shape) > 0
+    label_fraction = np.max(label_fractions, axis=1, initial=0)
+    accepted = np.where(above_half & (min_label_fraction < label_fraction)
+                        & (label_fraction < max_label_fraction))[0]
+    return accepted, label_fractions
+
+
+def write_padded_windows(writer: SubtomoWriter, raw_dataset: np.array or PaddedView,
+                         labels_datasets: dict, window_centers: list,
+                         crop_shape: tuple, progress_bar: bool = True):
+    """
+    Crops the windows of the padded raw and label datasets (arrays or
+    PaddedViews), and writes them in batches of WRITE_BATCH_SIZE.
+    """
+    batches = np.array_split(np.arange(len(window_centers)),
+                             max(1, int(np.ceil(len(window_centers) / WRITE_BATCH_SIZE))))
+    for batch in tqdm(batches, disable=not progress_bar):
+        raw_data = [np.array(crop_window_around_point(input_array=raw_dataset, crop_shape=crop_shape,
+                                                      window_center=window_centers[index]))
+                    for index in batch]
+        labels_data = {label_name: [np.array(crop_window_around_point(input_array=label_dataset,
+                                                                      crop_shape=crop_shape,
+                                                                      window_center=window_centers[index]))
+                                    for index in batch]
+                       for label_name, label_dataset in labels_datasets.items()}
+        writer.write_subtomos(centers=[window_centers[index] for index in batch],
+                              raw_data=raw_data, labels_data=labels_data)
+    return
+
+
 def write_strongly_labeled_subtomograms(
         output_path: str,
-        padded_raw_dataset: np.array,
+        padded_raw_dataset: np.array or PaddedView,
         padded_labels_list: list,
         segmentation_names: list,
         window_centers: list,
         crop_shape: tuple,
         min_label_fraction: float = 0,
         max_label_fraction: float = 1,
-        unpadded_dataset_shape: tuple = None) -> list:
-    label_fractions_list = []
+        unpadded_dataset_shape: tuple = None,
+        partition_format: int = 1,
+        compression: str or None = None) -> list:
+    """
+    Writes the strongly labeled windows (see select_strongly_labeled_windows).
+    Only the accepted windows are cropped and written.
+    :param padded_raw_dataset: array or PaddedView
+    :param padded_labels_list: arrays or PaddedViews
+    :return: label fractions of each window and label, in window order
+    """
+    accepted, label_fractions = select_strongly_labeled_windows(
+        labels_list=padded_labels_list, window_centers=window_centers, crop_shape=crop_shape,
+        min_label_fraction=min_label_fraction, max_label_fraction=max_label_fraction)
+    print("Writing", len(accepted), "of", len(window_centers), "windows")
     with h5py.File(output_path, 'w') as f:
-        total_points = len(window_centers)
-        for index, window_center in zip(tqdm(range(total_points)),
-                                        window_centers):
-            # print("window_center", window_center)
-            subtomo_name = "subtomo_{0}".format(str(window_center))
-            subtomo_raw_h5_internal_path = join(
-                h5_internal_paths.RAW_SUBTOMOGRAMS,
-                subtomo_name)
-            subtomo_raw_data = crop_window_around_point(
-                input_array=padded_raw_dataset,
-                crop_shape=crop_shape,
-                window_center=window_center)
-            volume = crop_shape[0] * crop_shape[1] * crop_shape[2]
-            # print("Subtomo volume", volume)
-            subtomo_label_data_list = []
-            subtomo_label_h5_internal_path_list = []
-            segmentation_max = 0
-            label_fraction = 0
-            # Getting label channels for our current raw subtomo
-            # for index, subtomo_name in zip(tqdm(range(total_subtomos)),
-            #                                        subtomo_names):
-            for label_name, padded_label in zip(segmentation_names,
-                                                padded_labels_list):
-                subtomo_label_data = crop_window_around_point(
-                    input_array=padded_label,
-                    crop_shape=crop_shape,
-                    window_center=window_center)
-
-                subtomo_label_data_list += [subtomo_label_data]
-                subtomo_label_h5_internal_path = join(
-                    h5_internal_paths.LABELED_SUBTOMOGRAMS, label_name)
-                subtomo_label_h5_internal_path = join(
-                    subtomo_label_h5_internal_path,
-                    subtomo_name)
-                subtomo_label_h5_internal_path_list += [
-                    subtomo_label_h5_internal_path]
-                segmentation_max = np.max(
-                    [segmentation_max, np.max(subtomo_label_data)])
-                label_indicator = np.where(subtomo_label_data > 0)
-                if len(label_indicator) > 0:
-                    current_fraction = len(label_indicator[0]) / volume
-                    label_fractions_list.append(current_fraction)
-                    label_fraction = np.max(
-                        [label_fraction, current_fraction])
-            if segmentation_max > 0.5 \
-                    and min_label_fraction < label_fraction < max_label_fraction:
-                f[subtomo_raw_h5_internal_path] = subtomo_raw_data
-                for subtomo_label_h5_internal_path, subtomo_label_data in zip(
-                        subtomo_label_h5_internal_path_list,
-                        subtomo_label_data_list):
-                    f[subtomo_label_h5_internal_path] = subtomo_label_data
-    return label_fractions_list
+        writer = SubtomoWriter(f, partition_format=partition_format,
+                               compression=compression)
+        write_padded_windows(writer=writer, raw_dataset=padded_raw_dataset,
+                             labels_datasets=dict(zip(segmentation_names, padded_labels_list)),
+                             window_centers=[window_centers[index] for index in accepted],
+                             crop_shape=crop_shape)
+    return label_fractions.ravel().tolist()
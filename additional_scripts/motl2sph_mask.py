@@ -18,7 +18,7 @@ from file_actions.readers.em import read_em
 from file_actions.writers.mrc import write_mrc_dataset
 from tomogram_utils.coordinates_toolbox.utils import \
     extract_coordinates_from_em_motl
-from tomogram_utils.peak_toolbox.utils import paste_sphere_in_dataset
+from tomogram_utils.peak_toolbox.utils import paste_spheres_in_dataset
 from file_actions.readers.motl import read_txt_list
 
 
@@ -62,20 +62,9 @@ def generate_particle_mask_from_motl(path_to_motl: str, output_shape: tuple,
         scores = [value for _ in coordinates]
 
     predicted_dataset = np.zeros(output_shape)
-    if mask is not None:
-        shz, shy, shx = mask.shape
-    else:
-        shz, shy, shx = (np.inf, np.inf, np.inf)
-    for val, center in zip(scores, coordinates):
-        if mask is not None:
-            z, y, x = center
-            if z < shz and y < shy and x < shx:
-                if mask[z, y, x] == 1:
-                    paste_sphere_in_dataset(dataset=predicted_dataset, center=center,
-                                            radius=sphere_radius, value=val)
-        else:
-            paste_sphere_in_dataset(dataset=predicted_dataset, center=center,
-                                    radius=sphere_radius, value=val)
+    paste_spheres_in_dataset(dataset=predicted_dataset, centers=coordinates,
+                             radius=sphere_radius, values=np.array(scores).reshape(-1),
+                             mask=mask)
     return predicted_dataset
 
 